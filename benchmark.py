@@ -0,0 +1,577 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from faice_core import (ENCODING_SIZE, METRICS, PRECISIONS, AttendanceLog, DatasetEncoder, DistributedWorkerPool, ExactIndex,
+                        FaceDatabase, FaceDetector, FaceGallery, IVFIndex, MotionGate, RecognitionPipeline, SnapshotDeduplicator,
+                        SnapshotWriter, StageStats, VideoSource, sort_folder)
+
+try:
+    import resource
+except ImportError:  # Windows: no getrusage, so peak RSS is not reported
+    resource = None
+
+
+def synthetic_gallery(num_identities, seed=0):
+    # Unit-norm random encodings; distinct identities end up ~1.4 apart like real dlib encodings
+    rng = np.random.default_rng(seed)
+    encodings = rng.standard_normal((num_identities, ENCODING_SIZE)).astype(np.float32)
+    encodings /= np.linalg.norm(encodings, axis=1, keepdims=True)
+    names = [f"identity_{i}" for i in range(num_identities)]
+    return encodings, names
+
+
+def synthetic_queries(encodings, num_queries, noise=0.025, seed=1):
+    # Noisy copies of enrolled encodings stand in for new captures of known people
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(encodings), num_queries, replace=False)
+    return encodings[rows] + rng.normal(0.0, noise, (num_queries, ENCODING_SIZE)).astype(np.float32)
+
+
+def time_search(gallery, queries, batch_size):
+    start = time.perf_counter()
+    results = []
+    for i in range(0, len(queries), batch_size):
+        rows, _ = gallery.search(queries[i:i + batch_size])
+        results.append(rows[:, 0])
+    elapsed = time.perf_counter() - start
+    return np.concatenate(results), elapsed * 1000.0 / len(queries)
+
+
+def benchmark_index(sizes, nprobes, num_queries, batch_size):
+    metrics = {}
+    print(f"{'identities':>10} {'index':>12} {'build ms':>10} {'ms/face':>9} {'recall@1':>9}")
+    for size in sizes:
+        encodings, names = synthetic_gallery(size)
+        queries = synthetic_queries(encodings, min(num_queries, size))
+
+        start = time.perf_counter()
+        exact = FaceGallery(encodings, names, index=ExactIndex())
+        build_ms = (time.perf_counter() - start) * 1000.0
+        exact_rows, exact_ms = time_search(exact, queries, batch_size)
+        print(f"{size:>10} {'exact':>12} {build_ms:>10.1f} {exact_ms:>9.3f} {1.0:>9.3f}")
+        metrics[str(size)] = {'exact': {'build_ms': build_ms, 'ms_per_face': exact_ms, 'recall': 1.0}}
+
+        index = IVFIndex(min_train_size=0)
+        start = time.perf_counter()
+        ivf = FaceGallery(encodings, names, index=index)
+        build_ms = (time.perf_counter() - start) * 1000.0
+        for nprobe in nprobes:
+            index.nprobe = nprobe
+            ivf_rows, ivf_ms = time_search(ivf, queries, batch_size)
+            recall = float(np.mean(ivf_rows == exact_rows))
+            label = f"ivf/{nprobe}"
+            print(f"{size:>10} {label:>12} {build_ms:>10.1f} {ivf_ms:>9.3f} {recall:>9.3f}")
+            metrics[str(size)][label] = {'build_ms': build_ms, 'ms_per_face': ivf_ms, 'recall': recall}
+    return metrics
+
+
+def benchmark_quantize(sizes, num_queries, batch_size, rerank, noise):
+    # Gallery heap memory and recall@1 against an exact float32 search per precision. As in the
+    # app, quantized galleries are built on the memory-mapped FaceDatabase matrix, which they
+    # only read to re-rank; the float32 gallery holds its matrix in memory
+    metrics = {}
+    print(f"{'identities':>10} {'precision':>10} {'heap MB':>9} {'vs f32':>7} {'ms/face':>9} {'recall@1':>9} {'no rerank':>10}")
+    for size in sizes:
+        encodings, names = synthetic_gallery(size)
+        queries = synthetic_queries(encodings, min(num_queries, size), noise)
+        exact = FaceGallery(encodings, names, index=ExactIndex())
+        exact_rows, _ = time_search(exact, queries, batch_size)
+        metrics[str(size)] = {}
+        with tempfile.TemporaryDirectory() as folder:
+            face_db = FaceDatabase(folder)
+            face_db.write_all(encodings, names)
+            mapped_encodings, mapped_names = face_db.read()
+            for precision in PRECISIONS:
+                if precision == "float32":
+                    gallery = exact
+                else:
+                    gallery = FaceGallery(mapped_encodings, mapped_names, index=ExactIndex(), precision=precision, rerank=rerank)
+                rows, ms_per_face = time_search(gallery, queries, batch_size)
+                recall = float(np.mean(rows == exact_rows))
+                # Ranking on the codes alone shows what the float32 re-rank recovers
+                gallery.rerank = 1
+                unranked_recall = float(np.mean(time_search(gallery, queries, batch_size)[0] == exact_rows))
+                gallery.rerank = rerank
+                memory_mb = gallery.memory_bytes() / 2 ** 20
+                ratio = memory_mb / (exact.memory_bytes() / 2 ** 20)
+                print(f"{size:>10} {precision:>10} {memory_mb:>9.1f} {ratio:>7.2f} {ms_per_face:>9.3f} {recall:>9.3f} {unranked_recall:>10.3f}")
+                metrics[str(size)][precision] = {'heap_mb': memory_mb, 'ms_per_face': ms_per_face, 'recall': recall,
+                                                 'recall_without_rerank': unranked_recall}
+            del gallery, mapped_encodings, face_db
+    return metrics
+
+
+def read_clip_frames(path, every, max_frames, width):
+    # Samples every Nth frame as RGB, resized to the working width used by the live stream
+    capture = cv2.VideoCapture(path)
+    frames = []
+    index = 0
+    while len(frames) < max_frames:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        if index % every == 0:
+            if width and frame.shape[1] != width:
+                frame = cv2.resize(frame, (width, int(frame.shape[0] * width / frame.shape[1])))
+            frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        index += 1
+    capture.release()
+    return frames
+
+
+def box_iou(a, b):
+    top, right, bottom, left = max(a[0], b[0]), min(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])
+    intersection = max(0, bottom - top) * max(0, right - left)
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    return intersection / max(area_a + area_b - intersection, 1)
+
+
+def matched_boxes(reference, detected, threshold=0.5):
+    unused = list(detected)
+    matched = 0
+    for box in reference:
+        best = max(unused, key=lambda candidate: box_iou(box, candidate), default=None)
+        if best is not None and box_iou(box, best) >= threshold:
+            unused.remove(best)
+            matched += 1
+    return matched
+
+
+def benchmark_detect(clips, settings, reference, every, max_frames, width):
+    # Recall is measured against the reference detector's boxes on the same frames
+    frames = [frame for clip in clips for frame in read_clip_frames(clip, every, max_frames, width)]
+    if not frames:
+        print("No frames could be read from the given clips")
+        return {}
+    reference_detector = FaceDetector.parse(reference)
+    start = time.perf_counter()
+    reference_boxes = [reference_detector.detect(frame) for frame in frames]
+    reference_fps = len(frames) / (time.perf_counter() - start)
+    total_reference = sum(len(boxes) for boxes in reference_boxes)
+    print(f"{len(frames)} frames, {total_reference} reference faces ({reference} at {reference_fps:.2f} fps)")
+    print(f"{'detector':>14} {'fps':>8} {'faces':>7} {'recall':>8}")
+    metrics = {'frames': len(frames), 'reference_faces': total_reference, 'reference_fps': reference_fps}
+    for setting in settings:
+        detector = FaceDetector.parse(setting)
+        start = time.perf_counter()
+        detected = [detector.detect(frame) for frame in frames]
+        fps = len(frames) / (time.perf_counter() - start)
+        matched = sum(matched_boxes(ref, found) for ref, found in zip(reference_boxes, detected))
+        recall = matched / total_reference if total_reference else float("nan")
+        print(f"{setting:>14} {fps:>8.2f} {sum(len(boxes) for boxes in detected):>7} {recall:>8.3f}")
+        metrics[setting] = {'fps': fps, 'faces': sum(len(boxes) for boxes in detected), 'recall': recall}
+    return metrics
+
+
+class RecordingStageStats(StageStats):
+    # Keeps every duration as well, for latency percentiles over the whole run
+    def __init__(self, name, window=5.0):
+        super().__init__(name, window)
+        self.durations = []
+
+    def record(self, duration):
+        super().record(duration)
+        self.durations.append(duration)
+
+    def summary(self, seconds):
+        durations = np.asarray(self.durations) * 1000.0
+        if not len(durations):
+            return {'count': 0, 'fps': 0.0}
+        p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+        return {'count': len(durations), 'fps': len(durations) / seconds, 'mean_ms': float(durations.mean()),
+                'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99)}
+
+
+class ResourceMonitor:
+    # Wall time, CPU time and peak RSS over a block. CPU time includes reaped child processes
+    # (the encoder's process pool); peak RSS is a lifetime high-water mark, so compare runs made
+    # one benchmark per invocation.
+    def __enter__(self):
+        self.start_times = os.times()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end_times = os.times()
+        self.wall = time.perf_counter() - self.start
+        self.cpu = sum(end - start for end, start in zip(end_times[:4], self.start_times[:4]))
+        self.metrics = {'wall_s': self.wall, 'cpu_s': self.cpu, 'cpu_percent': 100.0 * self.cpu / max(self.wall, 1e-9)}
+        if resource is not None:
+            # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+            unit = 1 if sys.platform == "darwin" else 1024
+            self.metrics['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2 ** 20
+            self.metrics['children_peak_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 2 ** 20
+
+
+def fixture_images(source, count, size=(640, 480), seed=0):
+    # `count` BGR images: frames sampled evenly from a recorded video, images cycled from a
+    # folder, or random noise (which exercises decoding and detection but finds no faces)
+    if source and os.path.isdir(source):
+        paths = sorted(os.path.join(source, name) for name in os.listdir(source) if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+        images = [image for image in (cv2.imread(path) for path in paths) if image is not None]
+    elif source:
+        capture = cv2.VideoCapture(source)
+        every = max(1, int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or count) // count)
+        images = []
+        index = 0
+        while len(images) < count:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            if index % every == 0:
+                images.append(frame)
+            index += 1
+        capture.release()
+    else:
+        rng = np.random.default_rng(seed)
+        images = [rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8) for _ in range(min(count, 16))]
+    if not images:
+        raise SystemExit(f"No fixture images could be read from {source}")
+    return [images[i % len(images)] for i in range(count)]
+
+
+def write_image_folder(folder, images, prefix="image"):
+    os.makedirs(folder, exist_ok=True)
+    for i, image in enumerate(images):
+        cv2.imwrite(os.path.join(folder, f"{prefix}_{i:05d}.jpg"), image)
+
+
+def benchmark_stream(clip, identities, duration, frame_rate, workers, detector, display_fps=None, capture_options=None,
+                     motion_gating=False, worker_pool=None):
+    # Drives the live-stream pipeline (what LiveStreamApp.start_stream builds) without a window:
+    # the clip is paced at its native frame rate and looped, like a camera. display_fps decodes
+    # frames for a display that isn't there, as LiveStreamApp would. Run with and without
+    # motion_gating to compare the detector duty cycle on the same clip
+    encodings, names = synthetic_gallery(identities)
+    gallery = FaceGallery(encodings, names, index=IVFIndex(nprobe=8))
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        video_source = VideoSource(clip, name=os.path.basename(clip), **(capture_options or {}))
+        if not video_source.connect():
+            raise SystemExit(f"Could not open {clip}")
+        attendance_log = AttendanceLog(os.path.join(folder, "attendance.db"))
+        snapshot_writer = SnapshotWriter(os.path.join(folder, "trespassers"))
+        pipeline = RecognitionPipeline(
+            video_source, gallery, os.path.join(folder, "trespassers"), lambda frame, names: results.append(len(names)),
+            frame_rate=frame_rate, workers=workers, worker_pool=worker_pool, display_fps=display_fps,
+            detector=detector, attendance_log=attendance_log, snapshot_writer=snapshot_writer, name=os.path.basename(clip),
+            motion_gate=MotionGate() if motion_gating else None,
+        )
+        pipeline.stats = {stage: RecordingStageStats(stage) for stage in pipeline.STAGES}
+        # Finer-grained timings (resize, color conversion, drawing, ...) from the metrics registry
+        METRICS.enable("benchmark")
+        with ResourceMonitor() as monitor:
+            pipeline.start()
+            time.sleep(duration)
+            pipeline.stop()
+        METRICS.disable("benchmark")
+        attendance_log.close()
+    metrics = {'fps': len(results) / monitor.wall, 'frames': len(results), 'faces_per_frame': float(np.mean(results)) if results else 0.0,
+               'dropped': pipeline.frames.dropped + pipeline.stale_results, **monitor.metrics}
+    metrics['stages'] = {stage: pipeline.stats[stage].summary(monitor.wall) for stage in ("capture", "detect", "encode", "match")}
+    metrics['substages'] = {
+        stage: {'count': count, 'mean_ms': 1000.0 * total / count}
+        for stage, (count, total) in METRICS.stream_totals(pipeline.name)['stages'].items() if count
+    }
+    metrics['capture'] = video_source.capture_stats()
+    metrics['duty_cycle_percent'] = 100.0 * pipeline.busy_seconds / monitor.wall
+    metrics['gated'] = pipeline.gated
+    print(f"{metrics['fps']:.2f} fps over {metrics['frames']} frames, {metrics['faces_per_frame']:.2f} faces/frame, "
+          f"{metrics['dropped']} dropped")
+    print(f"decoded {metrics['capture']['decoded']} of {metrics['capture']['grabbed']} grabbed frames, "
+          f"~{metrics['capture']['decode_saved_percent']:.1f}% CPU saved")
+    print(f"detector busy {metrics['duty_cycle_percent']:.1f}% of the time, {metrics['gated']} static frames skipped")
+    for stage, summary in metrics['stages'].items():
+        if summary['count']:
+            print(f"{stage:>8} {summary['fps']:>8.2f} fps  p50 {summary['p50_ms']:>8.2f}  p95 {summary['p95_ms']:>8.2f}  "
+                  f"p99 {summary['p99_ms']:>8.2f} ms")
+    return metrics
+
+
+def benchmark_distributed(clip, identities, duration, frame_rate, detector, processes, slots, local_workers, kill_after,
+                          shared_memory):
+    # The stream benchmark with detection and encoding in `server.py worker` processes on this
+    # host. kill_after terminates the first worker midway, to show its frames failing over.
+    worker_pool = DistributedWorkerPool("127.0.0.1", 0, local_workers=local_workers)
+    worker_pool.start()
+    server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    workers = [subprocess.Popen([sys.executable, server_script, "worker", f"127.0.0.1:{worker_pool.port}", "--slots", str(slots),
+                                 "--name", f"worker-{number}"] + ([] if shared_memory else ["--no-shared-memory"]))
+               for number in range(processes)]
+    deadline = time.monotonic() + 60
+    while len(worker_pool.worker_stats()['remote_workers']) < processes:
+        if time.monotonic() > deadline:
+            raise SystemExit("Recognition workers did not register within 60 s")
+        time.sleep(0.1)
+    killer = None
+    if kill_after is not None and workers:
+        killer = threading.Timer(kill_after, workers[0].terminate)
+        killer.start()
+    # Stats are taken while workers are still connected; a killed worker leaves the list on its next heartbeat
+    final_stats = []
+    try:
+        metrics = benchmark_stream(clip, identities, duration, frame_rate, None, detector, worker_pool=worker_pool)
+        final_stats = worker_pool.worker_stats()
+    finally:
+        if killer is not None:
+            killer.cancel()
+        worker_pool.stop()
+        for process in workers:
+            process.terminate()
+            process.wait()
+    metrics['workers'] = final_stats
+    for remote in final_stats['remote_workers']:
+        print(f"{remote['name']:>10} {remote['transport']:>13} {'alive' if remote['alive'] else 'lost':>5}  "
+              f"{remote['jobs']:>6} frames  {remote['mean_ms']:>8.2f} ms/frame  load {remote['load']:.2f}")
+    print(f"{final_stats['failovers']} calls failed over to the coordinator")
+    return metrics
+
+
+def timed_passes(run, passes=("cold", "warm")):
+    # The first pass encodes everything; the second only hits the embedding cache
+    metrics = {}
+    for label in passes:
+        with ResourceMonitor() as monitor:
+            extra = run() or {}
+        metrics[label] = {**monitor.metrics, **extra}
+        print(f"{label:>5} {monitor.wall:>8.2f} s  cpu {monitor.metrics['cpu_percent']:>6.0f}%  {extra}")
+    return metrics
+
+
+def benchmark_enroll(source, classes, per_class, workers):
+    # DatasetEncoder.encode_dataset is what encode_faces_in_dataset and update_face_data run
+    with tempfile.TemporaryDirectory() as folder:
+        root_folder = os.path.join(folder, "ImagesAttendance")
+        images = fixture_images(source, classes * per_class)
+        for class_index in range(classes):
+            write_image_folder(os.path.join(root_folder, f"class_{class_index}"), images[class_index * per_class:(class_index + 1) * per_class])
+        encoder = DatasetEncoder(os.path.join(folder, "embedding_cache.pkl"), workers=workers)
+
+        def run():
+            encoder.encoded_count = 0
+            class_templates = encoder.encode_dataset(root_folder)
+            return {'encoded': encoder.encoded_count,
+                    'enrolled': sum(templates is not None for templates in class_templates.values()),
+                    'templates': sum(len(templates) for templates in class_templates.values() if templates is not None)}
+
+        metrics = timed_passes(run)
+    metrics['cold']['images_per_s'] = classes * per_class / metrics['cold']['wall_s']
+    return metrics
+
+
+def benchmark_sort(source, images, identities):
+    encodings, names = synthetic_gallery(identities)
+    gallery = FaceGallery(encodings, names, index=IVFIndex(nprobe=8))
+    with tempfile.TemporaryDirectory() as folder:
+        write_image_folder(folder, fixture_images(source, images))
+
+        def run():
+            counts = sort_folder(gallery, folder)
+            for name in counts:
+                shutil.rmtree(os.path.join(folder, f"Sorted_{name}_Images"))
+            return {'sorted': sum(counts.values())}
+
+        metrics = timed_passes(run)
+    metrics['cold']['images_per_s'] = images / metrics['cold']['wall_s']
+    return metrics
+
+
+def benchmark_dedup(source, images):
+    with tempfile.TemporaryDirectory() as folder:
+        write_image_folder(folder, fixture_images(source, images), prefix="trespasser")
+        deduplicator = SnapshotDeduplicator(folder)
+        metrics = timed_passes(lambda: {key: value for key, value in deduplicator.run().items() if key != 'seconds'})
+    metrics['cold']['images_per_s'] = images / metrics['cold']['wall_s']
+    return metrics
+
+
+# Run in a fresh interpreter per pass, so module imports are part of the measurement
+STARTUP_SCRIPT = """
+import json, sys
+from PyQt5 import QtCore, QtWidgets
+import fAIce
+startup_timer = fAIce.StartupTimer()
+app = QtWidgets.QApplication([])
+window = fAIce.FaceRecognitionApp(startup_timer)
+# Instead of the error dialog, which nobody would close
+window.startup_failed = lambda message: (print(message, file=sys.stderr), app.exit(1))
+window.show()
+startup_timer.mark("window")
+window.start_loading()
+window.startup_worker.startup_finished.connect(app.quit, QtCore.Qt.QueuedConnection)
+if app.exec_():
+    sys.exit(1)
+print(json.dumps(dict(startup_timer.phases)))
+"""
+
+
+def benchmark_startup():
+    # App launch to window, loaded gallery, loaded face models and ready, first without a face
+    # database in the working directory (the dataset is encoded) and then with the one it left.
+    # Imported here, since the desktop app module pulls in PyQt5 and no other benchmark needs it
+    from fAIce import COLD_START_TARGET
+    metrics = {}
+    python_path = [os.path.dirname(os.path.abspath(__file__))] + [os.environ["PYTHONPATH"]] * ("PYTHONPATH" in os.environ)
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(python_path))
+    environment.setdefault("QT_QPA_PLATFORM", "offscreen")
+    with tempfile.TemporaryDirectory() as folder:
+        for label in ("cold", "warm"):
+            completed = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=folder, env=environment,
+                                       capture_output=True, text=True, timeout=600)
+            if completed.returncode != 0:
+                raise SystemExit(f"Startup run failed:\n{completed.stderr}")
+            phases = json.loads(completed.stdout.strip().splitlines()[-1])
+            metrics[label] = {f"{phase}_s": seconds for phase, seconds in phases.items()}
+            metrics[label]['within_target'] = phases.get("window", float("inf")) <= COLD_START_TARGET
+            print(f"{label:>5} " + "  ".join(f"{phase} {seconds:>6.2f} s" for phase, seconds in phases.items())
+                  + f"  ({'within' if metrics[label]['within_target'] else 'over'} the {COLD_START_TARGET:g} s window target)")
+    metrics['target_s'] = COLD_START_TARGET
+    return metrics
+
+
+def flatten(metrics, prefix=""):
+    flat = {}
+    for key, value in metrics.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare_with_baseline(report, baseline):
+    current, previous = flatten(report['metrics']), flatten(baseline['metrics'])
+    print(f"\nAgainst baseline from {baseline['timestamp']} ({baseline['command']}):")
+    print(f"{'metric':<40} {'baseline':>12} {'current':>12} {'change':>8}")
+    for key in sorted(current.keys() & previous.keys()):
+        change = f"{100.0 * (current[key] - previous[key]) / previous[key]:+.1f}%" if previous[key] else ""
+        print(f"{key:<40} {previous[key]:>12.3f} {current[key]:>12.3f} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fAIce performance benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = subparsers.add_parser("index", help="Approximate vs exact gallery search")
+    index_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    index_parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    index_parser.add_argument("--queries", type=int, default=500)
+    index_parser.add_argument("--batch-size", type=int, default=4, help="Faces matched per call, like one frame")
+
+    quantize_parser = subparsers.add_parser("quantize", help="Gallery memory and recall per storage precision")
+    quantize_parser.add_argument("--sizes", type=int, nargs="+", default=[100000])
+    quantize_parser.add_argument("--queries", type=int, default=500)
+    quantize_parser.add_argument("--batch-size", type=int, default=4, help="Faces matched per call, like one frame")
+    quantize_parser.add_argument("--rerank", type=int, default=32, help="Rows per face re-ranked at float32")
+    quantize_parser.add_argument("--noise", type=float, default=0.2, help="Query noise; higher puts more faces near a tie")
+
+    detect_parser = subparsers.add_parser("detect", help="Detector throughput vs recall on recorded clips")
+    detect_parser.add_argument("clips", nargs="+", help="Recorded video files")
+    detect_parser.add_argument("--settings", nargs="+", default=["hog:1:1", "hog:0.5:1", "hog:0.5:2", "hog:0.25:2", "cnn:0.5:1", "cnn:0.25:1"],
+                               help="model:scale:upsample detector settings to compare")
+    detect_parser.add_argument("--reference", default="cnn:1:1", help="Setting whose boxes count as ground truth")
+    detect_parser.add_argument("--every", type=int, default=15, help="Sample every Nth frame")
+    detect_parser.add_argument("--max-frames", type=int, default=200, help="Frames sampled per clip")
+    detect_parser.add_argument("--width", type=int, default=1344, help="Working frame width, 0 for native")
+
+    stream_parser = subparsers.add_parser("stream", help="Live-stream pipeline throughput and per-stage latency")
+    stream_parser.add_argument("clip", help="Recorded video file, paced and looped like a camera")
+    stream_parser.add_argument("--identities", type=int, default=1000, help="Synthetic gallery size")
+    stream_parser.add_argument("--duration", type=float, default=30, help="Seconds to run")
+    stream_parser.add_argument("--fps", type=float, default=30, help="Recognition FPS target")
+    stream_parser.add_argument("--workers", type=int, default=2)
+    stream_parser.add_argument("--detector", default="hog:0.5:1", help="model:scale:upsample")
+    stream_parser.add_argument("--display-fps", type=float, help="Also decode frames for a display at this rate")
+    stream_parser.add_argument("--keyframes-only", action="store_true", help="Only decode keyframes")
+    stream_parser.add_argument("--hardware-decoding", action="store_true", help="Use a hardware decoder when OpenCV has one")
+    stream_parser.add_argument("--motion-gating", action="store_true", help="Skip detection on static scenes")
+
+    distributed_parser = subparsers.add_parser("distributed", help="Stream throughput with recognition worker processes")
+    distributed_parser.add_argument("clip", help="Recorded video file, paced and looped like a camera")
+    distributed_parser.add_argument("--identities", type=int, default=1000, help="Synthetic gallery size")
+    distributed_parser.add_argument("--duration", type=float, default=30, help="Seconds to run")
+    distributed_parser.add_argument("--fps", type=float, default=30, help="Recognition FPS target")
+    distributed_parser.add_argument("--detector", default="hog:0.5:1", help="model:scale:upsample")
+    distributed_parser.add_argument("--processes", type=int, default=2, help="Worker processes on this host")
+    distributed_parser.add_argument("--slots", type=int, default=1, help="Frames each worker processes at once")
+    distributed_parser.add_argument("--local-workers", type=int, default=0, help="Worker threads in the coordinator too")
+    distributed_parser.add_argument("--kill-after", type=float, metavar="SECONDS", help="Terminate the first worker after this long")
+    distributed_parser.add_argument("--no-shared-memory", action="store_true", help="Send frames over TCP")
+
+    enroll_parser = subparsers.add_parser("enroll", help="Dataset encoding, cold and with a warm cache")
+    enroll_parser.add_argument("--source", help="Video file or image folder to draw images from; random images if omitted")
+    enroll_parser.add_argument("--classes", type=int, default=20)
+    enroll_parser.add_argument("--per-class", type=int, default=10)
+    enroll_parser.add_argument("--workers", type=int, help="Encoder processes")
+
+    sort_parser = subparsers.add_parser("sort", help="Sorting a photo folder, cold and with a warm cache")
+    sort_parser.add_argument("--source", help="Video file or image folder to draw images from; random images if omitted")
+    sort_parser.add_argument("--images", type=int, default=200)
+    sort_parser.add_argument("--identities", type=int, default=1000, help="Synthetic gallery size")
+
+    dedup_parser = subparsers.add_parser("dedup", help="Trespasser deduplication, cold and with a warm cache")
+    dedup_parser.add_argument("--source", help="Video file or image folder to draw images from; random images if omitted")
+    dedup_parser.add_argument("--images", type=int, default=200)
+
+    subparsers.add_parser("startup", help="App launch until the window is shown and until it is ready")
+
+    for command_parser in subparsers.choices.values():
+        command_parser.add_argument("--output", help="Save the results to this JSON file")
+        command_parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+
+    args = parser.parse_args()
+    if args.command == "index":
+        metrics = benchmark_index(args.sizes, args.nprobe, args.queries, args.batch_size)
+    elif args.command == "quantize":
+        metrics = benchmark_quantize(args.sizes, args.queries, args.batch_size, args.rerank, args.noise)
+    elif args.command == "detect":
+        metrics = benchmark_detect(args.clips, args.settings, args.reference, args.every, args.max_frames, args.width)
+    elif args.command == "stream":
+        metrics = benchmark_stream(args.clip, args.identities, args.duration, args.fps, args.workers, FaceDetector.parse(args.detector),
+                                   args.display_fps, {'keyframes_only': args.keyframes_only,
+                                                      'hardware_acceleration': args.hardware_decoding}, args.motion_gating)
+    elif args.command == "distributed":
+        metrics = benchmark_distributed(args.clip, args.identities, args.duration, args.fps, FaceDetector.parse(args.detector),
+                                        args.processes, args.slots, args.local_workers, args.kill_after, not args.no_shared_memory)
+    elif args.command == "enroll":
+        metrics = benchmark_enroll(args.source, args.classes, args.per_class, args.workers)
+    elif args.command == "sort":
+        metrics = benchmark_sort(args.source, args.images, args.identities)
+    elif args.command == "dedup":
+        metrics = benchmark_dedup(args.source, args.images)
+    elif args.command == "startup":
+        metrics = benchmark_startup()
+
+    report = {
+        'command': args.command,
+        'timestamp': datetime.datetime.now().isoformat(timespec="seconds"),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'args': {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        'metrics': metrics,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results saved to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare_with_baseline(report, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,68 @@
+import time
+# Reference point for the startup report, taken before the imports below
+STARTUP_STARTED = time.perf_counter()
 import os
 import cv2
-import shutil
-import pickle
 import concurrent.futures
-import csv
-import sys
-import threading
-import time
-from PIL import Image, ImageTk
-import face_recognition
+import sqlite3
+import numpy as np
 from PyQt5 import QtWidgets, QtGui, QtCore
 from PyQt5.QtGui import * 
 from PyQt5.QtWidgets import * 
-from threading import Thread, Timer
+from threading import Timer
+
+from faice_core import (METRICS, FaceDetector, MotionGate, RecognitionPipeline, RecognitionService, RecognitionWorkerPool,
+                        VideoSource, face_recognition, sort_folder)
+
+# Seconds from launch until the main window is shown, reported by StartupTimer
+COLD_START_TARGET = 1.5
+# Seconds after startup before the first trespasser deduplication pass
+DEDUP_STARTUP_DELAY = 60
+
+
+class StartupTimer:
+    # Seconds from STARTUP_STARTED (module import) to each named startup phase
+    def __init__(self, started=STARTUP_STARTED):
+        self.started = started
+        self.phases = []
+
+    def mark(self, phase):
+        elapsed = time.perf_counter() - self.started
+        self.phases.append((phase, elapsed))
+        METRICS.record_stage("startup", phase, elapsed)
+        return elapsed
+
+    def elapsed(self, phase):
+        return next((seconds for name, seconds in self.phases if name == phase), None)
+
+    def report(self):
+        parts = [f"{phase} {seconds:.2f} s" for phase, seconds in self.phases]
+        window = self.elapsed("window")
+        if window is not None:
+            parts.append(f"window {'within' if window <= COLD_START_TARGET else 'over'} the {COLD_START_TARGET:g} s target")
+        return "Startup: " + ", ".join(parts)
 
 
 class FaceRecognitionApp(QtWidgets.QMainWindow):
-    def __init__(self):
+    # The window is built without touching the gallery or the face models; start_loading() loads
+    # both in a StartupWorker once it is shown, and the buttons that need them stay disabled
+    # until then.
+    def __init__(self, startup_timer=None):
         super().__init__()
         self.setWindowTitle("Face Recognition App")
         self.setGeometry(100, 100, 1000, 800) 
         
         self.BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-        self.root_folder = os.path.join(self.BASE_DIR, "ImagesAttendance")
-        self.trespassers_folder = os.path.join(self.BASE_DIR, "trespassers")
-        self.all_face_encodings = []
-        self.all_face_names = []
-        self.face_data_file = "face_data.pkl"
+        self.startup_timer = startup_timer or StartupTimer()
+        # Gallery, face database, attendance log and snapshot writer, shared with the headless server
+        self.service = RecognitionService(self.BASE_DIR, load=False)
+        self.root_folder = self.service.root_folder
+        self.trespassers_folder = self.service.trespassers_folder
+        self.gallery = self.service.gallery
+        self.attendance_log = self.service.attendance_log
+        self.snapshot_writer = self.service.snapshot_writer
         self.light_mode = True
-        self.load_face_data()
+        self.stream_manager = StreamManager(self.gallery, self.attendance_log, self.snapshot_writer)
 
         self.central_widget = QtWidgets.QWidget()
         self.setCentralWidget(self.central_widget)
@@ -60,9 +94,16 @@ class FaceRecognitionApp(QtWidgets.QMainWindow):
         self.layout.addLayout(self.button_layout)
         self.layout.addWidget(self.mode_toggle_button, alignment=QtCore.Qt.AlignRight) 
 
-        self.scheduler_thread = Thread(target=self.run_scheduler)
-        self.scheduler_thread.daemon = True
-        self.scheduler_thread.start()
+        # Enabled once the gallery and models are loaded
+        for button in (self.add_class_button, self.start_stream_button, self.sort_images_button):
+            button.setEnabled(False)
+        self.startup_label = QtWidgets.QLabel("Starting")
+        self.startup_progress = QtWidgets.QProgressBar()
+        self.startup_progress.setMaximumWidth(200)
+        self.startup_progress.setRange(0, 0)
+        self.statusBar().addWidget(self.startup_label)
+        self.statusBar().addPermanentWidget(self.startup_progress)
+        self.startup_worker = None
 
         self.set_mode()
         self.light_mode_stylesheet = """
@@ -82,18 +123,60 @@ class FaceRecognitionApp(QtWidgets.QMainWindow):
         self.setup_menu_bar()
 
         # Initialize student dashboard widget
-        self.student_dashboard = StudentDashboard()
+        self.student_dashboard = StudentDashboard(self.gallery, self.attendance_log)
         self.layout.addWidget(self.student_dashboard)
         self.student_dashboard.hide()  # Hide by default
+
+        # Per-camera FPS, queue depth and dropped frames, in its own window
+        self.stream_stats_view = StreamStatsView(self.stream_manager)
         
     def resizeEvent(self, event):
         self.background_label.setGeometry(0, 0, self.width(), self.height())
         event.accept()
 
+    def start_loading(self):
+        self.startup_worker = worker = StartupWorker(self.service, self.startup_timer)
+        worker.progress.connect(self.show_startup_progress)
+        worker.startup_finished.connect(self.startup_finished)
+        worker.startup_failed.connect(self.startup_failed)
+        worker.start()
+
+    def show_startup_progress(self, message, done, total):
+        self.startup_label.setText(f"{message}...")
+        # A zero range shows a busy indicator when the amount of work is unknown
+        self.startup_progress.setRange(0, total)
+        self.startup_progress.setValue(done)
+
+    def startup_finished(self):
+        for button in (self.add_class_button, self.start_stream_button, self.sort_images_button):
+            button.setEnabled(True)
+        self.analyze_action.setEnabled(True)
+        self.statusBar().removeWidget(self.startup_label)
+        self.statusBar().removeWidget(self.startup_progress)
+        self.startup_timer.mark("ready")
+        print(self.startup_timer.report())
+        self.statusBar().showMessage(f"Ready: {len(self.gallery)} enrolled users", 5000)
+        # The first deduplication pass encodes every snapshot, so it waits until startup is long over
+        self.scheduler_timer = Timer(DEDUP_STARTUP_DELAY, self.run_scheduler)
+        self.scheduler_timer.daemon = True
+        self.scheduler_timer.start()
+
+    def startup_failed(self, message):
+        self.startup_label.setText("Startup failed")
+        self.startup_progress.hide()
+        QtWidgets.QMessageBox.critical(self, "Startup Failed", f"Could not load the enrolled users:\n{message}")
+
     def setup_menu_bar(self):
         menu_bar = self.menuBar()
         kebab_menu = QtWidgets.QMenu()
         kebab_menu.addAction(f"Student Dashboard", self.toggle_student_dashboard)
+        kebab_menu.addAction("Stream Stats", self.toggle_stream_stats)
+        self.analyze_action = kebab_menu.addAction("Analyze Recorded Videos", self.analyze_recorded_videos)
+        # Enabled with the buttons once startup finishes
+        self.analyze_action.setEnabled(False)
+        metrics_log_action = kebab_menu.addAction("Log Performance Metrics")
+        metrics_log_action.setCheckable(True)
+        metrics_log_action.toggled.connect(lambda checked: METRICS.start_log() if checked else METRICS.stop_log())
         kebab_button = QtWidgets.QToolButton()
         kebab_button.setMenu(kebab_menu)
         kebab_button.setIcon(QtGui.QIcon('kebab_menu.png'))
@@ -166,142 +249,6 @@ class FaceRecognitionApp(QtWidgets.QMainWindow):
             self.sort_images_button.setStyleSheet("QToolButton { border-radius: 50px; background-color: #555; }"
                                                   "QToolButton:hover { background-color: #777; }")
 
-    def update_face_data(self, class_name=None):
-        existing_face_encodings, existing_face_names, flag = self.load_face_data()
-
-        if flag == 0:
-            # Encode faces from the updated dataset
-            new_face_encodings = []
-            new_face_names = []
-
-            if class_name:
-                # Use the encoding function for a specific class
-                average_face_encoding, class_name = self.encode_faces_in_class(os.path.join(self.root_folder, class_name))
-                if average_face_encoding is not None:
-                    new_face_encodings.append(average_face_encoding)
-                    new_face_names.append(class_name)
-            else:
-                # Iterate through each folder in the root folder
-                for class_name in os.listdir(self.root_folder):
-                    class_folder = os.path.join(self.root_folder, class_name)
-
-                    if os.path.isdir(class_folder):
-                        # Check if the class is already present in the existing data
-                        if class_name not in existing_face_names:
-                            # Use the encoding function for a specific class
-                            average_face_encoding, class_name = self.encode_faces_in_class(class_folder)
-                            if average_face_encoding is not None:
-                                new_face_encodings.append(average_face_encoding)
-                                new_face_names.append(class_name)
-
-            # Combine existing and new face data
-            existing_face_encodings = existing_face_encodings + new_face_encodings
-            existing_face_names = existing_face_names + new_face_names
-
-        # Save the combined face data to the file using the existing save_face_data() function
-        self.save_face_data(existing_face_encodings, existing_face_names)
-
-        # Update class variables
-        self.all_face_encodings = existing_face_encodings
-        self.all_face_names = existing_face_names
-
-    def load_face_data(self):
-        # Check if the face data file exists
-        if os.path.exists(self.face_data_file):
-            # Load existing face data
-            with open(self.face_data_file, 'rb') as file:
-                face_data = pickle.load(file)
-                existing_face_encodings = face_data.get('encodings', [])
-                existing_face_names = face_data.get('names', [])
-                flag = 0
-        else:
-            # Encode faces from the entire dataset
-            existing_face_encodings, existing_face_names = self.encode_faces_in_dataset(self.root_folder)
-            # Save the encoded data to the file using the existing save_face_data() function
-            self.save_face_data(existing_face_encodings, existing_face_names)
-            flag = 1
-        self.all_face_encodings = existing_face_encodings
-        self.all_face_names = existing_face_names
-        return existing_face_encodings, existing_face_names, flag
-    
-    def save_face_data(self, encodings, names):
-        face_data = {'encodings': encodings, 'names': names}
-        with open(self.face_data_file, 'wb') as file:
-            pickle.dump(face_data, file)
-        print("Encodings Saved.")
-
-    def encode_faces_in_class(self, class_folder):
-        # Initialize face encodings and face names for the current class
-        class_face_encodings = []
-        class_face_names = []
-
-        # Iterate through each image in the class folder
-        for filename in os.listdir(class_folder):
-            image_path = os.path.join(class_folder, filename)
-
-            # Load the image
-            image = face_recognition.load_image_file(image_path)
-
-            # Find face encodings
-            face_encodings = face_recognition.face_encodings(image)
-
-            for face_encoding in face_encodings:
-                # Use all face encodings (not just the first one)
-                class_face_encodings.append(face_encoding)
-                class_face_names.append(os.path.basename(class_folder))
-
-        # Calculate the average face encoding for the class
-        if class_face_encodings:
-            average_face_encoding = [
-                sum(emb[i] for emb in class_face_encodings) / len(class_face_encodings)
-                for i in range(len(class_face_encodings[0]))
-            ]
-            return average_face_encoding, os.path.basename(class_folder)
-        else:
-            print("Class encoding failed")
-            return None, None
-
-    def encode_faces_in_dataset(self, root_folder):
-        all_face_encodings = []
-        all_face_names = []
-
-        # Iterate through each folder in the root folder
-        for class_name in os.listdir(root_folder):
-            class_folder = os.path.join(root_folder, class_name)
-
-            if os.path.isdir(class_folder):
-                # Initialize face encodings and face names for the current class
-                class_face_encodings = []
-                class_face_names = []
-
-                # Iterate through each image in the class folder
-                for filename in os.listdir(class_folder):
-                    image_path = os.path.join(class_folder, filename)
-
-                    # Load the image
-                    image = face_recognition.load_image_file(image_path)
-
-                    # Find face encodings
-                    face_encodings = face_recognition.face_encodings(image)
-
-                    for face_encoding in face_encodings:
-                        # Use all face encodings (not just the first one)
-                        class_face_encodings.append(face_encoding)
-                        class_face_names.append(class_name)
-
-                # Calculate the average face encoding for the class
-                if class_face_encodings:
-                    average_face_encoding = [
-                        sum(emb[i] for emb in class_face_encodings) / len(class_face_encodings)
-                        for i in range(len(class_face_encodings[0]))
-                    ]
-
-                    # Add the average face encoding and name for the current class to the overall list
-                    all_face_encodings.append(average_face_encoding)
-                    all_face_names.append(class_name)
-
-        return all_face_encodings, all_face_names
-
     def show_sort_images_window(self):
         sort_images_window = QtWidgets.QDialog(self)
         sort_images_window.setWindowTitle("Sort Images")
@@ -313,11 +260,16 @@ class FaceRecognitionApp(QtWidgets.QMainWindow):
         folder_button.clicked.connect(self.get_folder_path)
         self.folder_entry = QtWidgets.QLineEdit()
 
-        class_label = QtWidgets.QLabel("Enter Class Name:")
+        class_label = QtWidgets.QLabel("Enter Class Name (leave empty for all classes):")
         self.class_entry = QtWidgets.QLineEdit()
 
-        submit_button = QtWidgets.QPushButton("Submit")
-        submit_button.clicked.connect(lambda: self.sort_images(self.folder_entry.text(), self.class_entry.text(), sort_images_window))
+        sort_images_window.progress_bar = QtWidgets.QProgressBar()
+        sort_images_window.progress_bar.setValue(0)
+
+        sort_images_window.submit_button = submit_button = QtWidgets.QPushButton("Submit")
+        submit_button.clicked.connect(lambda: self.sort_images(self.folder_entry.text(), self.class_entry.text().strip(), sort_images_window))
+        sort_images_window.cancel_button = cancel_button = QtWidgets.QPushButton("Cancel")
+        cancel_button.setEnabled(False)
 
         layout = QtWidgets.QVBoxLayout()
         layout.addWidget(folder_label)
@@ -325,7 +277,9 @@ class FaceRecognitionApp(QtWidgets.QMainWindow):
         layout.addWidget(folder_button)
         layout.addWidget(class_label)
         layout.addWidget(self.class_entry)
+        layout.addWidget(sort_images_window.progress_bar)
         layout.addWidget(submit_button)
+        layout.addWidget(cancel_button)
         sort_images_window.setLayout(layout)
         sort_images_window.exec_()
 
@@ -335,52 +289,42 @@ class FaceRecognitionApp(QtWidgets.QMainWindow):
 
     def run_scheduler(self):
         self.delete_similar_faces_wrapper()
-        timer = Timer(600, self.run_scheduler)
-        timer.start()
+        self.scheduler_timer = Timer(600, self.run_scheduler)
+        self.scheduler_timer.daemon = True
+        self.scheduler_timer.start()
 
     def delete_similar_faces_wrapper(self):
-        self.delete_similar_faces(self.trespassers_folder)
-
-    def delete_similar_faces(self, folder_path, tolerance=0.6):
-        if not os.path.exists(folder_path):
-            return
-        face_encodings = []
-        file_paths = []
-        #print("Started")
-        for filename in os.listdir(folder_path):
-            file_path = os.path.join(folder_path, filename)
-            image = face_recognition.load_image_file(file_path)
-            face_encoding = face_recognition.face_encodings(image)
-            if len(face_encoding) > 0:
-                face_encodings.append(face_encoding[0])
-                file_paths.append(file_path)
-        #print("model work done")
-        for i in range(len(face_encodings)):
-            for j in range(i + 1, len(face_encodings)):
-                if face_recognition.compare_faces([face_encodings[i]], face_encodings[j], tolerance=tolerance)[0]:
-                    print(f"Deleting similar faces: {file_paths[i]} and {file_paths[j]}")
-                    if os.path.exists(file_paths[j]):
-                        os.remove(file_paths[j])
-                    else:
-                        print(f"File not found: {file_paths[j]}")
-        #print("Deletion successful")
+        self.service.delete_similar_faces(self.trespassers_folder)
 
     def sort_images(self, folder_path, class_name, sort_images_window):
-        class_index = self.all_face_names.index(class_name)
-        class_face_encoding = self.all_face_encodings[class_index]
-        output_folder_path = os.path.join(folder_path, f"Sorted_{class_name}_Images")
-        os.makedirs(output_folder_path, exist_ok=True)
-        for filename in os.listdir(folder_path):
-            if filename.endswith(('.jpg', '.jpeg', '.png')):
-                image_path = os.path.join(folder_path, filename)
-                image = face_recognition.load_image_file(image_path)
-                face_locations = face_recognition.face_locations(image)
-                face_encodings = face_recognition.face_encodings(image, face_locations)
-                for face_encoding in face_encodings:
-                    match = face_recognition.compare_faces([class_face_encoding], face_encoding, tolerance=0.5)
-                    if match[0]:
-                        shutil.copy(image_path, os.path.join(output_folder_path, filename))
-        QtWidgets.QMessageBox.information(self, "Sorting Complete", f"Images for class {class_name} have been sorted.")
+        class_names = [class_name] if class_name else None
+        if class_name and class_name not in self.gallery.rows:
+            QtWidgets.QMessageBox.warning(self, "Unknown Class", f"No enrolled user named {class_name}.")
+            return
+        if not os.path.isdir(folder_path):
+            QtWidgets.QMessageBox.warning(self, "Invalid Folder", f"{folder_path} is not a folder.")
+            return
+        sort_images_window.submit_button.setEnabled(False)
+        sort_images_window.cancel_button.setEnabled(True)
+        # Held on the app so the thread outlives this call and the dialog
+        self.sort_images_worker = worker = SortImagesWorker(self.gallery, folder_path, class_names)
+        worker.progress.connect(lambda done, total: (sort_images_window.progress_bar.setMaximum(max(total, 1)),
+                                                     sort_images_window.progress_bar.setValue(done)))
+        worker.sorting_finished.connect(lambda counts, cancelled: self.sort_images_finished(counts, cancelled, class_name, sort_images_window))
+        worker.sorting_failed.connect(lambda message: (QtWidgets.QMessageBox.warning(self, "Sorting Failed", message),
+                                                       sort_images_window.close()))
+        sort_images_window.cancel_button.clicked.connect(worker.cancel)
+        sort_images_window.finished.connect(worker.cancel)
+        worker.start()
+
+    def sort_images_finished(self, counts, cancelled, class_name, sort_images_window):
+        summary = "\n".join(f"{name}: {count}" for name, count in sorted(counts.items())) or "No known faces found."
+        if cancelled:
+            QtWidgets.QMessageBox.information(self, "Sorting Cancelled", f"Sorting was cancelled; run it again to resume.\n{summary}")
+        elif class_name:
+            QtWidgets.QMessageBox.information(self, "Sorting Complete", f"Images for class {class_name} have been sorted.\n{summary}")
+        else:
+            QtWidgets.QMessageBox.information(self, "Sorting Complete", f"Images have been sorted.\n{summary}")
         sort_images_window.close()
 
     def show_add_class_window(self):
@@ -392,54 +336,227 @@ class FaceRecognitionApp(QtWidgets.QMainWindow):
         layout = QtWidgets.QVBoxLayout()
         label = QtWidgets.QLabel("Enter the User name:")
         entry = QtWidgets.QLineEdit()
+        replace_checkbox = QtWidgets.QCheckBox("Replace existing images")
         add_button = QtWidgets.QPushButton("Add Class")
-        add_button.clicked.connect(lambda: self.add_new_class(entry.text(), add_class_window))
+        add_button.clicked.connect(lambda: self.add_new_class(entry.text().strip(), add_class_window, replace_checkbox.isChecked()))
         layout.addWidget(label)
         layout.addWidget(entry)
+        layout.addWidget(replace_checkbox)
         layout.addWidget(add_button)
         add_class_window.setLayout(layout)
         add_class_window.exec_()
 
-    def add_new_class(self, class_name, add_class_window):
-        folder_path = os.path.join(self.root_folder, class_name)
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
-        video_capture = cv2.VideoCapture(0)
-        count = 0
-        while True:
-            ret, frame = video_capture.read()
-            cv2.imshow('Capture Frame', frame)
-            key = cv2.waitKey(1)
-            if key == ord('c'):
-                image_path = os.path.join(folder_path, f"{class_name}_{count}.jpg")
-                cv2.imwrite(image_path, frame)
-                print(f"Image {count} captured for class {class_name}")
-                count += 1
-            elif key == ord('q'):
-                break
-        video_capture.release()
-        cv2.destroyAllWindows()
-        self.update_face_data(class_name)
+    def add_new_class(self, class_name, add_class_window, replace=False):
+        if not class_name or os.path.basename(class_name) != class_name:
+            QtWidgets.QMessageBox.warning(self, "Invalid Name", "Enter a user name without path separators.")
+            return
         add_class_window.close()
+        # Captures are encoded as they are taken and only this identity is updated
+        EnrollmentWindow(self.service, class_name, replace, parent=self).exec_()
 
     def start_live_stream_window(self):
         dialog = StartLiveStreamDialog()
         if dialog.exec_():
             input_type = dialog.get_input_type()
+            frame_rate = dialog.get_frame_rate()
+            detector = dialog.get_detector()
+            capture_options = dialog.get_capture_options()
+            motion_gating = dialog.get_motion_gating()
             if input_type == "RTSP":
                 url = dialog.get_rtsp_url()
-                self.start_live_stream_rtsp(url)
+                self.start_live_stream_rtsp(url, frame_rate, detector, capture_options, motion_gating)
             elif input_type == "Webcam":
                 port = dialog.get_webcam_port()
-                self.start_live_stream_webcam(port)
+                self.start_live_stream_webcam(port, frame_rate, detector, capture_options, motion_gating)
+            elif input_type == "Video File":
+                self.stream_manager.add_stream(dialog.get_video_path(), frame_rate, detector, capture_options, motion_gating)
 
-    def start_live_stream_rtsp(self, url):
-        live_stream_window = LiveStreamApp(self.all_face_encodings, self.all_face_names, rtsp_url=url)
-        live_stream_window.start_live_stream_rtsp(url)
+    def start_live_stream_rtsp(self, url, frame_rate=2, detector=None, capture_options=None, motion_gating=True):
+        self.stream_manager.add_stream(url, frame_rate, detector, capture_options, motion_gating)
 
-    def start_live_stream_webcam(self, port):
-        live_stream_window = LiveStreamApp(self.all_face_encodings, self.all_face_names, webcam_port=port)
-        live_stream_window.start_live_stream_webcam(port)
+    def start_live_stream_webcam(self, port, frame_rate=2, detector=None, capture_options=None, motion_gating=True):
+        self.stream_manager.add_stream(port, frame_rate, detector, capture_options, motion_gating)
+
+    def analyze_recorded_videos(self):
+        paths, _ = QFileDialog.getOpenFileNames(self, "Select Recorded Videos", "", "Video Files (*.mp4 *.avi *.mkv *.mov)")
+        if not paths:
+            return
+        progress_dialog = QtWidgets.QProgressDialog("Analyzing recorded videos...", "Cancel", 0, 0, self)
+        progress_dialog.setWindowTitle("Analyze Recorded Videos")
+        progress_dialog.setMinimumDuration(0)
+        # Held on the app so the thread outlives this call and the dialog
+        self.analyze_videos_worker = worker = AnalyzeVideosWorker(self.service, paths)
+        worker.progress.connect(lambda done, total: (progress_dialog.setMaximum(max(total, 1)), progress_dialog.setValue(done)))
+        worker.analysis_finished.connect(lambda summaries, cancelled: self.analyze_videos_finished(summaries, cancelled, progress_dialog))
+        worker.analysis_failed.connect(lambda message: (progress_dialog.reset(),
+                                                        QtWidgets.QMessageBox.warning(self, "Analysis Failed", message)))
+        progress_dialog.canceled.connect(worker.cancel)
+        worker.start()
+
+    def analyze_videos_finished(self, summaries, cancelled, progress_dialog):
+        progress_dialog.reset()
+        summary = "\n".join(
+            f"{os.path.basename(path)}: {values['attendance']} attendance records, {values['snapshots']} trespasser snapshots"
+            for path, values in summaries.items()
+        )
+        title = "Analysis Cancelled" if cancelled else "Analysis Complete"
+        QtWidgets.QMessageBox.information(self, title, summary)
+
+    def toggle_stream_stats(self):
+        self.stream_stats_view.setVisible(not self.stream_stats_view.isVisible())
+
+
+class SortImagesWorker(QtCore.QThread):
+    # Runs sort_folder off the GUI thread, reporting progress through signals
+    CACHE_FILE = ".faice_embeddings.pkl"
+    progress = QtCore.pyqtSignal(int, int)
+    sorting_finished = QtCore.pyqtSignal(dict, bool)
+    sorting_failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, gallery, folder_path, class_names=None, tolerance=None, batch_size=4096):
+        super().__init__()
+        self.gallery = gallery
+        self.folder_path = folder_path
+        self.class_names = set(class_names) if class_names else None
+        self.tolerance = tolerance
+        self.batch_size = batch_size
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            counts = sort_folder(self.gallery, self.folder_path, self.class_names, self.tolerance, self.batch_size,
+                                 progress=self.progress.emit, cancelled=lambda: self.cancelled, cache_file=self.CACHE_FILE)
+        except Exception as error:
+            # An unreadable folder or cache, or an image the decoder chokes on
+            self.sorting_failed.emit(str(error))
+            return
+        self.sorting_finished.emit(counts, self.cancelled)
+
+
+class AnalyzeVideosWorker(QtCore.QThread):
+    # Runs RecognitionService.analyze_videos off the GUI thread, reporting progress in segments
+    progress = QtCore.pyqtSignal(int, int)
+    analysis_finished = QtCore.pyqtSignal(dict, bool)
+    analysis_failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, service, paths, **options):
+        super().__init__()
+        self.service = service
+        self.paths = paths
+        self.options = options
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            summaries = self.service.analyze_videos(self.paths, progress=self.progress.emit, cancelled=lambda: self.cancelled, **self.options)
+        except Exception as error:
+            # Unreadable videos, but also I/O errors and a broken segment process pool
+            self.analysis_failed.emit(f"{type(error).__name__}: {error}")
+            return
+        self.analysis_finished.emit(summaries, self.cancelled)
+
+
+class StartupWorker(QtCore.QThread):
+    # Loads the gallery and the face models after the window is shown. The face database is
+    # memory-mapped and quick to read; encoding the whole dataset only happens on a first run.
+    progress = QtCore.pyqtSignal(str, int, int)
+    startup_finished = QtCore.pyqtSignal()
+    startup_failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, service, startup_timer):
+        super().__init__()
+        self.service = service
+        self.startup_timer = startup_timer
+
+    def run(self):
+        try:
+            self.progress.emit("Loading enrolled users", 0, 0)
+            self.service.load_face_data(progress=lambda done, total: self.progress.emit("Encoding enrolled users", done, total))
+            self.startup_timer.mark("gallery")
+            self.progress.emit("Loading face models", 0, 0)
+            face_recognition.load()
+            self.startup_timer.mark("models")
+        except Exception as error:
+            # A corrupt cache or database, or dlib failing to load: anything but silence, which
+            # would leave the window loading forever
+            self.startup_failed.emit(f"{type(error).__name__}: {error}")
+            return
+        self.startup_finished.emit()
+
+
+class StreamManager:
+    # Owns every open LiveStreamApp and the single recognition worker pool they all share.
+    # Sources are webcam ports (int), RTSP URLs or video file paths.
+    def __init__(self, gallery, attendance_log=None, snapshot_writer=None, workers=None):
+        self.gallery = gallery
+        self.attendance_log = attendance_log
+        self.snapshot_writer = snapshot_writer
+        self.worker_pool = RecognitionWorkerPool(workers or max(1, (os.cpu_count() or 2) // 2))
+        self.worker_pool.start()
+        self.live_streams = []
+
+    def add_stream(self, source, frame_rate=2, detector=None, capture_options=None, motion_gating=True):
+        live_stream = LiveStreamApp(self.gallery, worker_pool=self.worker_pool, frame_rate=frame_rate, detector=detector,
+                                    attendance_log=self.attendance_log, snapshot_writer=self.snapshot_writer, name=str(source),
+                                    capture_options=capture_options, motion_gating=motion_gating)
+        if isinstance(source, int):
+            live_stream.start_live_stream_webcam(source)
+        elif os.path.isfile(source):
+            live_stream.start_live_stream_file(source)
+        else:
+            live_stream.start_live_stream_rtsp(source)
+        # Streams are not kept alive by a thread of their own, so hold them until their window closes
+        self.live_streams.append(live_stream)
+        live_stream.live_stream_window.destroyed.connect(lambda: self.remove_stream(live_stream))
+        return live_stream
+
+    def remove_stream(self, live_stream):
+        if live_stream in self.live_streams:
+            self.live_streams.remove(live_stream)
+
+    def stream_stats(self):
+        return [live_stream.pipeline.stream_stats() for live_stream in self.live_streams if live_stream.pipeline is not None]
+
+    def stop_all(self):
+        for live_stream in list(self.live_streams):
+            live_stream.stop_live_stream()
+        self.worker_pool.stop()
+
+
+class StreamStatsView(QtWidgets.QWidget):
+    def __init__(self, stream_manager):
+        super().__init__()
+        self.stream_manager = stream_manager
+        self.setWindowTitle("Stream Stats")
+        self.setWindowIcon(QtGui.QIcon("live.png"))
+        self.layout = QtWidgets.QVBoxLayout(self)
+        self.table = QtWidgets.QTableWidget()
+        self.table.setColumnCount(8)
+        self.table.setHorizontalHeaderLabels(["Camera", "Target FPS", "Achieved FPS", "Queue Depth", "Dropped Frames",
+                                              "Decode CPU Saved", "Reconnects", "Detector Duty"])
+        self.table.horizontalHeader().setSectionResizeMode(QtWidgets.QHeaderView.Stretch)
+        self.layout.addWidget(self.table)
+        self.refresh_timer = QtCore.QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.refresh_timer.start(1000)
+
+    def refresh(self):
+        if not self.isVisible():
+            return
+        rows = self.stream_manager.stream_stats()
+        self.table.setRowCount(len(rows))
+        for row, stats in enumerate(rows):
+            values = [stats['name'], f"{stats['target_fps']:g}", f"{stats['fps']:.1f}", stats['queue_depth'], stats['dropped'],
+                      f"~{stats['decode_saved_percent']:.0f}% ({stats['skipped']} frames)", stats['reconnects'],
+                      f"{stats['duty_cycle_percent']:.0f}% ({stats['gated']} static frames)"]
+            for col, value in enumerate(values):
+                self.table.setItem(row, col, QtWidgets.QTableWidgetItem(str(value)))
 
 
 class StartLiveStreamDialog(QtWidgets.QDialog):
@@ -453,7 +570,7 @@ class StartLiveStreamDialog(QtWidgets.QDialog):
 
         self.input_type_label = QtWidgets.QLabel("Select Input Type:")
         self.input_type_combo = QtWidgets.QComboBox()
-        self.input_type_combo.addItems(["RTSP", "Webcam"])
+        self.input_type_combo.addItems(["RTSP", "Webcam", "Video File"])
 
         self.rtsp_url_label = QtWidgets.QLabel("RTSP URL:")
         self.rtsp_url_entry = QtWidgets.QLineEdit()
@@ -463,6 +580,38 @@ class StartLiveStreamDialog(QtWidgets.QDialog):
         self.webcam_port_spinbox.setMinimum(0)
         self.webcam_port_spinbox.setMaximum(1)
 
+        self.video_path_label = QtWidgets.QLabel("Video File:")
+        self.video_path_entry = QtWidgets.QLineEdit()
+        self.video_path_button = QtWidgets.QPushButton("Browse")
+        self.video_path_button.clicked.connect(self.get_video_file)
+
+        self.frame_rate_label = QtWidgets.QLabel("Recognition FPS Target:")
+        self.frame_rate_spinbox = QtWidgets.QDoubleSpinBox()
+        self.frame_rate_spinbox.setRange(0.1, 30.0)
+        self.frame_rate_spinbox.setValue(2.0)
+
+        default_detector = FaceDetector()
+        self.detector_model_label = QtWidgets.QLabel("Detector Model:")
+        self.detector_model_combo = QtWidgets.QComboBox()
+        self.detector_model_combo.addItems(FaceDetector.MODELS)
+        self.detector_model_combo.setCurrentText(default_detector.model)
+        self.detector_scale_label = QtWidgets.QLabel("Detection Scale:")
+        self.detector_scale_spinbox = QtWidgets.QDoubleSpinBox()
+        self.detector_scale_spinbox.setRange(0.1, 1.0)
+        self.detector_scale_spinbox.setSingleStep(0.05)
+        self.detector_scale_spinbox.setValue(default_detector.scale)
+        self.detector_upsample_label = QtWidgets.QLabel("Upsample Count:")
+        self.detector_upsample_spinbox = QtWidgets.QSpinBox()
+        self.detector_upsample_spinbox.setRange(0, 3)
+        self.detector_upsample_spinbox.setValue(default_detector.upsample)
+
+        self.tcp_checkbox = QtWidgets.QCheckBox("RTSP over TCP")
+        self.tcp_checkbox.setChecked(True)
+        self.keyframes_checkbox = QtWidgets.QCheckBox("Decode keyframes only")
+        self.hardware_checkbox = QtWidgets.QCheckBox("Hardware decoding")
+        self.motion_checkbox = QtWidgets.QCheckBox("Skip detection on static scenes")
+        self.motion_checkbox.setChecked(True)
+
         self.start_button = QtWidgets.QPushButton("Start")
         self.start_button.clicked.connect(self.accept)
 
@@ -472,10 +621,29 @@ class StartLiveStreamDialog(QtWidgets.QDialog):
         layout.addWidget(self.rtsp_url_entry)
         layout.addWidget(self.webcam_port_label)
         layout.addWidget(self.webcam_port_spinbox)
+        layout.addWidget(self.video_path_label)
+        layout.addWidget(self.video_path_entry)
+        layout.addWidget(self.video_path_button)
+        layout.addWidget(self.frame_rate_label)
+        layout.addWidget(self.frame_rate_spinbox)
+        layout.addWidget(self.detector_model_label)
+        layout.addWidget(self.detector_model_combo)
+        layout.addWidget(self.detector_scale_label)
+        layout.addWidget(self.detector_scale_spinbox)
+        layout.addWidget(self.detector_upsample_label)
+        layout.addWidget(self.detector_upsample_spinbox)
+        layout.addWidget(self.tcp_checkbox)
+        layout.addWidget(self.keyframes_checkbox)
+        layout.addWidget(self.hardware_checkbox)
+        layout.addWidget(self.motion_checkbox)
         layout.addWidget(self.start_button)
 
         self.setLayout(layout)
 
+    def get_video_file(self):
+        video_path, _ = QFileDialog.getOpenFileName(self, "Select Video File", "", "Videos (*.mp4 *.avi *.mkv *.mov)")
+        self.video_path_entry.setText(video_path)
+
     def get_input_type(self):
         return self.input_type_combo.currentText()
 
@@ -485,156 +653,541 @@ class StartLiveStreamDialog(QtWidgets.QDialog):
     def get_webcam_port(self):
         return self.webcam_port_spinbox.value()
 
+    def get_video_path(self):
+        return self.video_path_entry.text()
+
+    def get_frame_rate(self):
+        return self.frame_rate_spinbox.value()
+
+    def get_detector(self):
+        return FaceDetector(
+            self.detector_model_combo.currentText(),
+            self.detector_scale_spinbox.value(),
+            self.detector_upsample_spinbox.value(),
+        )
+
+    def get_capture_options(self):
+        return {
+            'transport': "tcp" if self.tcp_checkbox.isChecked() else "udp",
+            'keyframes_only': self.keyframes_checkbox.isChecked(),
+            'hardware_acceleration': self.hardware_checkbox.isChecked(),
+        }
+
+    def get_motion_gating(self):
+        return self.motion_checkbox.isChecked()
+
+
+class AttendanceTableModel(QtCore.QAbstractTableModel):
+    # Enrolled users joined with their attendance on one date, for a QTableView. Filtering,
+    # sorting and the day's aggregate run on a background thread and arrive through signals; a
+    # generation counter drops results of superseded queries. Rows are exposed a page at a time
+    # through fetchMore as the view scrolls, and the days-present history is only queried for
+    # the pages the view actually shows.
+    COLUMNS = ("Name", "Status", "First Seen", "Last Seen", "Sightings", "Days Present")
+    DAYS_COLUMN = 5
+    PAGE_SIZE = 500
+    rows_ready = QtCore.pyqtSignal(int, object)
+    days_ready = QtCore.pyqtSignal(int, int, object)
+    summary_changed = QtCore.pyqtSignal(str)
+
+    def __init__(self, gallery, attendance_log, parent=None):
+        super().__init__(parent)
+        self.gallery = gallery
+        self.attendance_log = attendance_log
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="dashboard")
+        self.generation = 0
+        self.filter_text = ""
+        self.date = time.strftime('%Y-%m-%d')
+        self.sort_column = 0
+        self.sort_order = QtCore.Qt.AscendingOrder
+        # Display order, rows shown so far, the day's {name: (first, last, sightings)} and the
+        # days-present counts fetched so far
+        self.names = []
+        self.loaded = 0
+        self.day = {}
+        self.days = {}
+        self.requested_pages = set()
+        self.rows_ready.connect(self.set_rows)
+        self.days_ready.connect(self.set_days)
+
+    def refresh(self, filter_text=None, date=None):
+        if filter_text is not None:
+            self.filter_text = filter_text
+        if date is not None:
+            self.date = date
+        self.generation += 1
+        self.executor.submit(self.query, self.generation, self.filter_text.lower(), self.date, self.sort_column, self.sort_order)
+
+    def query(self, generation, filter_text, date, column, order):
+        try:
+            with self.gallery.lock:
+                names = list(self.gallery.rows)
+            names = [name for name in names if filter_text in name.lower()]
+            day = self.attendance_log.day_summary(date)
+            # Sorting by history needs every count up front; otherwise they are fetched per page
+            days = self.attendance_log.days_present(names) if column == self.DAYS_COLUMN else None
+            keys = {
+                0: lambda name: name.lower(),
+                1: lambda name: name in day,
+                2: lambda name: day[name][0] if name in day else "",
+                3: lambda name: day[name][1] if name in day else "",
+                4: lambda name: day[name][2] if name in day else 0,
+                self.DAYS_COLUMN: lambda name: days.get(name, 0),
+            }
+            names.sort(key=keys[column], reverse=order == QtCore.Qt.DescendingOrder)
+        except (sqlite3.Error, OSError) as error:
+            print(f"Could not load the dashboard: {error}")
+            return
+        self.rows_ready.emit(generation, (names, day, days))
+
+    def set_rows(self, generation, result):
+        if generation != self.generation:
+            return
+        names, day, days = result
+        if names == self.names:
+            # Only the attendance changed, such as new sightings from a live stream; a reset
+            # would lose the selection and scroll position
+            self.day = day
+            if days is not None:
+                self.days, self.requested_pages = days, None
+            else:
+                # Counts shown so far stay up until their pages are queried again
+                self.requested_pages = set()
+                for page in range(-(-self.loaded // self.PAGE_SIZE)):
+                    self.request_days(page)
+            if self.loaded:
+                self.dataChanged.emit(self.index(0, 1), self.index(self.loaded - 1, len(self.COLUMNS) - 1))
+        else:
+            self.beginResetModel()
+            self.names, self.day = names, day
+            self.days, self.requested_pages = (days, None) if days is not None else ({}, set())
+            self.loaded = min(self.PAGE_SIZE, len(names))
+            self.endResetModel()
+        present = sum(name in day for name in names)
+        self.summary_changed.emit(f"{self.date}: {present} present, {len(names) - present} absent of {len(names)} users")
+
+    def request_days(self, page):
+        if self.requested_pages is None or page in self.requested_pages:
+            return
+        self.requested_pages.add(page)
+        names = self.names[page * self.PAGE_SIZE:(page + 1) * self.PAGE_SIZE]
+        self.executor.submit(self.query_days, self.generation, page, names)
+
+    def query_days(self, generation, page, names):
+        try:
+            self.days_ready.emit(generation, page, self.attendance_log.days_present(names))
+        except (sqlite3.Error, OSError) as error:
+            print(f"Could not load attendance history: {error}")
+
+    def set_days(self, generation, page, counts):
+        if generation != self.generation:
+            return
+        first = page * self.PAGE_SIZE
+        last = min(first + self.PAGE_SIZE, self.loaded) - 1
+        for name in self.names[first:last + 1]:
+            self.days[name] = counts.get(name, 0)
+        if last >= first:
+            self.dataChanged.emit(self.index(first, self.DAYS_COLUMN), self.index(last, self.DAYS_COLUMN))
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else self.loaded
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        return not parent.isValid() and self.loaded < len(self.names)
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        count = min(self.PAGE_SIZE, len(self.names) - self.loaded)
+        self.beginInsertRows(QtCore.QModelIndex(), self.loaded, self.loaded + count - 1)
+        self.loaded += count
+        self.endInsertRows()
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return self.COLUMNS[section]
+        return super().headerData(section, orientation, role)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if role != QtCore.Qt.DisplayRole or not index.isValid():
+            return None
+        name = self.names[index.row()]
+        seen = self.day.get(name)
+        column = index.column()
+        if column == 0:
+            return name
+        if column == 1:
+            return "Present" if seen else "Absent"
+        if column in (2, 3):
+            return seen[column - 2] if seen else ""
+        if column == 4:
+            return seen[2] if seen else 0
+        if name not in self.days:
+            self.request_days(index.row() // self.PAGE_SIZE)
+            return "..."
+        return self.days[name]
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        self.sort_column, self.sort_order = column, order
+        self.refresh()
+
 
 class StudentDashboard(QtWidgets.QWidget):
-    def __init__(self):
+    # Attendance of every enrolled user on a chosen date, refreshed while visible so sightings
+    # from running streams show up
+    REFRESH_INTERVAL_MS = 5000
+
+    def __init__(self, gallery, attendance_log):
         super().__init__()
         self.layout = QtWidgets.QVBoxLayout(self)
-        self.table = QtWidgets.QTableWidget()
-        self.table.setColumnCount(3)
+        self.model = AttendanceTableModel(gallery, attendance_log, self)
+        self.date_edit = QtWidgets.QDateEdit(QtCore.QDate.currentDate())
+        self.date_edit.setCalendarPopup(True)
+        self.date_edit.setDisplayFormat("yyyy-MM-dd")
+        self.filter_edit = QtWidgets.QLineEdit()
+        self.filter_edit.setPlaceholderText("Filter by name")
+        self.summary_label = QtWidgets.QLabel()
+        self.table = QtWidgets.QTableView()
+        self.table.setModel(self.model)
+        self.table.verticalHeader().setDefaultSectionSize(24)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.setSortingEnabled(True)
+        self.table.sortByColumn(0, QtCore.Qt.AscendingOrder)
         self.set_table_color()
-        self.table.setHorizontalHeaderLabels(["Student ID", "Student Name", "Accommodation"])
-        h_header = self.table.horizontalHeader()
-        h_header.setStyleSheet(f"color: {'#fff' if not self.light_mode else '#333'};")
-        v_header = self.table.verticalHeader()
-        v_header.setStyleSheet(f"color: {'#fff' if not self.light_mode else '#333'};")
-
-        # Sample data for demonstration
-        sample_data = [
-            ["222AD118", "Athi", "Hosteller"],
-            ["221CS280", "Ritthyk", "Hosteller"],
-            ["221CS314", "SivaRam", "Hosteller"],
-            ["222AD116", "Artha", "DayScholar"]
-        ]
-
-        self.set_table_data(sample_data)
 
+        # Typing restarts the timer, so only the final filter is queried
+        self.filter_timer = QtCore.QTimer(self, singleShot=True, interval=250)
+        self.filter_timer.timeout.connect(self.refresh)
+        self.filter_edit.textChanged.connect(self.filter_timer.start)
+        self.date_edit.dateChanged.connect(self.refresh)
+        self.model.summary_changed.connect(self.summary_label.setText)
+        self.refresh_timer = QtCore.QTimer(self, interval=self.REFRESH_INTERVAL_MS)
+        self.refresh_timer.timeout.connect(self.refresh)
+
+        controls = QtWidgets.QHBoxLayout()
+        controls.addWidget(self.date_edit)
+        controls.addWidget(self.filter_edit)
+        self.layout.addLayout(controls)
+        self.layout.addWidget(self.summary_label)
         self.layout.addWidget(self.table)
         self.hide()  # Hide by default
 
+    def refresh(self):
+        self.model.refresh(self.filter_edit.text().strip(), self.date_edit.date().toString("yyyy-MM-dd"))
+
+    def showEvent(self, event):
+        self.refresh()
+        self.refresh_timer.start()
+        super().showEvent(event)
+
+    def hideEvent(self, event):
+        self.refresh_timer.stop()
+        super().hideEvent(event)
+
     def set_table_color(self, light_mode=True):
         self.light_mode = light_mode
         # Use ternary if-else to set text color based on mode
-        self.table.setStyleSheet(f"color: {'#333' if self.light_mode else '#fff'};")
+        color = '#333' if self.light_mode else '#fff'
+        self.table.setStyleSheet(f"color: {color};")
+        self.table.horizontalHeader().setStyleSheet(f"color: {color};")
+        self.table.verticalHeader().setStyleSheet(f"color: {color};")
+
+
+class VideoWidget(QtWidgets.QWidget):
+    # Paints BGR frames scaled once, on the GUI thread, to fit the widget. The scaled frame, its
+    # overlay and (only where Qt lacks BGR888) its color conversion live in buffers that are
+    # reallocated only when the widget is resized, and the QImage painted wraps them without a copy.
+    BGR_FORMAT = getattr(QtGui.QImage, "Format_BGR888", None)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Expanding)
+        self.setAttribute(QtCore.Qt.WA_OpaquePaintEvent)
+        self.scaled = None
+        self.converted = None
+        self.image = None
+        self.offset = QtCore.QPoint()
+
+    def fit(self, frame_width, frame_height):
+        scale = min(self.width() / frame_width, self.height() / frame_height)
+        width, height = max(1, int(frame_width * scale)), max(1, int(frame_height * scale))
+        if self.scaled is None or self.scaled.shape[:2] != (height, width):
+            self.scaled = np.empty((height, width, 3), np.uint8)
+            if self.BGR_FORMAT is not None:
+                self.image = QtGui.QImage(self.scaled.data, width, height, 3 * width, self.BGR_FORMAT)
+            else:
+                self.converted = np.empty((height, width, 3), np.uint8)
+                self.image = QtGui.QImage(self.converted.data, width, height, 3 * width, QtGui.QImage.Format_RGB888)
+            self.offset = QtCore.QPoint((self.width() - width) // 2, (self.height() - height) // 2)
+        return scale
+
+    def show_frame(self, frame, faces):
+        # `faces` are (box, name) or (box, label, BGR color) in the frame's coordinates
+        frame_height, frame_width = frame.shape[:2]
+        scale = self.fit(frame_width, frame_height)
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        cv2.resize(frame, (self.scaled.shape[1], self.scaled.shape[0]), dst=self.scaled, interpolation=interpolation)
+        for face in faces:
+            (top, right, bottom, left), name = face[:2]
+            top, right, bottom, left = int(top * scale), int(right * scale), int(bottom * scale), int(left * scale)
+            color = face[2] if len(face) > 2 else (0, 255, 0) if name != "Unknown" else (0, 0, 255)
+            cv2.rectangle(self.scaled, (left, top), (right, bottom), color, 2)
+            cv2.putText(self.scaled, name, (left + 6, bottom - 6), cv2.FONT_HERSHEY_DUPLEX, 0.5, (255, 255, 255), 1)
+        if self.converted is not None:
+            cv2.cvtColor(self.scaled, cv2.COLOR_BGR2RGB, dst=self.converted)
+        self.update()
+
+    def resizeEvent(self, event):
+        # Reallocated for the new size by the next frame
+        self.scaled = None
+        self.image = None
+        super().resizeEvent(event)
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.fillRect(self.rect(), QtCore.Qt.black)
+        if self.image is not None:
+            painter.drawImage(self.offset, self.image)
+        painter.end()
+
+
+class EnrollmentWindow(QtWidgets.QDialog):
+    # Webcam preview for an EnrollmentSession. Good frames are captured automatically every
+    # `auto_interval` ms while the session is idle, or on demand with the Capture button; each
+    # capture's feedback comes back from the session's thread through `capture_checked`.
+    capture_checked = QtCore.pyqtSignal(dict)
+
+    def __init__(self, service, class_name, replace=False, webcam_port=0, auto_interval=400, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle(f"Enroll {class_name}")
+        self.resize(720, 620)
+        self.session = service.start_enrollment(class_name, replace)
+        self.frame = None
+        self.feedback = None
+        self.video_widget = VideoWidget()
+        self.feedback_label = QtWidgets.QLabel("Look at the camera")
+        self.progress_bar = QtWidgets.QProgressBar()
+        self.progress_bar.setMaximum(self.session.target)
+        self.auto_checkbox = QtWidgets.QCheckBox("Capture automatically")
+        self.auto_checkbox.setChecked(True)
+        capture_button = QtWidgets.QPushButton("Capture")
+        capture_button.clicked.connect(lambda: self.capture(manual=True))
+        done_button = QtWidgets.QPushButton("Done")
+        done_button.clicked.connect(self.accept)
+        cancel_button = QtWidgets.QPushButton("Cancel")
+        cancel_button.clicked.connect(self.reject)
+        buttons = QtWidgets.QHBoxLayout()
+        for widget in (self.auto_checkbox, capture_button, done_button, cancel_button):
+            buttons.addWidget(widget)
+        layout = QtWidgets.QVBoxLayout()
+        layout.addWidget(self.video_widget, 1)
+        layout.addWidget(self.feedback_label)
+        layout.addWidget(self.progress_bar)
+        layout.addLayout(buttons)
+        self.setLayout(layout)
+        self.capture_checked.connect(self.show_feedback)
+
+        self.video_source = VideoSource(webcam_port, name=f"enroll-{class_name}")
+        self.video_source.start(self.on_frame)
+        self.display_timer = QtCore.QTimer(self)
+        self.display_timer.timeout.connect(self.refresh_display)
+        self.display_timer.start(30)
+        self.auto_timer = QtCore.QTimer(self)
+        self.auto_timer.timeout.connect(self.capture)
+        self.auto_timer.start(auto_interval)
+
+    def on_frame(self, frame, duration):
+        # Grabber thread; the GUI only ever reads the newest frame
+        self.frame = frame
+
+    def refresh_display(self):
+        if self.frame is None:
+            return
+        faces = []
+        if self.feedback is not None and self.feedback['box'] is not None:
+            color = (0, 255, 0) if self.feedback['accepted'] else (0, 165, 255)
+            faces.append((self.feedback['box'], self.session.class_name, color))
+        self.video_widget.show_frame(self.frame, faces)
+
+    def capture(self, manual=False):
+        if self.frame is None:
+            return
+        if not manual and (not self.auto_checkbox.isChecked() or self.session.pending
+                           or len(self.session.captures) >= self.session.target):
+            return
+        future = self.session.submit(self.frame, manual)
+        future.add_done_callback(lambda done: self.capture_checked.emit(done.result()))
+
+    def show_feedback(self, feedback):
+        self.feedback = feedback
+        details = f" (size {feedback['size']}px, sharpness {feedback['sharpness']:.0f}, pose {feedback['pose']:.2f})" if 'size' in feedback else ""
+        self.feedback_label.setText(feedback['message'] + details)
+        self.progress_bar.setValue(min(len(self.session.captures), self.session.target))
+        if len(self.session.captures) >= self.session.target and self.auto_checkbox.isChecked():
+            self.feedback_label.setText(f"{feedback['message']}. Enough captures: press Done")
+
+    def done(self, result):
+        self.auto_timer.stop()
+        self.display_timer.stop()
+        self.video_source.stop()
+        if result == QtWidgets.QDialog.Accepted:
+            self.session.finish()
+        else:
+            self.session.cancel()
+        super().done(result)
 
-    def set_table_data(self, data):
-        self.table.setRowCount(len(data))
-        for row, rowData in enumerate(data):
-            for col, value in enumerate(rowData):
-                item = QtWidgets.QTableWidgetItem(str(value))
-                self.table.setItem(row, col, item)
-                
 
 class LiveStreamApp(QtWidgets.QWidget):
-    def __init__(self, all_face_encodings, all_face_names, rtsp_url=None, webcam_port=None):
+    # Emitted from the pipeline's match thread with each frame's faces; Qt queues it onto the GUI thread
+    results_ready = QtCore.pyqtSignal(list)
+
+    def __init__(self, gallery, rtsp_url=None, webcam_port=None, worker_pool=None, frame_rate=2, detector=None,
+                 attendance_log=None, snapshot_writer=None, name=None, capture_options=None, display_fps=30,
+                 motion_gating=True):
         super().__init__()
-        self.all_face_encodings = all_face_encodings
-        self.all_face_names = all_face_names
+        # Shared with the main window, so re-enrollment is picked up by running streams
+        self.gallery = gallery
+        self.worker_pool = worker_pool
+        self.frame_rate = frame_rate
+        self.detector = detector
+        self.attendance_log = attendance_log
+        self.snapshot_writer = snapshot_writer
+        # VideoSource.OPTIONS; frames beyond display_fps are grabbed but not decoded
+        self.capture_options = capture_options or {}
+        self.display_fps = display_fps
+        self.motion_gating = motion_gating
+        self.name = name
         self.streaming = False
-        self.video_capture = None
+        self.video_source = None
+        self.pipeline = None
         self.BASE_DIR = os.path.dirname(os.path.abspath(__file__))
         self.trespassers_folder = os.path.join(self.BASE_DIR, "trespassers")
         self.window_width = 1920
         self.window_height = 1080
         self.live_stream_window = QtWidgets.QMainWindow()
-        self.live_stream_window.setWindowTitle("Live Stream")
+        self.live_stream_window.setAttribute(QtCore.Qt.WA_DeleteOnClose)
+        self.live_stream_window.setWindowTitle("Live Stream" if name is None else f"Live Stream - {name}")
         self.live_stream_window.setWindowIcon(QtGui.QIcon("live.png"))
         self.live_stream_window.setGeometry(0, 0, self.window_width, self.window_height)
-        self.live_stream_label = QtWidgets.QLabel()
-        self.live_stream_label.setAlignment(QtCore.Qt.AlignCenter)
-        self.live_stream_label.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Expanding)
+        self.video_widget = VideoWidget()
+        # Latest recognition results, drawn over every displayed frame until the next ones arrive
+        self.faces = []
+        self.displayed_sequence = 0
         self.name_label = QtWidgets.QLabel("")
         self.name_label.setFont(QtGui.QFont("Helvetica", 14))
         self.name_label.setAlignment(QtCore.Qt.AlignRight)
         layout = QtWidgets.QHBoxLayout()
-        layout.addWidget(self.live_stream_label)
+        layout.addWidget(self.video_widget, stretch=7)
         layout.addWidget(self.name_label)
         central_widget = QtWidgets.QWidget()
         central_widget.setLayout(layout)
         self.live_stream_window.setCentralWidget(central_widget)
+        self.status_bar = self.live_stream_window.statusBar()
+        # Per-stage timings drawn over the video; metrics are only collected while one is shown
+        self.metrics_overlay = QtWidgets.QLabel(self.video_widget)
+        self.metrics_overlay.setStyleSheet("background-color: rgba(0, 0, 0, 160); color: white; padding: 4px;")
+        self.metrics_overlay.move(8, 8)
+        self.metrics_overlay.hide()
+        self.previous_metrics = None
+        self.metrics_checkbox = QtWidgets.QCheckBox("Metrics")
+        self.metrics_checkbox.toggled.connect(self.toggle_metrics_overlay)
+        self.status_bar.addPermanentWidget(self.metrics_checkbox)
         self.live_stream_window.show()
 
+        self.results_ready.connect(self.show_results)
+        # Polls for new captures, so the video refreshes at camera rate whatever the recognition rate
+        self.display_timer = QtCore.QTimer(self)
+        self.display_timer.timeout.connect(self.refresh_display)
+        self.display_timer.start(15)
+        # Per-stage throughput shown in the status bar
+        self.stats_timer = QtCore.QTimer(self)
+        self.stats_timer.timeout.connect(self.show_stats)
+        self.stats_timer.start(1000)
+
         # Connect destroyed signal to cleanup method
         self.live_stream_window.destroyed.connect(self.cleanup)
 
     def start_live_stream_rtsp(self, url):
-        self.video_capture = cv2.VideoCapture(f"{url}")
+        self.video_source = VideoSource(f"{url}", name=self.name, **self.capture_options)
         if url:
-            rtsp_thread = threading.Thread(target=self.start_stream)
-            rtsp_thread.daemon = True
-            rtsp_thread.start()
+            self.start_stream()
 
     def start_live_stream_webcam(self, port):
-        self.video_capture = cv2.VideoCapture(port)
+        self.video_source = VideoSource(port, name=self.name, **self.capture_options)
         if port is not None:
-            webcam_thread = threading.Thread(target=self.start_stream)
-            webcam_thread.daemon = True
-            webcam_thread.start()
+            self.start_stream()
+
+    def start_live_stream_file(self, path):
+        # Files are played back at their own frame rate instead of decoding as fast as possible
+        self.video_source = VideoSource(path, name=self.name, **self.capture_options)
+        self.start_stream()
 
     def start_stream(self):
-        if self.video_capture is not None:
+        if self.video_source is not None:
             self.streaming = True
-            frame_rate = 2
-            start_time = time.time()
-            csv_file_path = "detections.csv"
             os.makedirs(self.trespassers_folder, exist_ok=True)
-            with open(csv_file_path, mode='a', newline='') as csv_file:
-                fieldnames = ['Class Name', 'Date', 'Time']
-                writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-                writer.writeheader()
-                while self.streaming:
-                    ret, frame = self.video_capture.read()
-                    if ret:
-                        elapsed_time = time.time() - start_time
-                        if elapsed_time > 1 / frame_rate:
-                            start_time = time.time()
-                            frame = cv2.resize(frame, (int(self.window_width * 0.7), self.window_height))
-                            face_locations = face_recognition.face_locations(frame, model="cnn")
-                            face_encodings = face_recognition.face_encodings(frame, face_locations, model="cnn")
-                            names = []
-                            for face_encoding in face_encodings:
-                                matches = face_recognition.compare_faces(self.all_face_encodings, face_encoding, tolerance=0.5)
-                                name = "Unknown"
-                                if True in matches:
-                                    first_match_index = matches.index(True)
-                                    name = self.all_face_names[first_match_index]
-                                names.append(name)
-                            current_time = time.strftime('%Y-%m-%d_%H_%M_%S')
-                            for (top, right, bottom, left), name in zip(face_locations, names):
-                                color = (0, 255, 0) if name != "Unknown" else (0, 0, 255)
-                                cv2.rectangle(frame, (left, top), (right, bottom), color, 2)
-                                font = cv2.FONT_HERSHEY_DUPLEX
-                                cv2.putText(frame, name, (left + 6, bottom - 6), font, 0.5, (255, 255, 255), 1)
-                                if name == "Unknown":
-                                    image_path = os.path.join(self.trespassers_folder, f"trespasser_{current_time}.png")
-                                    temp = cv2.imwrite(image_path, frame)
-                                else:
-                                    writer.writerow({'Class Name': name, 'Date': current_time.split("_")[0], 'Time': current_time.split("_")[1]})
-                            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                            h, w, ch = frame.shape
-                            bytes_per_line = ch * w
-                            qt_image = QtGui.QImage(frame.data, w, h, bytes_per_line, QtGui.QImage.Format_RGB888)
-                            qt_pixmap = QtGui.QPixmap.fromImage(qt_image)
-                            self.live_stream_label.setPixmap(qt_pixmap)
-                            self.live_stream_label.setScaledContents(True)
-                            self.name_label.setText("\n".join(names))
-                            key = cv2.waitKey(1)
-                            if key == ord("q"):
-                                self.stop_live_stream()
-                    else:
-                        print("Error reading frame from RTSP stream")
-            self.video_capture.release()
+            self.pipeline = RecognitionPipeline(
+                self.video_source, self.gallery, self.trespassers_folder, lambda frame, faces: self.results_ready.emit(faces),
+                frame_rate=self.frame_rate, display_fps=self.display_fps,
+                worker_pool=self.worker_pool, detector=self.detector,
+                attendance_log=self.attendance_log, snapshot_writer=self.snapshot_writer,
+                name=self.name or "Live Stream", motion_gate=MotionGate() if self.motion_gating else None,
+            )
+            self.pipeline.start()
+
+    def show_results(self, faces):
+        # Runs on the GUI thread, at recognition rate
+        self.faces = faces
+        self.name_label.setText("\n".join(name for _, name in faces))
+
+    def refresh_display(self):
+        # Runs on the GUI thread; draws only when the capture thread has a newer frame
+        if not self.streaming or self.pipeline is None or self.pipeline.latest_frame is None:
+            return
+        sequence, frame = self.pipeline.latest_frame
+        if sequence == self.displayed_sequence:
+            return
+        self.displayed_sequence = sequence
+        start = time.perf_counter()
+        self.video_widget.show_frame(frame, self.faces)
+        duration = time.perf_counter() - start
+        self.pipeline.stats["render"].record(duration)
+        METRICS.record_stage(self.pipeline.name, "render", duration)
+
+    def show_stats(self):
+        if self.streaming and self.pipeline is not None:
+            self.status_bar.showMessage(self.pipeline.stats_text())
+            if self.metrics_overlay.isVisible():
+                current = METRICS.stream_totals(self.pipeline.name)
+                self.metrics_overlay.setText("\n".join(METRICS.describe(current, self.previous_metrics)))
+                self.metrics_overlay.adjustSize()
+                self.previous_metrics = current
+
+    def toggle_metrics_overlay(self, checked):
+        if checked:
+            METRICS.enable(f"overlay-{id(self)}")
+            self.previous_metrics = None
+            self.metrics_overlay.setText("Collecting metrics...")
+            self.metrics_overlay.adjustSize()
+        else:
+            METRICS.disable(f"overlay-{id(self)}")
+        self.metrics_overlay.setVisible(checked)
 
     def stop_live_stream(self):
-        self.streaming = False
-        self.video_capture.release()
-        cv2.destroyAllWindows()
+        self.cleanup()
         self.live_stream_window.close()
 
     def cleanup(self):
         self.streaming = False
-        if self.video_capture is not None and self.video_capture.isOpened():
-            self.video_capture.release()
+        self.stats_timer.stop()
+        self.display_timer.stop()
+        METRICS.disable(f"overlay-{id(self)}")
+        if self.pipeline is not None:
+            self.pipeline.stop()
+            self.pipeline = None
+        elif self.video_source is not None:
+            self.video_source.stop()
         cv2.destroyAllWindows()
         
     def closeEvent(self, event):
@@ -643,7 +1196,11 @@ class LiveStreamApp(QtWidgets.QWidget):
 
 
 if __name__ == "__main__":
+    startup_timer = StartupTimer()
     app = QtWidgets.QApplication([])
-    window = FaceRecognitionApp()
+    window = FaceRecognitionApp(startup_timer)
     window.show()
+    startup_timer.mark("window")
+    # Queued, so the window is painted before the loading thread competes with it
+    QtCore.QTimer.singleShot(0, window.start_loading)
     app.exec_()
@@ -0,0 +1,3072 @@
+# Qt-free core of fAIce: galleries, storage, detection, tracking, streaming and the recognition
+# service. The desktop app (fAIce.py), the headless server and the benchmarks all build on it.
+import time
+import os
+import atexit
+import bisect
+import cv2
+import shutil
+import sqlite3
+import pickle
+import concurrent.futures
+import collections
+import csv
+import importlib
+import json
+import multiprocessing
+import queue
+import socket
+import struct
+import sys
+import threading
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+from threading import Thread
+
+ENCODING_SIZE = 128
+
+
+class LazyModule:
+    # Imports a module on first attribute access. face_recognition loads dlib and its models
+    # when imported, which takes longer than everything else at startup put together, so it is
+    # only loaded once something detects or encodes a face (or load() is called to warm it up).
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.module is None:
+                self.module = importlib.import_module(self.name)
+        return self.module
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+
+face_recognition = LazyModule("face_recognition")
+
+
+def pairwise_distances(queries, vectors, vector_norms=None):
+    # ||q - v||^2 = ||q||^2 + ||v||^2 - 2 q.v, clipped for float rounding
+    if vector_norms is None:
+        vector_norms = np.einsum('ij,ij->i', vectors, vectors)
+    squared = np.einsum('ij,ij->i', queries, queries)[:, None] + vector_norms[None, :] - 2.0 * (queries @ vectors.T)
+    return np.sqrt(np.maximum(squared, 0.0))
+
+
+def nearest_rows(vectors, centroids, chunk_size=4096):
+    # Index of the closest centroid for every vector, chunked to bound the distance matrix size
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = vectors[start:start + chunk_size]
+        assignment[start:start + chunk_size] = np.argmin(pairwise_distances(chunk, centroids, centroid_norms), axis=1)
+    return assignment
+
+
+def kmeans(vectors, k, iterations=10, sample_size=65536, seed=0):
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample_size:
+        vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest_rows(vectors, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        order = np.argsort(assignment, kind='stable')
+        occupied = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[occupied]
+        centroids[occupied] = np.add.reduceat(vectors[order], starts, axis=0) / counts[occupied, None]
+        # Re-seed empty cells from random points so every list stays in use
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+    return centroids
+
+
+class ExactIndex:
+    # Brute-force search: every gallery row is a candidate for every face
+    def build(self, matrix):
+        pass
+
+    def add(self, rows, vectors):
+        pass
+
+    def remove(self, rows):
+        pass
+
+    def needs_rebuild(self):
+        return False
+
+    def candidates(self, queries):
+        return None
+
+
+class IVFIndex:
+    # Inverted-file index: rows are partitioned by k-means and a query only scans the
+    # `nprobe` closest partitions. Raising nprobe trades latency for recall; nprobe >= nlist
+    # is exact. Galleries smaller than `min_train_size` stay in a single partition.
+    def __init__(self, nlist=None, nprobe=8, min_train_size=4096, iterations=10, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self.iterations = iterations
+        self.seed = seed
+        self.build(np.empty((0, ENCODING_SIZE), dtype=np.float32))
+
+    def build(self, matrix):
+        self.trained_size = len(matrix)
+        if len(matrix) < self.min_train_size:
+            self.centroids = np.zeros((1, ENCODING_SIZE), dtype=np.float32)
+        else:
+            nlist = self.nlist or int(2 * np.sqrt(len(matrix)))
+            self.centroids = kmeans(matrix, min(nlist, len(matrix)), self.iterations, seed=self.seed)
+        assignment = nearest_rows(matrix, self.centroids) if len(matrix) else np.empty(0, dtype=np.int64)
+        order = np.argsort(assignment, kind='stable')
+        bounds = np.searchsorted(assignment[order], np.arange(len(self.centroids) + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+        self.row_list = {int(row): int(cell) for row, cell in enumerate(assignment)}
+
+    def add(self, rows, vectors):
+        assignment = nearest_rows(np.asarray(vectors, dtype=np.float32).reshape(-1, ENCODING_SIZE), self.centroids)
+        for row, cell in zip(rows, assignment):
+            self.lists[cell] = np.append(self.lists[cell], row)
+            self.row_list[int(row)] = int(cell)
+
+    def remove(self, rows):
+        for row in rows:
+            cell = self.row_list.pop(int(row), None)
+            if cell is not None:
+                self.lists[cell] = self.lists[cell][self.lists[cell] != row]
+
+    def needs_rebuild(self):
+        # Partitions trained on a much smaller gallery get unbalanced as identities are added
+        size = len(self.row_list)
+        return size >= self.min_train_size and (len(self.centroids) == 1 or size > 2 * self.trained_size)
+
+    def candidates(self, queries):
+        if len(self.centroids) == 1 or self.nprobe >= len(self.centroids):
+            return None
+        probe = np.argpartition(pairwise_distances(queries, self.centroids), self.nprobe - 1, axis=1)[:, :self.nprobe]
+        return [np.concatenate([self.lists[cell] for cell in cells]) for cells in probe]
+
+
+PRECISIONS = ("float32", "float16", "int8")
+
+
+class ScalarQuantizer:
+    # Compact codes for the candidate scan: float16 halves the gallery, int8 quarters it. int8
+    # uses one scale for every dimension (dlib encodings stay well inside +-0.5), so distances
+    # between decoded codes are still Euclidean distances, just rounded.
+    def __init__(self, precision):
+        if precision not in PRECISIONS[1:]:
+            raise ValueError(f"Unknown quantized precision {precision!r}, expected one of {PRECISIONS[1:]}")
+        self.precision = precision
+        self.scale = 0.5 / 127
+
+    def fit(self, matrix):
+        if self.precision == "int8" and len(matrix):
+            self.scale = max(float(np.abs(matrix).max()), 1e-6) / 127
+
+    def encode(self, vectors):
+        if self.precision == "float16":
+            return vectors.astype(np.float16)
+        return np.clip(np.rint(vectors / self.scale), -127, 127).astype(np.int8)
+
+    def decode(self, codes):
+        decoded = codes.astype(np.float32)
+        if self.precision == "int8":
+            decoded *= self.scale
+        return decoded
+
+
+def memory_mapped(array):
+    # True if the array's data lives in a memory-mapped file rather than on the heap
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+class FaceGallery:
+    # Enrolled encodings kept as one contiguous float32 matrix so a whole frame's faces
+    # can be matched with a single batched distance computation. An optional index
+    # narrows each face down to candidate rows, which are then ranked exactly. An identity
+    # may own several rows (templates); the nearest row is the minimum over each identity's
+    # templates, so matching stays one vectorized search.
+    # With a float16 or int8 `precision`, candidates are scanned on compact codes and only the
+    # best `rerank` rows per face are ranked against the float32 matrix. That matrix is then
+    # only read row by row, so a memory-mapped one from FaceDatabase.read() stays out of RAM
+    # (until the first enrollment, which needs a writeable copy).
+    SCAN_CHUNK = 16384
+
+    def __init__(self, encodings=None, names=None, tolerance=0.5, index=None, precision="float32", rerank=32):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown gallery precision {precision!r}, expected one of {PRECISIONS}")
+        self.tolerance = tolerance
+        self.index = index if index is not None else ExactIndex()
+        self.precision = precision
+        self.quantizer = ScalarQuantizer(precision) if precision != "float32" else None
+        self.rerank = rerank
+        self.lock = threading.RLock()
+        self.set_data(encodings if encodings is not None else [], names if names is not None else [])
+
+    def set_data(self, encodings, names):
+        matrix = np.ascontiguousarray(np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE))
+        if len(matrix) != len(names):
+            raise ValueError(f"Got {len(matrix)} encodings for {len(names)} names")
+        with self.lock:
+            self.matrix = matrix
+            self.norms = np.einsum('ij,ij->i', matrix, matrix)
+            self.codes = self.code_norms = None
+            if self.quantizer is not None:
+                self.quantizer.fit(matrix)
+                self.codes = self.quantizer.encode(matrix)
+                self.code_norms = self.decoded_norms(self.codes)
+            # Name of every row, and the rows of every name
+            self.names = list(names)
+            self.rows = {}
+            for row, name in enumerate(self.names):
+                self.rows.setdefault(name, []).append(row)
+            self.index.build(self.matrix)
+
+    def ensure_writeable(self):
+        # The matrix may be a read-only memory map straight from the face database
+        if not self.matrix.flags.writeable:
+            self.matrix = np.array(self.matrix)
+
+    def decoded_norms(self, codes):
+        decoded = self.quantizer.decode(codes)
+        return np.einsum('ij,ij->i', decoded, decoded)
+
+    def memory_bytes(self):
+        # Heap memory of the search data; a memory-mapped matrix is left out
+        arrays = [self.norms, self.codes, self.code_norms] + ([] if memory_mapped(self.matrix) else [self.matrix])
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def add_identity(self, name, encodings):
+        # Adds a new identity or replaces every template of an existing one without a full
+        # rebuild; `encodings` is a single encoding or a (templates, 128) array
+        vectors = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        with self.lock:
+            rows = self.rows.get(name)
+            codes = self.quantizer.encode(vectors) if self.quantizer is not None else None
+            if rows is not None and len(rows) == len(vectors):
+                self.index.remove(rows)
+                self.ensure_writeable()
+                self.matrix[rows] = vectors
+                self.norms[rows] = np.einsum('ij,ij->i', vectors, vectors)
+                if codes is not None:
+                    self.codes[rows] = codes
+                    self.code_norms[rows] = self.decoded_norms(codes)
+            else:
+                self.remove_identity(name)
+                rows = list(range(len(self.names), len(self.names) + len(vectors)))
+                self.matrix = np.vstack((self.matrix, vectors))
+                self.norms = np.append(self.norms, np.einsum('ij,ij->i', vectors, vectors))
+                if codes is not None:
+                    self.codes = np.vstack((self.codes, codes))
+                    self.code_norms = np.append(self.code_norms, self.decoded_norms(codes))
+                self.names.extend([name] * len(vectors))
+                self.rows[name] = rows
+            self.index.add(rows, vectors)
+            if self.index.needs_rebuild():
+                self.index.build(self.matrix)
+
+    def remove_identity(self, name):
+        with self.lock:
+            rows = self.rows.pop(name, None)
+            if rows is None:
+                return False
+            self.index.remove(rows)
+            self.ensure_writeable()
+            # Move rows from the end into the holes, highest hole first, so rows stay contiguous
+            last = len(self.names)
+            for row in sorted(rows, reverse=True):
+                last -= 1
+                if row == last:
+                    continue
+                moved = self.names[last]
+                self.index.remove([last])
+                self.matrix[row] = self.matrix[last]
+                self.norms[row] = self.norms[last]
+                if self.codes is not None:
+                    self.codes[row] = self.codes[last]
+                    self.code_norms[row] = self.code_norms[last]
+                self.names[row] = moved
+                owner_rows = self.rows[moved]
+                owner_rows[owner_rows.index(last)] = row
+                self.index.add([row], self.matrix[row:row + 1])
+            self.matrix = self.matrix[:last].copy()
+            self.norms = self.norms[:last].copy()
+            if self.codes is not None:
+                self.codes = self.codes[:last].copy()
+                self.code_norms = self.code_norms[:last].copy()
+            del self.names[last:]
+            return True
+
+    def __len__(self):
+        # Identities, not template rows
+        return len(self.rows)
+
+    def scan(self, queries, rows=None):
+        # Distances from the queries to `rows` (every row if None): exact on the float32 matrix,
+        # or approximate on the codes, decoded a chunk at a time so no float32 copy is ever whole
+        if self.codes is None:
+            if rows is None:
+                return pairwise_distances(queries, self.matrix, self.norms)
+            return pairwise_distances(queries, self.matrix[rows], self.norms[rows])
+        codes = self.codes if rows is None else self.codes[rows]
+        code_norms = self.code_norms if rows is None else self.code_norms[rows]
+        distances = np.empty((len(queries), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), self.SCAN_CHUNK):
+            end = start + self.SCAN_CHUNK
+            distances[:, start:end] = pairwise_distances(queries, self.quantizer.decode(codes[start:end]), code_norms[start:end])
+        return distances
+
+    def search(self, face_encodings, k=1):
+        # Returns (rows, distances), both shaped (faces, k); missing neighbours are -1 / inf.
+        # With k > 1 an identity can appear more than once, through several templates
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        # Quantized galleries shortlist more rows than asked for, to re-rank exactly
+        shortlist = k if self.codes is None else max(k, self.rerank)
+        with self.lock:
+            if not self.names or not len(queries):
+                return rows, distances
+            candidates = self.index.candidates(queries)
+            if candidates is None:
+                all_distances = self.scan(queries)
+                candidates = [None] * len(queries)
+            for i, candidate_rows in enumerate(candidates):
+                if candidate_rows is None:
+                    row_distances = all_distances[i]
+                    candidate_rows = np.arange(len(self.names))
+                else:
+                    row_distances = self.scan(queries[i:i + 1], candidate_rows)[0]
+                top = min(shortlist, len(candidate_rows))
+                if top == 0:
+                    continue
+                best = np.argpartition(row_distances, top - 1)[:top]
+                if self.codes is not None:
+                    best_rows = candidate_rows[best]
+                    row_distances = pairwise_distances(queries[i:i + 1], np.asarray(self.matrix[best_rows]), self.norms[best_rows])[0]
+                    candidate_rows, best = best_rows, np.arange(top)
+                    top = min(k, top)
+                best = best[np.argsort(row_distances[best])][:top]
+                rows[i, :top] = candidate_rows[best]
+                distances[i, :top] = row_distances[best]
+        return rows, distances
+
+    def match(self, face_encodings, tolerance=None):
+        # Returns one (name, distance) per face; name is "Unknown" if the nearest identity is too
+        # far. The distance is that of the identity's closest template
+        tolerance = self.tolerance if tolerance is None else tolerance
+        if len(face_encodings) == 0:
+            return []
+        with self.lock:
+            rows, distances = self.search(face_encodings)
+            names = self.names
+            return [
+                (names[row] if row >= 0 and distance <= tolerance else "Unknown", float(distance))
+                for row, distance in zip(rows[:, 0], distances[:, 0])
+            ]
+
+
+class FaceDatabase:
+    # Versioned on-disk gallery replacing face_data.pkl: a small JSON header, a raw float32
+    # embedding matrix and a fixed-width identity table. Both data files are memory-mapped, so
+    # opening costs the same at any gallery size. Rows are append-only: new rows are written past
+    # the end and only become visible when the header is atomically replaced, and replacing or
+    # removing an identity tombstones its old rows. An identity has one row per template (version
+    # 2; version 1 files have one row each and read the same). If a replace is interrupted before
+    # the tombstones are written, the newest put of a name wins.
+    FORMAT = "faice-face-db"
+    VERSION = 2
+    NAME_BYTES = 64
+    RECORD = np.dtype([('name', f'S{NAME_BYTES}'), ('deleted', 'u1'), ('updated', '<f8')])
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.header_path = os.path.join(folder, "header.json")
+        self.lock = threading.RLock()
+        self.open()
+
+    def exists(self):
+        return self.header is not None
+
+    def open(self):
+        with self.lock:
+            self.header = None
+            self.embeddings = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+            self.records = np.empty(0, dtype=self.RECORD)
+            self.rows = None
+            if not os.path.exists(self.header_path):
+                return
+            with open(self.header_path, 'r') as file:
+                header = json.load(file)
+            if header.get('format') != self.FORMAT or header.get('version', 0) > self.VERSION:
+                raise ValueError(f"{self.header_path} is not a supported face database (version {header.get('version')})")
+            if header['dim'] != ENCODING_SIZE:
+                raise ValueError(f"Face database stores {header['dim']}-d encodings, expected {ENCODING_SIZE}")
+            self.header = header
+            if header['rows']:
+                self.embeddings = np.memmap(os.path.join(self.folder, header['embeddings']), dtype='<f4', mode='r',
+                                            shape=(header['rows'], ENCODING_SIZE))
+                self.records = np.memmap(os.path.join(self.folder, header['identities']), dtype=self.RECORD, mode='r+',
+                                         shape=(header['rows'],))
+
+    def write_header(self, header):
+        temporary_path = f"{self.header_path}.tmp"
+        with open(temporary_path, 'w') as file:
+            json.dump(header, file, indent=2)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.header_path)
+
+    def encode_names(self, names):
+        encoded = [name.encode('utf-8') for name in names]
+        for name in encoded:
+            if len(name) > self.NAME_BYTES:
+                raise ValueError(f"Identity name {name!r} is longer than {self.NAME_BYTES} bytes")
+        return encoded
+
+    def read(self):
+        # Returns (encodings, names), a row per template of every live identity; zero-copy when
+        # there are no tombstones
+        with self.lock:
+            if self.header is None or not self.header['rows']:
+                return np.empty((0, ENCODING_SIZE), dtype=np.float32), []
+            names = [name.decode('utf-8') for name in self.records['name']]
+            deleted = self.records['deleted'].astype(bool)
+            updated = self.records['updated']
+            # All templates of one put share its timestamp
+            newest = {}
+            for row, name in enumerate(names):
+                if not deleted[row] and updated[row] > newest.get(name, -np.inf):
+                    newest[name] = updated[row]
+            live_rows = [row for row, name in enumerate(names) if not deleted[row] and updated[row] == newest[name]]
+            if len(live_rows) == len(names):
+                return self.embeddings, names
+            return np.asarray(self.embeddings[live_rows]), [names[row] for row in live_rows]
+
+    def write_all(self, encodings, names):
+        # Writes a whole new generation of data files, then switches the header over to it
+        matrix = np.ascontiguousarray(np.asarray(encodings, dtype='<f4').reshape(-1, ENCODING_SIZE))
+        if len(matrix) != len(names):
+            raise ValueError(f"Got {len(matrix)} encodings for {len(names)} names")
+        records = np.zeros(len(names), dtype=self.RECORD)
+        records['name'] = self.encode_names(names)
+        records['updated'] = time.time()
+        with self.lock:
+            os.makedirs(self.folder, exist_ok=True)
+            previous = self.header
+            generation = previous['generation'] + 1 if previous else 1
+            header = {
+                'format': self.FORMAT, 'version': self.VERSION, 'dim': ENCODING_SIZE, 'dtype': 'float32',
+                'generation': generation, 'rows': len(names), 'live': len(names),
+                'embeddings': f"embeddings.{generation}.f32", 'identities': f"identities.{generation}.bin",
+                'created': previous['created'] if previous else time.time(),
+            }
+            for filename, data in ((header['embeddings'], matrix), (header['identities'], records)):
+                with open(os.path.join(self.folder, filename), 'wb') as file:
+                    file.write(data.tobytes())
+                    file.flush()
+                    os.fsync(file.fileno())
+            self.write_header(header)
+            self.open()
+            for filename in os.listdir(self.folder):
+                if filename.startswith(("embeddings.", "identities.")) and filename not in (header['embeddings'], header['identities']):
+                    try:
+                        os.remove(os.path.join(self.folder, filename))
+                    except OSError:
+                        # Still memory-mapped somewhere (Windows); removed by a later generation
+                        pass
+
+    def append(self, names, encodings):
+        matrix = np.ascontiguousarray(np.asarray(encodings, dtype='<f4').reshape(-1, ENCODING_SIZE))
+        records = np.zeros(len(names), dtype=self.RECORD)
+        records['name'] = self.encode_names(names)
+        records['updated'] = time.time()
+        with self.lock:
+            if self.header is None:
+                self.write_all(matrix, names)
+                return
+            header = dict(self.header)
+            # Write past the published end; a crash here leaves the header (and readers) untouched
+            for filename, data, row_size in ((header['embeddings'], matrix, matrix.itemsize * ENCODING_SIZE),
+                                             (header['identities'], records, self.RECORD.itemsize)):
+                with open(os.path.join(self.folder, filename), 'r+b') as file:
+                    file.seek(header['rows'] * row_size)
+                    file.write(data.tobytes())
+                    file.truncate()
+                    file.flush()
+                    os.fsync(file.fileno())
+            header['rows'] += len(names)
+            header['live'] += len(names)
+            header['version'] = self.VERSION
+            self.write_header(header)
+            self.open()
+
+    def live_rows(self):
+        # Every live row of every name, including those an interrupted replace left behind
+        if self.rows is None:
+            deleted = self.records['deleted']
+            self.rows = {}
+            for row, name in enumerate(self.records['name']):
+                if not deleted[row]:
+                    self.rows.setdefault(name.decode('utf-8'), []).append(row)
+        return self.rows
+
+    def tombstone(self, rows):
+        self.records['deleted'][rows] = 1
+        self.records.flush()
+        header = dict(self.header)
+        header['live'] -= len(rows)
+        self.write_header(header)
+        self.header = header
+        self.rows = None
+        # Reclaim space once most rows are dead
+        if header['live'] < header['rows'] // 2:
+            self.write_all(*self.read())
+
+    def put(self, name, encodings):
+        # Adds or atomically replaces a single identity; `encodings` is one encoding or its templates
+        matrix = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        with self.lock:
+            old_rows = self.live_rows().get(name) if self.header else None
+            self.append([name] * len(matrix), matrix)
+            if old_rows:
+                self.tombstone(old_rows)
+
+    def remove(self, name):
+        with self.lock:
+            rows = self.live_rows().get(name) if self.header else None
+            if not rows:
+                return False
+            self.tombstone(rows)
+            return True
+
+    def import_pickle(self, pickle_path):
+        # One-time import of the old face_data.pkl format; the pickle itself is left in place
+        with open(pickle_path, 'rb') as file:
+            face_data = pickle.load(file)
+        names = list(face_data.get('names', []))
+        self.write_all(np.asarray(face_data.get('encodings', []), dtype=np.float32).reshape(-1, ENCODING_SIZE), names)
+        print(f"Imported {len(names)} identities from {pickle_path} into {self.folder}")
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+# Templates kept per enrolled identity, which bounds the rows a face is matched against
+MAX_TEMPLATES = 5
+
+
+def encode_image_file(image_path):
+    # Module-level so it can run in a worker process; returns a (faces, 128) float32 array
+    try:
+        image = face_recognition.load_image_file(image_path)
+        face_encodings = face_recognition.face_encodings(image)
+    except Exception as error:
+        print(f"Could not encode {image_path}: {error}")
+        face_encodings = []
+    return np.asarray(face_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+
+
+def face_quality(rgb_image, box):
+    # Face area times Laplacian sharpness: large, in-focus faces score highest
+    top, right, bottom, left = box
+    gray_face = cv2.cvtColor(rgb_image[top:bottom, left:right], cv2.COLOR_RGB2GRAY)
+    sharpness = cv2.Laplacian(gray_face, cv2.CV_64F).var() if gray_face.size else 0.0
+    return float((bottom - top) * (right - left) * sharpness)
+
+
+def pose_score(landmarks):
+    # 1.0 for a frontal face, falling towards 0 as the nose moves towards one eye (yaw)
+    nose = np.mean(landmarks['nose_tip'], axis=0)
+    left = np.linalg.norm(nose - np.mean(landmarks['left_eye'], axis=0))
+    right = np.linalg.norm(nose - np.mean(landmarks['right_eye'], axis=0))
+    return float(1.0 - abs(left - right) / max(left + right, 1e-6))
+
+
+def encode_snapshot_file(image_path):
+    # Encoding of the largest face in a snapshot plus its face_quality, or (None, 0.0) when no
+    # face is found
+    try:
+        image = face_recognition.load_image_file(image_path)
+        face_locations = face_recognition.face_locations(image)
+        if not face_locations:
+            return None, 0.0
+        box = max(face_locations, key=lambda box: (box[2] - box[0]) * (box[1] - box[3]))
+        face_encodings = face_recognition.face_encodings(image, [box])
+    except Exception as error:
+        print(f"Could not encode {image_path}: {error}")
+        return None, 0.0
+    return np.asarray(face_encodings[0], dtype=np.float32), face_quality(image, box)
+
+
+def enrollment_face(rgb_image):
+    # Returns (face locations, encoding, details). The encoding and details (face size in pixels,
+    # sharpness, pose score and their combined quality) are only computed for exactly one face
+    face_locations = face_recognition.face_locations(rgb_image)
+    if len(face_locations) != 1:
+        return face_locations, None, {}
+    top, right, bottom, left = face_locations[0]
+    face_encodings = face_recognition.face_encodings(rgb_image, face_locations)
+    landmarks = face_recognition.face_landmarks(rgb_image, face_locations, model="small")
+    gray_face = cv2.cvtColor(rgb_image[top:bottom, left:right], cv2.COLOR_RGB2GRAY)
+    details = {
+        'size': min(bottom - top, right - left),
+        'sharpness': float(cv2.Laplacian(gray_face, cv2.CV_64F).var()) if gray_face.size else 0.0,
+        'pose': pose_score(landmarks[0]) if landmarks else 1.0,
+    }
+    details['quality'] = face_quality(rgb_image, face_locations[0]) * details['pose']
+    return face_locations, np.asarray(face_encodings[0], dtype=np.float32), details
+
+
+def encode_enrollment_image(image_path):
+    # Encoding of the only face in an enrollment image plus a quality score (face_quality times
+    # pose_score), or (None, 0.0). Images with several faces are skipped: the other face could be
+    # anyone, and must not end up in the enrolled identity.
+    try:
+        face_locations, encoding, details = enrollment_face(face_recognition.load_image_file(image_path))
+    except Exception as error:
+        print(f"Could not encode {image_path}: {error}")
+        return None, 0.0
+    if encoding is None:
+        if face_locations:
+            print(f"Skipping {image_path}: {len(face_locations)} faces")
+        return None, 0.0
+    return encoding, details['quality']
+
+
+def select_templates(encodings, qualities, max_templates=MAX_TEMPLATES, cluster_radius=0.35, outlier_distance=0.6):
+    # Picks at most `max_templates` representative encodings for one identity, or None. Outliers
+    # (further than `outlier_distance` from the medoid: mislabelled or badly detected images)
+    # are dropped, then a greedy pass in descending quality order groups the rest
+    # into clusters of `cluster_radius`, the way SnapshotDeduplicator groups snapshots. Each cluster
+    # (pose, lighting, glasses...) contributes its quality-weighted mean.
+    if not len(encodings):
+        return None
+    encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+    weights = np.maximum(np.asarray(qualities, dtype=np.float64), 1e-6)
+    if len(encodings) > 2:
+        # The medoid (smallest median distance to the others) is the centre one sharp image of
+        # the wrong person cannot drag away
+        distances = pairwise_distances(encodings, encodings)
+        medoid = int(np.argmin(np.median(distances, axis=1)))
+        inliers = distances[medoid] <= outlier_distance
+        encodings, weights = encodings[inliers], weights[inliers]
+    order = np.argsort(-weights, kind='stable')
+    centres, members = [], []
+    for i in order:
+        if centres:
+            distances = np.linalg.norm(np.asarray(centres) - encodings[i], axis=1)
+            nearest = int(np.argmin(distances))
+            if distances[nearest] <= cluster_radius or len(centres) >= max_templates:
+                members[nearest].append(i)
+                continue
+        centres.append(encodings[i])
+        members.append([i])
+    return np.vstack([np.average(encodings[rows], axis=0, weights=weights[rows]) for rows in members]).astype(np.float32)
+
+
+def convert_encodings(value, dtype):
+    # Casts every float array in an encode function's result (an array, or tuples and lists
+    # holding arrays) to dtype, leaving everything else as it is
+    if isinstance(value, np.ndarray) and value.dtype.kind == 'f':
+        return value.astype(dtype)
+    if isinstance(value, (tuple, list)):
+        return type(value)(convert_encodings(item, dtype) for item in value)
+    return value
+
+
+class DatasetEncoder:
+    # Encodes images over a process pool and caches each image's result keyed by path, mtime, size
+    # and encode function, so re-enrollment only runs the model on new or changed images.
+    # `encode_function` must be a module-level function so worker processes can import it. With a
+    # float16 or int8 `precision` the cache holds float16 encodings (an int8 code would need a
+    # scale per vector, which saves little per pickled entry) and hands them out as float32.
+    def __init__(self, cache_file="embedding_cache.pkl", workers=None, encode_function=encode_enrollment_image, name="enrollment",
+                 precision="float32"):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown cache precision {precision!r}, expected one of {PRECISIONS}")
+        self.cache_file = cache_file
+        self.cache_dtype = np.float32 if precision == "float32" else np.float16
+        # Metrics label
+        self.name = name
+        self.workers = workers or os.cpu_count() or 1
+        self.encode_function = encode_function
+        # Number of images the last encode_images call actually ran the model on
+        self.encoded_count = 0
+        self.lock = threading.Lock()
+        self.cache = {}
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'rb') as file:
+                    self.cache = pickle.load(file)
+            except (OSError, pickle.UnpicklingError, EOFError) as error:
+                print(f"Ignoring unreadable embedding cache: {error}")
+
+    @staticmethod
+    def image_paths(class_folder):
+        return sorted(
+            os.path.join(class_folder, filename) for filename in os.listdir(class_folder)
+            if filename.lower().endswith(IMAGE_EXTENSIONS)
+        )
+
+    def encode_images(self, image_paths, progress=None, cancelled=None):
+        # Returns {path: encodings}. Misses are encoded in chunks so `progress(done, total)` can be
+        # reported and `cancelled()` polled; the cache is saved periodically, so an interrupted
+        # run resumes where it stopped. Cancelled runs leave the unencoded paths out.
+        results = {}
+        missing = []
+        for image_path in image_paths:
+            stat = os.stat(image_path)
+            key = (stat.st_mtime_ns, stat.st_size, self.encode_function.__name__)
+            cached = self.cache.get(os.path.abspath(image_path))
+            if cached is not None and cached[0] == key:
+                results[image_path] = convert_encodings(cached[1], np.float32)
+            else:
+                missing.append((image_path, key))
+        self.encoded_count = 0
+        if progress is not None:
+            progress(len(results), len(image_paths))
+        if not missing:
+            return results
+        executor = None
+        if len(missing) > 1 and self.workers > 1:
+            # Spawned rather than forked: the GUI process already runs threads
+            context = multiprocessing.get_context("spawn")
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=min(self.workers, len(missing)), mp_context=context)
+        chunk_size = 8 * min(self.workers, len(missing))
+        last_save = time.monotonic()
+        try:
+            for start in range(0, len(missing), chunk_size):
+                if cancelled is not None and cancelled():
+                    break
+                chunk = missing[start:start + chunk_size]
+                clock = METRICS.clock()
+                paths = [image_path for image_path, _ in chunk]
+                encoded = executor.map(self.encode_function, paths) if executor is not None else map(self.encode_function, paths)
+                with self.lock:
+                    for (image_path, key), encodings in zip(chunk, encoded):
+                        cached = convert_encodings(encodings, self.cache_dtype)
+                        self.cache[os.path.abspath(image_path)] = (key, cached)
+                        # Handed out as a cache hit would be, so later runs see identical values
+                        results[image_path] = convert_encodings(cached, np.float32)
+                        self.encoded_count += 1
+                METRICS.stage_since(self.name, "encode_chunk", clock)
+                METRICS.count('faice_images_encoded_total', (('stream', self.name),), len(chunk))
+                if progress is not None:
+                    progress(len(results), len(image_paths))
+                if time.monotonic() - last_save > 10:
+                    self.save_cache()
+                    last_save = time.monotonic()
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            self.save_cache()
+        return results
+
+    def save_cache(self):
+        with self.lock:
+            # Drop entries for images that have been deleted since they were cached
+            self.cache = {path: entry for path, entry in self.cache.items() if os.path.exists(path)}
+            temporary_file = f"{self.cache_file}.tmp"
+            with open(temporary_file, 'wb') as file:
+                pickle.dump(self.cache, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_file, self.cache_file)
+
+    def encode_dataset(self, root_folder, class_names=None, max_templates=MAX_TEMPLATES, progress=None):
+        # Returns {class_name: (templates, 128) array or None} from encode_enrollment_image
+        # results; every image of every class goes through one pool so small classes don't leave
+        # workers idle
+        class_names = class_names if class_names is not None else sorted(
+            name for name in os.listdir(root_folder) if os.path.isdir(os.path.join(root_folder, name))
+        )
+        class_images = {name: self.image_paths(os.path.join(root_folder, name)) for name in class_names}
+        encoded = self.encode_images([path for paths in class_images.values() for path in paths], progress)
+        templates = {}
+        for class_name, paths in class_images.items():
+            faces = [encoded[path] for path in paths if encoded[path][0] is not None]
+            templates[class_name] = select_templates(
+                [encoding for encoding, _ in faces], [quality for _, quality in faces], max_templates,
+            ) if faces else None
+        return templates
+
+
+class SnapshotDeduplicator:
+    # Keeps one snapshot per distinct trespasser. Snapshot encodings are cached in the folder, so
+    # each pass only encodes new files; clustering is a greedy pass in descending quality order
+    # against an index of the representatives kept so far, so the sharpest, largest shot of each
+    # face survives and every later near-duplicate is deleted.
+    CACHE_FILE = ".faice_embeddings.pkl"
+
+    def __init__(self, folder_path, tolerance=0.6, precision="float32"):
+        self.folder_path = folder_path
+        self.tolerance = tolerance
+        self.precision = precision
+        self.encoder = None
+
+    def run(self):
+        start = time.perf_counter()
+        if not os.path.exists(self.folder_path):
+            return {'files': 0, 'encoded': 0, 'removed': 0, 'seconds': 0.0}
+        if self.encoder is None:
+            self.encoder = DatasetEncoder(os.path.join(self.folder_path, self.CACHE_FILE), encode_function=encode_snapshot_file, name="dedup",
+                                          precision=self.precision)
+        file_paths = sorted(
+            os.path.join(self.folder_path, filename) for filename in os.listdir(self.folder_path)
+            if filename.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        encoded = self.encoder.encode_images(file_paths)
+        candidates = sorted(
+            ((quality, path, encoding) for path, (encoding, quality) in encoded.items() if encoding is not None),
+            key=lambda candidate: candidate[0], reverse=True,
+        )
+        representatives = FaceGallery(tolerance=self.tolerance, index=IVFIndex())
+        removed = 0
+        for quality, path, encoding in candidates:
+            name, distance = representatives.match([encoding])[0]
+            if name == "Unknown":
+                representatives.add_identity(path, encoding)
+                continue
+            print(f"Deleting similar faces: {name} and {path}")
+            if os.path.exists(path):
+                os.remove(path)
+                removed += 1
+                context_path = SnapshotWriter.context_path(path)
+                if os.path.exists(context_path):
+                    os.remove(context_path)
+            else:
+                print(f"File not found: {path}")
+        if removed:
+            self.encoder.save_cache()
+        stats = {'files': len(file_paths), 'encoded': self.encoder.encoded_count, 'removed': removed, 'seconds': time.perf_counter() - start}
+        print(f"Trespasser dedup: {stats['files']} files, {stats['encoded']} newly encoded, "
+              f"{stats['removed']} removed in {stats['seconds']:.1f}s")
+        return stats
+
+
+def sort_folder(gallery, folder_path, class_names=None, tolerance=None, batch_size=4096, progress=None, cancelled=None,
+                cache_file=".faice_embeddings.pkl"):
+    # Sorts a photo folder into Sorted_<class>_Images folders for every known class in one pass
+    # and returns the number of images per class. Each image is encoded once through a per-folder
+    # embedding cache, so repeated sorts (for other classes, or after a cancel) only encode images
+    # that are new or changed. The cache is kept at the gallery's precision, and a None tolerance
+    # matches at the gallery's.
+    class_names = set(class_names) if class_names else None
+    image_paths = sorted(
+        os.path.join(folder_path, filename) for filename in os.listdir(folder_path)
+        if filename.lower().endswith(('.jpg', '.jpeg', '.png'))
+    )
+    encoder = DatasetEncoder(os.path.join(folder_path, cache_file), encode_function=encode_image_file, name="sort",
+                             precision=gallery.precision)
+    encoded = encoder.encode_images(image_paths, progress=progress, cancelled=cancelled)
+    # Match every face of every encoded image in large batches
+    owners = [path for path in image_paths if path in encoded for _ in range(len(encoded[path]))]
+    encodings = [encoded[path] for path in image_paths if path in encoded and len(encoded[path])]
+    matches = collections.defaultdict(set)
+    if encodings:
+        encodings = np.vstack(encodings)
+        for start in range(0, len(encodings), batch_size):
+            batch = encodings[start:start + batch_size]
+            for owner, (name, _) in zip(owners[start:start + batch_size], gallery.match(batch, tolerance)):
+                if name != "Unknown" and (class_names is None or name in class_names):
+                    matches[name].add(owner)
+    counts = {}
+    for name, paths in matches.items():
+        output_folder_path = os.path.join(folder_path, f"Sorted_{name}_Images")
+        os.makedirs(output_folder_path, exist_ok=True)
+        for image_path in paths:
+            destination = os.path.join(output_folder_path, os.path.basename(image_path))
+            # Already copied by an earlier, possibly interrupted, run
+            if not os.path.exists(destination):
+                shutil.copy(image_path, destination)
+        counts[name] = len(paths)
+    return counts
+
+
+class CsvAttendanceBackend:
+    FIELDNAMES = ['Class Name', 'Date', 'Time']
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, events):
+        # The header is only written when the file is new, not on every stream start
+        write_header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, mode='a', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=self.FIELDNAMES)
+            if write_header:
+                writer.writeheader()
+            for name, date, clock, source in events:
+                writer.writerow({'Class Name': name, 'Date': date, 'Time': clock})
+
+    def query(self, name=None, date=None, limit=None, offset=0):
+        if not os.path.exists(self.path):
+            return []
+        rows = []
+        with open(self.path, newline='') as csv_file:
+            for row in csv.DictReader(csv_file):
+                if row.get('Class Name') == 'Class Name':
+                    continue  # Repeated headers written by older versions
+                if (name is None or row['Class Name'] == name) and (date is None or row['Date'] == date):
+                    rows.append((row['Class Name'], row['Date'], row['Time'], None))
+        return rows[offset:offset + limit if limit is not None else None]
+
+    def day_summary(self, date):
+        summary = {}
+        for name, _, clock, _ in self.query(date=date):
+            first, last, sightings = summary.get(name, (clock, clock, 0))
+            summary[name] = (min(first, clock), max(last, clock), sightings + 1)
+        return summary
+
+    def days_present(self, names):
+        names = set(names)
+        dates = {}
+        for name, date, _, _ in self.query():
+            if name in names:
+                dates.setdefault(name, set()).add(date)
+        return {name: len(days) for name, days in dates.items()}
+
+    def close(self):
+        pass
+
+
+class SqliteAttendanceBackend:
+    # WAL mode lets the dashboard read while the flusher writes
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS detections ("
+                "id INTEGER PRIMARY KEY, name TEXT NOT NULL, date TEXT NOT NULL, time TEXT NOT NULL, source TEXT)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS detections_name_date ON detections (name, date)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS detections_date ON detections (date)")
+
+    def write(self, events):
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT INTO detections (name, date, time, source) VALUES (?, ?, ?, ?)", events)
+
+    def query(self, name=None, date=None, limit=None, offset=0):
+        clauses, parameters = [], []
+        if name is not None:
+            clauses.append("name = ?")
+            parameters.append(name)
+        if date is not None:
+            clauses.append("date = ?")
+            parameters.append(date)
+        sql = "SELECT name, date, time, source FROM detections"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY id LIMIT ? OFFSET ?"
+        parameters += [-1 if limit is None else limit, offset]
+        return self.read(sql, parameters)
+
+    def day_summary(self, date):
+        # {name: (first time, last time, sightings)} for everyone seen on `date`
+        rows = self.read("SELECT name, MIN(time), MAX(time), COUNT(*) FROM detections WHERE date = ? GROUP BY name", [date])
+        return {name: (first, last, sightings) for name, first, last, sightings in rows}
+
+    def days_present(self, names, chunk_size=500):
+        # {name: distinct dates with a sighting}, chunked under SQLite's bound parameter limit
+        names = list(names)
+        counts = {}
+        for start in range(0, len(names), chunk_size):
+            chunk = names[start:start + chunk_size]
+            placeholders = ", ".join("?" * len(chunk))
+            counts.update(self.read(f"SELECT name, COUNT(DISTINCT date) FROM detections WHERE name IN ({placeholders}) GROUP BY name", chunk))
+        return counts
+
+    def read(self, sql, parameters):
+        # A separate connection per query, so reads never wait on the writer's lock
+        connection = sqlite3.connect(self.path)
+        try:
+            return connection.execute(sql, parameters).fetchall()
+        finally:
+            connection.close()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class AttendanceLog:
+    # Attendance sink shared by every stream. Repeated sightings of an identity within
+    # `debounce_seconds` are dropped, and accepted events are written in batches by a background
+    # flusher, so recording never blocks the recognition loop on disk I/O. Paths ending in .csv
+    # use the CSV backend, anything else SQLite.
+    def __init__(self, path="attendance.db", debounce_seconds=60.0, flush_interval=2.0):
+        self.backend = CsvAttendanceBackend(path) if path.lower().endswith(".csv") else SqliteAttendanceBackend(path)
+        self.debounce_seconds = debounce_seconds
+        self.flush_interval = flush_interval
+        self.last_logged = {}
+        self.pending = []
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.flusher = Thread(target=self.flush_loop, name="attendance-flusher", daemon=True)
+        self.flusher.start()
+        atexit.register(self.close)
+
+    def record(self, name, timestamp=None, source=None):
+        # Returns True if the sighting was logged, False if it was debounced
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            last = self.last_logged.get(name)
+            if last is not None and abs(timestamp - last) < self.debounce_seconds:
+                return False
+            self.last_logged[name] = timestamp
+            local_time = time.localtime(timestamp)
+            self.pending.append((name, time.strftime('%Y-%m-%d', local_time), time.strftime('%H:%M:%S', local_time), source))
+        return True
+
+    def flush(self):
+        with self.lock:
+            events, self.pending = self.pending, []
+        if events:
+            with self.write_lock:
+                try:
+                    self.backend.write(events)
+                except Exception as error:
+                    print(f"Could not write {len(events)} attendance events: {error}")
+
+    def flush_loop(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+
+    def query(self, name=None, date=None, limit=None, offset=0):
+        # Rows of (name, date, time, source), oldest first
+        self.flush()
+        return self.backend.query(name, date, limit, offset)
+
+    def day_summary(self, date):
+        # {name: (first time, last time, sightings)} for everyone seen on `date` ('%Y-%m-%d')
+        self.flush()
+        return self.backend.day_summary(date)
+
+    def days_present(self, names):
+        # {name: number of dates with at least one sighting}; names never seen are left out
+        self.flush()
+        return self.backend.days_present(names)
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.flush()
+        self.backend.close()
+
+
+class SnapshotWriter:
+    # Saves trespasser snapshots off the recognition loop: a face crop in the trespassers folder
+    # plus an optional downscaled context frame under context/ with the same file name. Each
+    # track gets at most one snapshot per `min_interval` seconds, the queue is bounded (extra
+    # snapshots are dropped), and the folder is kept under `quota_bytes` and `retention_days`
+    # by deleting the oldest snapshots first.
+    FORMATS = {"jpg": cv2.IMWRITE_JPEG_QUALITY, "webp": cv2.IMWRITE_WEBP_QUALITY}
+
+    def __init__(self, folder, image_format="jpg", quality=85, context_width=640, face_margin=0.4,
+                 min_interval=30.0, max_queue=32, quota_bytes=2 * 1024 ** 3, retention_days=30):
+        if image_format not in self.FORMATS:
+            raise ValueError(f"Unsupported snapshot format {image_format!r}, expected one of {tuple(self.FORMATS)}")
+        self.folder = folder
+        self.context_folder = os.path.join(folder, "context")
+        self.image_format = image_format
+        self.quality = quality
+        self.context_width = context_width
+        self.face_margin = face_margin
+        self.min_interval = min_interval
+        self.quota_bytes = quota_bytes
+        self.retention_days = retention_days
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.last_snapshot = {}
+        self.dropped = 0
+        self.written = 0
+        # Snapshots lost to write errors (a full disk, an unwritable folder); the thread carries on
+        self.failed = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.context_folder, exist_ok=True)
+        self.usage = sum(os.path.getsize(path) for path in self.snapshot_files())
+        self.thread = Thread(target=self.writer_loop, name="snapshot-writer", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def context_path(snapshot_path):
+        folder, filename = os.path.split(snapshot_path)
+        return os.path.join(folder, "context", filename)
+
+    def snapshot_files(self):
+        for folder in (self.folder, self.context_folder):
+            for filename in os.listdir(folder):
+                path = os.path.join(folder, filename)
+                if filename.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(path):
+                    yield path
+
+    def submit(self, frame, box, track_key, timestamp=None, wait=False):
+        # Called from the match thread with a BGR frame; returns True if a snapshot was queued.
+        # Offline analysis passes wait=True to block for room instead of dropping the snapshot
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            last = self.last_snapshot.get(track_key)
+            if last is not None and timestamp - last < self.min_interval:
+                return False
+            self.last_snapshot[track_key] = timestamp
+            # Forget tracks that have been quiet for a while
+            if len(self.last_snapshot) > 1024:
+                self.last_snapshot = {key: value for key, value in self.last_snapshot.items() if timestamp - value < self.min_interval}
+        top, right, bottom, left = box
+        margin_y, margin_x = int((bottom - top) * self.face_margin), int((right - left) * self.face_margin)
+        height, width = frame.shape[:2]
+        # Both copies are taken now, since the caller keeps drawing on the frame
+        face = frame[max(0, top - margin_y):min(height, bottom + margin_y), max(0, left - margin_x):min(width, right + margin_x)].copy()
+        context = None
+        if self.context_width:
+            scale = min(1.0, self.context_width / width)
+            context = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        try:
+            self.queue.put((timestamp, track_key, face, context), block=wait)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def writer_loop(self):
+        last_cleanup = 0.0
+        while True:
+            try:
+                item = self.queue.get(timeout=60)
+            except queue.Empty:
+                item = None
+            if item is not None:
+                try:
+                    self.write(*item)
+                except Exception as error:
+                    self.failed += 1
+                    print(f"Could not write trespasser snapshot: {error}")
+                finally:
+                    self.queue.task_done()
+            if time.monotonic() - last_cleanup > 600 or self.usage > self.quota_bytes:
+                try:
+                    self.enforce_limits()
+                except Exception as error:
+                    print(f"Snapshot retention failed: {error}")
+                last_cleanup = time.monotonic()
+
+    def flush(self):
+        # Blocks until every queued snapshot is on disk
+        self.queue.join()
+
+    def write(self, timestamp, track_key, face, context):
+        clock = METRICS.clock()
+        stamp = time.strftime('%Y-%m-%d_%H_%M_%S', time.localtime(timestamp))
+        milliseconds = int(timestamp * 1000) % 1000
+        track_tag = "_".join(str(part) for part in (track_key if isinstance(track_key, tuple) else (track_key,)))
+        track_tag = "".join(character if character.isalnum() else "-" for character in track_tag)
+        filename = f"trespasser_{stamp}_{milliseconds:03d}_{track_tag}.{self.image_format}"
+        parameters = [self.FORMATS[self.image_format], self.quality]
+        for folder, image in ((self.folder, face), (self.context_folder, context)):
+            if image is None or not image.size:
+                continue
+            ok, data = cv2.imencode(f".{self.image_format}", image, parameters)
+            if not ok:
+                print(f"Could not encode snapshot {filename}")
+                continue
+            path = os.path.join(folder, filename)
+            # Written under a temporary name so the dedup pass never reads a partial file
+            temporary_path = f"{path}.part"
+            with open(temporary_path, 'wb') as file:
+                file.write(data.tobytes())
+            os.replace(temporary_path, path)
+            self.usage += len(data)
+        self.written += 1
+        METRICS.stage_since(track_key[0] if isinstance(track_key, tuple) else "snapshots", "snapshot_write", clock)
+
+    def enforce_limits(self):
+        # A crop and its context image share a file name and are aged, counted and deleted as one
+        # snapshot, so neither half is ever left behind without the other
+        snapshots = collections.defaultdict(list)
+        for path in self.snapshot_files():
+            snapshots[os.path.basename(path)].append((os.path.getmtime(path), os.path.getsize(path), path))
+        cutoff = time.time() - self.retention_days * 86400
+        usage = sum(size for files in snapshots.values() for _, size, _ in files)
+        removed = 0
+        for files in sorted(snapshots.values(), key=lambda files: max(modified for modified, _, _ in files)):
+            if max(modified for modified, _, _ in files) >= cutoff and usage <= self.quota_bytes:
+                break
+            for _, size, path in files:
+                try:
+                    os.remove(path)
+                    usage -= size
+                except OSError:
+                    pass
+            removed += 1
+        self.usage = usage
+        if removed:
+            print(f"Snapshot retention: removed {removed} old trespasser snapshots")
+
+
+class FrameQueue:
+    # Bounded queue that drops the oldest item when full, so consumers always get the newest frame
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item):
+        # Returns True if an older item was dropped to make room
+        with self.condition:
+            dropped = len(self.items) >= self.maxsize
+            if dropped:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify()
+        return dropped
+
+    def get(self, timeout=None):
+        # Returns None when the queue is closed or the timeout expires
+        with self.condition:
+            if not self.items and not self.closed:
+                self.condition.wait(timeout)
+            if not self.items:
+                return None
+            return self.items.popleft()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class StageStats:
+    # Per-stage item counter and busy time, reported as throughput over a sliding window
+    def __init__(self, name, window=5.0):
+        self.name = name
+        self.window = window
+        self.lock = threading.Lock()
+        self.events = collections.deque()
+        self.count = 0
+
+    def record(self, duration):
+        now = time.monotonic()
+        with self.lock:
+            self.count += 1
+            self.events.append((now, duration))
+            while self.events and self.events[0][0] < now - self.window:
+                self.events.popleft()
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            recent = [duration for timestamp, duration in self.events if timestamp >= now - self.window]
+        fps = len(recent) / self.window
+        average_ms = 1000.0 * sum(recent) / len(recent) if recent else 0.0
+        return {'stage': self.name, 'fps': fps, 'ms': average_ms, 'count': self.count}
+
+
+class MetricsRegistry:
+    # Process-wide stage timers, frame counters and faces-per-frame histograms, labelled by stream
+    # and rendered in the Prometheus text format. It is off by default: clock() then returns None
+    # and every other call returns after one attribute check, so the instrumentation stays in
+    # the hot paths. Each consumer (overlay, log, HTTP endpoint) enables it under its own name.
+    TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    FACE_BUCKETS = (0, 1, 2, 4, 8, 16, 32)
+    HELP = {
+        'faice_stage_seconds': "Time spent per pipeline stage",
+        'faice_frames_total': "Frames grabbed, skipped, decoded, gated (static scene), processed and dropped",
+        'faice_faces_per_frame': "Faces found in each processed frame",
+        'faice_images_encoded_total': "Images encoded by dataset encoders",
+    }
+
+    def __init__(self):
+        self.enabled = False
+        self.owners = set()
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+        self.log_stop = None
+
+    def enable(self, owner="default"):
+        with self.lock:
+            self.owners.add(owner)
+            self.enabled = True
+
+    def disable(self, owner="default"):
+        with self.lock:
+            self.owners.discard(owner)
+            self.enabled = bool(self.owners)
+
+    def clock(self):
+        return time.perf_counter() if self.enabled else None
+
+    def stage_since(self, stream, stage, start):
+        # `start` is a perf_counter() reading; clock() gives None while disabled, which is ignored
+        if start is not None:
+            self.record_stage(stream, stage, time.perf_counter() - start)
+
+    def record_stage(self, stream, stage, seconds):
+        if self.enabled:
+            self.observe('faice_stage_seconds', (('stream', stream), ('stage', stage)), seconds, self.TIME_BUCKETS)
+
+    def frames(self, stream, state, count=1):
+        if self.enabled and count:
+            self.count('faice_frames_total', (('stream', stream), ('state', state)), count)
+
+    def faces(self, stream, count):
+        if self.enabled:
+            self.observe('faice_faces_per_frame', (('stream', stream),), count, self.FACE_BUCKETS)
+
+    def count(self, name, labels, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[(name, labels)] += value
+
+    def observe(self, name, labels, value, buckets):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                # Per-bucket counts (the last one is +Inf), sum, count
+                histogram = self.histograms[(name, labels)] = [buckets, [0] * (len(buckets) + 1), 0.0, 0]
+            histogram[1][bisect.bisect_left(buckets, value)] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        escaped = (
+            (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for key, value in tuple(labels) + tuple(extra)
+        )
+        return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+    def render(self):
+        # Prometheus text exposition format, version 0.0.4
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (buckets, list(counts), total, count)) for key, (buckets, counts, total, count) in self.histograms.items())
+        lines = []
+        described = set()
+        for (name, labels), value in counters:
+            if name not in described:
+                described.add(name)
+                lines += [f"# HELP {name} {self.HELP.get(name, name)}", f"# TYPE {name} counter"]
+            lines.append(f"{name}{self.format_labels(labels)} {value:g}")
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            if name not in described:
+                described.add(name)
+                lines += [f"# HELP {name} {self.HELP.get(name, name)}", f"# TYPE {name} histogram"]
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{self.format_labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{self.format_labels(labels)} {total:g}")
+            lines.append(f"{name}_count{self.format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def streams(self):
+        with self.lock:
+            keys = list(self.counters) + list(self.histograms)
+        return sorted({dict(labels)['stream'] for _, labels in keys if 'stream' in dict(labels)})
+
+    def stream_totals(self, stream):
+        # Cumulative stage (count, seconds), frame counts and (frames, faces) for one stream
+        totals = {'stages': {}, 'frames': {}, 'faces': (0, 0.0)}
+        with self.lock:
+            for (name, labels), (_, _, total, count) in self.histograms.items():
+                labels = dict(labels)
+                if labels.get('stream') != stream:
+                    continue
+                if name == 'faice_stage_seconds':
+                    totals['stages'][labels['stage']] = (count, total)
+                elif name == 'faice_faces_per_frame':
+                    totals['faces'] = (count, total)
+            for (name, labels), value in self.counters.items():
+                labels = dict(labels)
+                if name == 'faice_frames_total' and labels.get('stream') == stream:
+                    totals['frames'][labels['state']] = int(value)
+        return totals
+
+    @staticmethod
+    def describe(current, previous=None):
+        # One line per group, covering what happened since `previous` (or since enabling)
+        previous = previous or {'stages': {}, 'frames': {}, 'faces': (0, 0.0)}
+        stages = []
+        for stage, (count, total) in current['stages'].items():
+            before_count, before_total = previous['stages'].get(stage, (0, 0.0))
+            if count > before_count:
+                stages.append(f"{stage} {1000.0 * (total - before_total) / (count - before_count):.1f} ms")
+        frames = " ".join(f"{state} {value - previous['frames'].get(state, 0)}" for state, value in sorted(current['frames'].items()))
+        processed = current['faces'][0] - previous['faces'][0]
+        faces = (current['faces'][1] - previous['faces'][1]) / processed if processed else 0.0
+        return [" | ".join(stages) or "no stage timings yet", f"frames {frames or 'none'} | {faces:.1f} faces/frame"]
+
+    def start_log(self, interval=10.0):
+        # Prints every stream's stage times and frame counts for each `interval`
+        if self.log_stop is not None:
+            return
+        self.enable("log")
+        self.log_stop = threading.Event()
+        Thread(target=self.log_loop, args=(interval, self.log_stop), name="metrics-log", daemon=True).start()
+
+    def stop_log(self):
+        if self.log_stop is not None:
+            self.log_stop.set()
+            self.log_stop = None
+            self.disable("log")
+
+    def log_loop(self, interval, stop):
+        previous = {}
+        while not stop.wait(interval):
+            for stream in self.streams():
+                current = self.stream_totals(stream)
+                print(f"[metrics] {stream}: " + " | ".join(self.describe(current, previous.get(stream))))
+                previous[stream] = current
+
+
+METRICS = MetricsRegistry()
+
+
+class FaceDetector:
+    # Detection runs on a downscaled copy of the frame and the boxes are mapped back to the
+    # input resolution, so encoding still sees full-resolution faces. HOG at half scale is the
+    # cheap default; CNN is far more robust but only practical on a GPU or at a small scale.
+    MODELS = ("hog", "cnn")
+
+    def __init__(self, model="hog", scale=0.5, upsample=1):
+        if model not in self.MODELS:
+            raise ValueError(f"Unknown detector model {model!r}, expected one of {self.MODELS}")
+        if not 0 < scale <= 1:
+            raise ValueError(f"Detector scale must be in (0, 1], got {scale}")
+        self.model = model
+        self.scale = scale
+        self.upsample = upsample
+
+    def __repr__(self):
+        return f"{self.model}:{self.scale:g}:{self.upsample}"
+
+    @classmethod
+    def parse(cls, setting):
+        # Inverse of repr(): "model:scale:upsample", e.g. "hog:0.5:1"
+        model, scale, upsample = setting.split(":")
+        return cls(model, float(scale), int(upsample))
+
+    def detect(self, rgb_frame):
+        if self.scale == 1:
+            return face_recognition.face_locations(rgb_frame, number_of_times_to_upsample=self.upsample, model=self.model)
+        small_frame = cv2.resize(rgb_frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        small_locations = face_recognition.face_locations(small_frame, number_of_times_to_upsample=self.upsample, model=self.model)
+        return self.scale_up(small_locations, rgb_frame.shape)
+
+    def detect_batch(self, rgb_frames):
+        # Same-sized frames go through the CNN detector as a single dlib batch; HOG has no
+        # batched path, and mixed sizes cannot share one
+        if self.model != "cnn" or len({frame.shape for frame in rgb_frames}) != 1:
+            return [self.detect(frame) for frame in rgb_frames]
+        if self.scale != 1:
+            small_frames = [cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA) for frame in rgb_frames]
+        else:
+            small_frames = list(rgb_frames)
+        batches = face_recognition.batch_face_locations(small_frames, number_of_times_to_upsample=self.upsample, batch_size=len(small_frames))
+        return [self.scale_up(locations, frame.shape) for locations, frame in zip(batches, rgb_frames)]
+
+    def scale_up(self, small_locations, shape):
+        if self.scale == 1:
+            return list(small_locations)
+        height, width = shape[:2]
+        return [
+            (max(0, int(top / self.scale)), min(width, int(right / self.scale)),
+             min(height, int(bottom / self.scale)), max(0, int(left / self.scale)))
+            for top, right, bottom, left in small_locations
+        ]
+
+
+class FaceTrack:
+    def __init__(self, track_id, box, now):
+        self.track_id = track_id
+        # (top, right, bottom, left) as returned by face_recognition.face_locations
+        self.box = box
+        self.name = None
+        self.distance = None
+        self.first_seen = now
+        self.last_seen = now
+        self.last_encoded = None
+        self.missed = 0
+
+
+class FaceTracker:
+    # Associates each frame's face boxes with existing tracks: greedy by IoU first, then by
+    # centroid distance (relative to face size) for fast movers the low frame rate can't overlap.
+    # A track only asks for a fresh encoding when it is new, still unidentified, or due to be
+    # re-verified, so a person standing in view is encoded once every `reverify_interval` seconds.
+    def __init__(self, iou_threshold=0.3, centroid_threshold=0.6, max_missed=2, reverify_interval=5.0, retry_interval=1.0):
+        self.iou_threshold = iou_threshold
+        self.centroid_threshold = centroid_threshold
+        self.max_missed = max_missed
+        self.reverify_interval = reverify_interval
+        self.retry_interval = retry_interval
+        self.tracks = []
+        self.next_track_id = 1
+
+    def affinity(self, track_boxes, face_boxes):
+        # IoU for overlapping boxes; otherwise a score below the IoU threshold that decays with
+        # centroid distance, so overlap always wins
+        tracks = np.asarray(track_boxes, dtype=np.float32).reshape(-1, 1, 4)
+        faces = np.asarray(face_boxes, dtype=np.float32).reshape(1, -1, 4)
+        height = np.minimum(tracks[..., 2], faces[..., 2]) - np.maximum(tracks[..., 0], faces[..., 0])
+        width = np.minimum(tracks[..., 1], faces[..., 1]) - np.maximum(tracks[..., 3], faces[..., 3])
+        intersection = np.clip(height, 0, None) * np.clip(width, 0, None)
+        track_area = (tracks[..., 2] - tracks[..., 0]) * (tracks[..., 1] - tracks[..., 3])
+        face_area = (faces[..., 2] - faces[..., 0]) * (faces[..., 1] - faces[..., 3])
+        iou = intersection / np.maximum(track_area + face_area - intersection, 1.0)
+        offset_y = (tracks[..., 0] + tracks[..., 2] - faces[..., 0] - faces[..., 2]) / 2
+        offset_x = (tracks[..., 1] + tracks[..., 3] - faces[..., 1] - faces[..., 3]) / 2
+        offset = np.hypot(offset_y, offset_x) / np.maximum(np.sqrt(track_area), 1.0)
+        nearby = np.clip(1.0 - offset / self.centroid_threshold, 0.0, None) * self.iou_threshold * 0.99
+        return np.where(iou >= self.iou_threshold, iou, nearby)
+
+    def update(self, face_locations, now):
+        # Returns (track per face, indices of faces to encode, tracks that were lost)
+        assigned = [None] * len(face_locations)
+        if self.tracks and face_locations:
+            scores = self.affinity([track.box for track in self.tracks], face_locations)
+            # Greedy assignment, best pairs first
+            for flat in np.argsort(scores, axis=None)[::-1]:
+                track_index, face_index = np.unravel_index(flat, scores.shape)
+                if scores[track_index, face_index] <= 0:
+                    break
+                track = self.tracks[track_index]
+                if assigned[face_index] is None and track not in assigned:
+                    assigned[face_index] = track
+                    track.box = face_locations[face_index]
+                    track.last_seen = now
+                    track.missed = 0
+        lost = []
+        for track in self.tracks:
+            if track not in assigned:
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    lost.append(track)
+        self.tracks = [track for track in self.tracks if track not in lost]
+        for face_index, location in enumerate(face_locations):
+            if assigned[face_index] is None:
+                track = FaceTrack(self.next_track_id, location, now)
+                self.next_track_id += 1
+                self.tracks.append(track)
+                assigned[face_index] = track
+        to_encode = []
+        for face_index, track in enumerate(assigned):
+            if track.last_encoded is None:
+                due = True
+            elif track.name in (None, "Unknown"):
+                # Matchers name unmatched faces "Unknown"; they are retried as often as unnamed ones
+                due = now - track.last_encoded >= self.retry_interval
+            else:
+                due = now - track.last_encoded >= self.reverify_interval
+            if due:
+                track.last_encoded = now
+                to_encode.append(face_index)
+        return assigned, to_encode, lost
+
+
+class VideoSource:
+    # Capture layer for a webcam port (int), a video file or a network stream (an RTSP/HTTP URL or
+    # a GStreamer pipeline). A grabber thread grab()s every frame as it arrives, so the capture
+    # buffer never backs up and adds lag, but only retrieve()s the frames `should_decode(now)`
+    # asks for; the others are never converted into BGR images. Lost live sources are reopened
+    # with exponential backoff. Files are paced to their native frame rate and looped, so they
+    # can stand in for cameras.
+    #   transport              "tcp" (no frames smeared by lost UDP packets) or "udp", for RTSP
+    #   buffer_size            network receive buffer in bytes
+    #   keyframes_only         asks FFmpeg to skip decoding non-key frames. FFmpeg decodes inside
+    #                          grab(), so this is what saves decode time rather than conversion
+    #   backend                "ffmpeg" (options via OPENCV_FFMPEG_CAPTURE_OPTIONS) or "gstreamer"
+    #                          (a pipeline ending in a one-buffer, dropping appsink)
+    #   hardware_acceleration  any available hardware decoder, on OpenCV 4.5.2 and later
+    OPTIONS = ("transport", "buffer_size", "keyframes_only", "backend", "hardware_acceleration")
+    BACKENDS = ("ffmpeg", "gstreamer")
+    # OpenCV reads FFmpeg options from the environment, so sources are opened one at a time
+    ffmpeg_options_lock = threading.Lock()
+
+    def __init__(self, source, transport="tcp", buffer_size=None, keyframes_only=False, backend="ffmpeg",
+                 hardware_acceleration=False, min_backoff=0.5, max_backoff=30.0, name=None):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown capture backend {backend!r}, expected one of {self.BACKENDS}")
+        if transport not in ("tcp", "udp"):
+            raise ValueError(f"Unknown RTSP transport {transport!r}, expected 'tcp' or 'udp'")
+        self.source = source
+        self.is_file = not isinstance(source, int) and os.path.isfile(source)
+        self.transport = transport
+        self.buffer_size = buffer_size
+        self.keyframes_only = keyframes_only
+        self.backend = backend
+        self.hardware_acceleration = hardware_acceleration
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.name = name or str(source)
+        self.capture = None
+        self.pace_fps = None
+        self.on_frame = None
+        self.should_decode = None
+        self.stopped = threading.Event()
+        self.thread = None
+        self.started = None
+        self.grabbed = 0
+        self.decoded = 0
+        self.skipped = 0
+        self.reconnects = 0
+        self.grab_seconds = 0.0
+        self.retrieve_seconds = 0.0
+
+    def ffmpeg_options(self):
+        options = []
+        if str(self.source).lower().startswith("rtsp"):
+            options.append(f"rtsp_transport;{self.transport}")
+        if self.buffer_size:
+            options.append(f"buffer_size;{int(self.buffer_size)}")
+        if self.keyframes_only:
+            options.append("skip_frame;nokey")
+        return "|".join(options)
+
+    def gstreamer_pipeline(self):
+        if "!" in self.source:
+            return self.source
+        if self.source.lower().startswith("rtsp"):
+            source = f"rtspsrc location={self.source} latency=0 protocols={self.transport} ! decodebin"
+        else:
+            source = f"uridecodebin uri={self.source}"
+        return f"{source} ! videoconvert ! video/x-raw,format=BGR ! appsink drop=true max-buffers=1 sync=false"
+
+    def open(self):
+        # Returns an opened cv2.VideoCapture, or None
+        params = []
+        if self.hardware_acceleration and hasattr(cv2, "CAP_PROP_HW_ACCELERATION"):
+            params = [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+        if isinstance(self.source, int):
+            capture = cv2.VideoCapture(self.source)
+            # Drivers that support it queue one frame instead of several
+            capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        elif self.is_file:
+            capture = cv2.VideoCapture(self.source, cv2.CAP_ANY, params) if params else cv2.VideoCapture(self.source)
+        elif self.backend == "gstreamer":
+            capture = cv2.VideoCapture(self.gstreamer_pipeline(), cv2.CAP_GSTREAMER)
+        else:
+            with self.ffmpeg_options_lock:
+                previous = os.environ.get("OPENCV_FFMPEG_CAPTURE_OPTIONS")
+                os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = self.ffmpeg_options()
+                try:
+                    capture = cv2.VideoCapture(self.source, cv2.CAP_FFMPEG, params) if params else cv2.VideoCapture(self.source, cv2.CAP_FFMPEG)
+                finally:
+                    if previous is None:
+                        os.environ.pop("OPENCV_FFMPEG_CAPTURE_OPTIONS", None)
+                    else:
+                        os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = previous
+        if not capture.isOpened():
+            capture.release()
+            return None
+        if self.is_file:
+            self.pace_fps = capture.get(cv2.CAP_PROP_FPS) or 25
+        return capture
+
+    def connect(self):
+        # Opens the source now, so a bad source can be reported; the grabber retries otherwise
+        if self.capture is None:
+            self.capture = self.open()
+        return self.capture is not None
+
+    def start(self, on_frame, should_decode=None):
+        # on_frame(frame, seconds spent grabbing and retrieving it) runs on the grabber thread
+        self.on_frame = on_frame
+        self.should_decode = should_decode
+        self.started = time.monotonic()
+        self.thread = Thread(target=self.grab_loop, name=f"grab-{self.name}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is None:
+            if self.capture is not None:
+                self.capture.release()
+                self.capture = None
+        elif self.thread is not threading.current_thread():
+            # The grabber releases the capture itself, even if a blocking grab() outlasts the join
+            self.thread.join(timeout=2)
+
+    def grab_loop(self):
+        backoff = self.min_backoff
+        next_grab = time.monotonic()
+        while not self.stopped.is_set():
+            if self.capture is None:
+                self.capture = self.open()
+                if self.capture is None:
+                    print(f"Could not open {self.name}, retrying in {backoff:.1f}s")
+                    self.stopped.wait(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+                backoff = self.min_backoff
+                next_grab = time.monotonic()
+            if self.pace_fps:
+                # Files are paced to their native rate so they behave like a live camera
+                next_grab += 1.0 / self.pace_fps
+                self.stopped.wait(max(0.0, next_grab - time.monotonic()))
+            start = time.perf_counter()
+            ok = self.capture.grab()
+            if not ok and self.is_file:
+                # Files stand in for cameras, so loop them instead of ending the stream
+                self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ok = self.capture.grab()
+            if not ok:
+                print(f"Lost {self.name}, reconnecting")
+                self.capture.release()
+                self.capture = None
+                self.reconnects += 1
+                continue
+            grab_duration = time.perf_counter() - start
+            self.grabbed += 1
+            self.grab_seconds += grab_duration
+            METRICS.record_stage(self.name, "grab", grab_duration)
+            METRICS.frames(self.name, "grabbed")
+            if self.should_decode is not None and not self.should_decode(time.monotonic()):
+                self.skipped += 1
+                METRICS.frames(self.name, "skipped")
+                continue
+            start = time.perf_counter()
+            ok, frame = self.capture.retrieve()
+            retrieve_duration = time.perf_counter() - start
+            if not ok:
+                continue
+            self.decoded += 1
+            self.retrieve_seconds += retrieve_duration
+            METRICS.record_stage(self.name, "retrieve", retrieve_duration)
+            METRICS.frames(self.name, "decoded")
+            self.on_frame(frame, grab_duration + retrieve_duration)
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+    def capture_stats(self):
+        # The CPU saved is estimated from the mean cost of the frames that were retrieved
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        mean_retrieve = self.retrieve_seconds / self.decoded if self.decoded else 0.0
+        return {
+            'grabbed': self.grabbed,
+            'decoded': self.decoded,
+            'skipped': self.skipped,
+            'reconnects': self.reconnects,
+            'grab_ms': 1000.0 * self.grab_seconds / self.grabbed if self.grabbed else 0.0,
+            'retrieve_ms': 1000.0 * mean_retrieve,
+            'decode_saved_percent': 100.0 * self.skipped * mean_retrieve / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+class MotionGate:
+    # Cheap change detector for idle cameras, run on the grabber thread before a frame is queued
+    # for detection: a blurred grayscale copy `width` pixels wide is compared with a running-average
+    # background. update() returns the bounding box, in source coordinates and padded by `margin`,
+    # of everything that changed, or None for a static scene, so detection can skip the frame or
+    # be limited to the part that moved. `min_area` is the fraction of pixels that must change.
+    def __init__(self, width=160, threshold=25, min_area=0.002, learning_rate=0.05, margin=0.25):
+        self.width = width
+        self.threshold = threshold
+        self.min_area = min_area
+        self.learning_rate = learning_rate
+        self.margin = margin
+        self.background = None
+
+    def update(self, frame):
+        height, width = frame.shape[:2]
+        scale = self.width / width
+        small_frame = cv2.resize(frame, (self.width, max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+        gray = cv2.GaussianBlur(cv2.cvtColor(small_frame, cv2.COLOR_BGR2GRAY), (5, 5), 0).astype(np.float32)
+        if self.background is None or self.background.shape != gray.shape:
+            # Nothing to compare against yet, so everything counts as changed
+            self.background = gray
+            return 0, width, height, 0
+        changed = cv2.absdiff(gray, self.background) > self.threshold
+        cv2.accumulateWeighted(gray, self.background, self.learning_rate)
+        if changed.mean() < self.min_area:
+            return None
+        rows = np.flatnonzero(changed.any(axis=1))
+        columns = np.flatnonzero(changed.any(axis=0))
+        margin_y = (rows[-1] - rows[0] + 1) * self.margin
+        margin_x = (columns[-1] - columns[0] + 1) * self.margin
+        return (max(0, int((rows[0] - margin_y) / scale)), min(width, int((columns[-1] + 1 + margin_x) / scale)),
+                min(height, int((rows[-1] + 1 + margin_y) / scale)), max(0, int((columns[0] - margin_x) / scale)))
+
+
+class RecognitionWorkerPool:
+    # Fixed set of detection/encoding workers shared by every registered stream, so N cameras
+    # never run more than `workers` CNN passes at once. Free workers serve streams round-robin,
+    # and a stream is only eligible when it has a frame, is below its in-flight cap and its
+    # FPS target says the next frame is due.
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.pipelines = []
+        self.next_index = 0
+        self.condition = threading.Condition()
+        self.running = False
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        for number in range(self.workers):
+            Thread(target=self.worker_loop, name=f"recognition-{number}", daemon=True).start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def register(self, pipeline):
+        with self.condition:
+            self.pipelines.append(pipeline)
+            self.condition.notify_all()
+
+    def unregister(self, pipeline):
+        with self.condition:
+            if pipeline in self.pipelines:
+                self.pipelines.remove(pipeline)
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify()
+
+    def detect(self, detector, rgb_frame):
+        # Called by RecognitionPipeline on a worker thread; DistributedWorkerPool runs it elsewhere
+        return detector.detect(rgb_frame)
+
+    def encode(self, rgb_frame, face_locations):
+        # Always follows a detect() on the same thread and frame
+        return face_recognition.face_encodings(rgb_frame, face_locations, model="cnn")
+
+    def worker_stats(self):
+        return {'local_workers': self.workers, 'remote_workers': [], 'failovers': 0}
+
+    def next_job(self, active=None):
+        # `active()` turning False makes the calling worker exit instead of taking another frame
+        with self.condition:
+            while self.running and (active is None or active()):
+                now = time.monotonic()
+                wait = 0.5
+                count = len(self.pipelines)
+                for offset in range(count):
+                    pipeline = self.pipelines[(self.next_index + offset) % count]
+                    delay = pipeline.time_until_due(now)
+                    if delay <= 0:
+                        item = pipeline.take_frame(now)
+                        if item is not None:
+                            # Resume the scan after this stream next time, so every camera gets a turn
+                            self.next_index = (self.next_index + offset + 1) % count
+                            return pipeline, item
+                    else:
+                        wait = min(wait, delay)
+                self.condition.wait(wait)
+        return None, None
+
+    def worker_loop(self, active=None):
+        while True:
+            pipeline, item = self.next_job(active)
+            if pipeline is None:
+                return
+            try:
+                pipeline.process(*item)
+            except Exception as error:
+                print(f"Recognition worker failed: {error}")
+            finally:
+                with self.condition:
+                    pipeline.in_flight -= 1
+                    self.condition.notify_all()
+
+
+class WorkerLost(Exception):
+    # A remote recognition worker disconnected or stopped answering
+    pass
+
+
+class RemoteWorkerError(Exception):
+    # The worker answered, but the model failed there
+    pass
+
+
+class WorkerProtocol:
+    # Binary framing between DistributedWorkerPool and run_recognition_worker. Every message is a
+    # (type, slot, payload length) header and a payload. Frames go as raw RGB bytes after a
+    # DETECT_HEADER, or only as the name of a shared-memory buffer when the worker is on the same
+    # host; ENCODE names no frame and reuses the one the slot last detected on. Boxes travel as
+    # int32 and encodings as float32, each after a uint16 count. HELLO, WELCOME and PONG carry JSON.
+    HEADER = struct.Struct("!BHI")
+    HELLO, WELCOME, DETECT, ENCODE, RESULT, ERROR, PING, PONG = range(1, 9)
+    # Frame height and width, detector scale, model index, upsample, shared-memory name length
+    DETECT_HEADER = struct.Struct("!HHfBBB")
+    COUNT = struct.Struct("!H")
+
+    @classmethod
+    def send(cls, connection, kind, slot, *parts):
+        connection.sendall(cls.HEADER.pack(kind, slot, sum(len(part) for part in parts)))
+        for part in parts:
+            if len(part):
+                connection.sendall(part)
+
+    @classmethod
+    def receive(cls, connection):
+        kind, slot, length = cls.HEADER.unpack(cls.receive_exactly(connection, cls.HEADER.size))
+        return kind, slot, cls.receive_exactly(connection, length)
+
+    @staticmethod
+    def receive_exactly(connection, length):
+        # A bytearray, so frames decoded from it are writeable without a copy
+        data = bytearray(length)
+        view = memoryview(data)
+        received = 0
+        while received < length:
+            count = connection.recv_into(view[received:])
+            if not count:
+                raise ConnectionError("Connection closed")
+            received += count
+        return data
+
+    @classmethod
+    def pack_array(cls, array, dtype):
+        array = np.ascontiguousarray(array, dtype=dtype)
+        return cls.COUNT.pack(len(array)) + array.tobytes()
+
+    @classmethod
+    def unpack_array(cls, payload, dtype, width):
+        count, = cls.COUNT.unpack_from(payload)
+        return np.frombuffer(payload, dtype=dtype, count=count * width, offset=cls.COUNT.size).reshape(count, width)
+
+
+class RemoteWorker:
+    # Coordinator side of one worker connection. A reader thread routes each reply to the slot
+    # waiting for it; every slot has its own shared-memory frame buffer (for same-host workers),
+    # only ever touched by the pool thread serving that slot.
+    def __init__(self, connection, address, hello, shared_memory):
+        self.connection = connection
+        self.address = address
+        self.name = hello.get('name') or f"{address[0]}:{address[1]}"
+        self.slots = max(1, int(hello.get('slots', 1)))
+        self.shared_memory = shared_memory
+        self.send_lock = threading.Lock()
+        self.replies = [queue.Queue() for _ in range(self.slots)]
+        self.buffers = [None] * self.slots
+        self.alive = True
+        self.last_seen = time.monotonic()
+        # Host load per core and busy slots, from the worker's last heartbeat
+        self.load = 0.0
+        self.busy = 0
+        self.jobs = 0
+        self.busy_seconds = 0.0
+
+    def active_slots(self):
+        # Load-aware dispatch: a host busy with other work serves fewer slots
+        if self.load <= 1.0:
+            return self.slots
+        return max(1, int(self.slots / self.load))
+
+    def send(self, kind, slot, *parts):
+        try:
+            with self.send_lock:
+                WorkerProtocol.send(self.connection, kind, slot, *parts)
+        except OSError as error:
+            self.lose()
+            raise WorkerLost(f"{self.name}: {error}")
+
+    def read_loop(self):
+        try:
+            while self.alive:
+                kind, slot, payload = WorkerProtocol.receive(self.connection)
+                self.last_seen = time.monotonic()
+                if kind == WorkerProtocol.PONG:
+                    status = json.loads(payload)
+                    self.load, self.busy = float(status.get('load', 0.0)), int(status.get('busy', 0))
+                elif kind in (WorkerProtocol.RESULT, WorkerProtocol.ERROR) and slot < self.slots:
+                    self.replies[slot].put((kind, payload))
+        except (OSError, ValueError, struct.error):
+            pass
+        finally:
+            self.lose()
+
+    def lose(self):
+        if not self.alive:
+            return
+        self.alive = False
+        try:
+            self.connection.close()
+        except OSError:
+            pass
+        # Wakes every slot waiting for a reply
+        for replies in self.replies:
+            replies.put(None)
+
+    def call(self, slot, kind, parts, timeout):
+        start = time.perf_counter()
+        self.send(kind, slot, *parts)
+        try:
+            reply = self.replies[slot].get(timeout=timeout)
+        except queue.Empty:
+            self.lose()
+            raise WorkerLost(f"{self.name} did not answer within {timeout:g} s")
+        if reply is None:
+            raise WorkerLost(f"{self.name} disconnected")
+        reply_kind, payload = reply
+        if reply_kind == WorkerProtocol.ERROR:
+            raise RemoteWorkerError(f"{self.name}: {payload.decode('utf-8', 'replace')}")
+        self.jobs += kind == WorkerProtocol.DETECT
+        self.busy_seconds += time.perf_counter() - start
+        return payload
+
+    def detect(self, slot, detector, rgb_frame, timeout):
+        rgb_frame = np.ascontiguousarray(rgb_frame, dtype=np.uint8)
+        height, width = rgb_frame.shape[:2]
+        name, frame_bytes = b"", memoryview(rgb_frame).cast('B')
+        if self.shared_memory:
+            buffer = self.buffers[slot]
+            if buffer is None or buffer.size < rgb_frame.nbytes:
+                self.release(slot)
+                buffer = self.buffers[slot] = shared_memory.SharedMemory(create=True, size=rgb_frame.nbytes)
+            np.ndarray(rgb_frame.shape, np.uint8, buffer=buffer.buf)[:] = rgb_frame
+            name, frame_bytes = buffer.name.encode('ascii'), b""
+        header = WorkerProtocol.DETECT_HEADER.pack(height, width, detector.scale, FaceDetector.MODELS.index(detector.model),
+                                                   detector.upsample, len(name))
+        payload = self.call(slot, WorkerProtocol.DETECT, (header, name, frame_bytes), timeout)
+        return [tuple(int(value) for value in box) for box in WorkerProtocol.unpack_array(payload, '>i4', 4)]
+
+    def encode(self, slot, face_locations, timeout):
+        payload = self.call(slot, WorkerProtocol.ENCODE, (WorkerProtocol.pack_array(np.reshape(face_locations, (-1, 4)), '>i4'),), timeout)
+        return list(WorkerProtocol.unpack_array(payload, '>f4', ENCODING_SIZE).astype(np.float32))
+
+    def release(self, slot):
+        buffer, self.buffers[slot] = self.buffers[slot], None
+        if buffer is not None:
+            buffer.close()
+            buffer.unlink()
+
+    def stats(self):
+        return {
+            'name': self.name, 'address': f"{self.address[0]}:{self.address[1]}", 'alive': self.alive,
+            'transport': "shared memory" if self.shared_memory else "tcp", 'slots': self.slots,
+            'active_slots': self.active_slots(), 'busy': self.busy, 'load': self.load, 'jobs': self.jobs,
+            'mean_ms': 1000.0 * self.busy_seconds / self.jobs if self.jobs else 0.0,
+        }
+
+
+class DistributedWorkerPool(RecognitionWorkerPool):
+    # A RecognitionWorkerPool whose detection and encoding can run in worker processes on this or
+    # other hosts (run_recognition_worker, `server.py worker`). Workers register over TCP at
+    # `port`; each of their slots is a pool thread that pulls frames like a local worker, so a
+    # worker only gets frames while it has a free slot and faster workers take more of them.
+    # Same-host workers get frames through shared memory, others over the socket. Workers are
+    # pinged every `heartbeat_interval` seconds and dropped after `heartbeat_timeout` seconds of
+    # silence; a frame whose worker is lost mid-job is finished in this process, so no frame is
+    # lost. `local_workers` threads also run the models here, as a plain pool would.
+    def __init__(self, host="0.0.0.0", port=7070, local_workers=0, heartbeat_interval=2.0, heartbeat_timeout=6.0,
+                 call_timeout=30.0):
+        super().__init__(local_workers)
+        self.host = host
+        self.port = port
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.call_timeout = call_timeout
+        self.remote_workers = []
+        self.failovers = 0
+        self.local = threading.local()
+        self.listener = None
+
+    def start(self):
+        super().start()
+        if self.listener is not None:
+            return
+        self.listener = socket.create_server((self.host, self.port))
+        # Port 0 picks a free port
+        self.port = self.listener.getsockname()[1]
+        self.listener.settimeout(1.0)
+        Thread(target=self.accept_loop, name="worker-registration", daemon=True).start()
+        Thread(target=self.heartbeat_loop, name="worker-heartbeat", daemon=True).start()
+        print(f"Recognition coordinator listening on {self.host}:{self.port}")
+
+    def stop(self):
+        super().stop()
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        for remote in list(self.remote_workers):
+            remote.lose()
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                connection, address = self.listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            try:
+                self.register_worker(connection, address)
+            except (OSError, ValueError, struct.error) as error:
+                print(f"Rejected recognition worker {address[0]}:{address[1]}: {error}")
+                connection.close()
+
+    def register_worker(self, connection, address):
+        connection.settimeout(self.heartbeat_timeout)
+        kind, _, payload = WorkerProtocol.receive(connection)
+        if kind != WorkerProtocol.HELLO:
+            raise ValueError(f"expected HELLO, got message type {kind}")
+        hello = json.loads(payload)
+        # Shared memory only works within one host; the hostname is the worker's claim to be on this one
+        use_shared_memory = bool(hello.get('shared_memory')) and hello.get('host') == socket.gethostname()
+        welcome = {'shared_memory': use_shared_memory, 'heartbeat_interval': self.heartbeat_interval}
+        WorkerProtocol.send(connection, WorkerProtocol.WELCOME, 0, json.dumps(welcome).encode('utf-8'))
+        connection.settimeout(None)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        remote = RemoteWorker(connection, address, hello, use_shared_memory)
+        with self.condition:
+            self.remote_workers.append(remote)
+        Thread(target=remote.read_loop, name=f"worker-{remote.name}", daemon=True).start()
+        for slot in range(remote.slots):
+            Thread(target=self.worker_loop, args=(remote, slot), name=f"recognition-{remote.name}-{slot}", daemon=True).start()
+        print(f"Recognition worker {remote.name} joined with {remote.slots} slots over {remote.stats()['transport']}")
+
+    def heartbeat_loop(self):
+        while self.running:
+            time.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            for remote in list(self.remote_workers):
+                if remote.alive and now - remote.last_seen > self.heartbeat_timeout:
+                    print(f"Recognition worker {remote.name} missed its heartbeats")
+                    remote.lose()
+                if remote.alive:
+                    try:
+                        remote.send(WorkerProtocol.PING, 0)
+                    except WorkerLost:
+                        pass
+                if not remote.alive:
+                    with self.condition:
+                        self.remote_workers.remove(remote)
+                        self.condition.notify_all()
+                    print(f"Recognition worker {remote.name} left after {remote.jobs} frames")
+
+    def worker_loop(self, remote=None, slot=0):
+        self.local.remote, self.local.slot = remote, slot
+        if remote is None:
+            return super().worker_loop()
+        try:
+            super().worker_loop(lambda: remote.alive)
+        finally:
+            remote.release(slot)
+
+    def next_job(self, active=None):
+        remote = getattr(self.local, 'remote', None)
+        if remote is not None:
+            with self.condition:
+                while self.running and remote.alive and self.local.slot >= remote.active_slots():
+                    self.condition.wait(self.heartbeat_interval)
+        return super().next_job(active)
+
+    def detect(self, detector, rgb_frame):
+        remote = getattr(self.local, 'remote', None)
+        if remote is not None and remote.alive:
+            try:
+                return remote.detect(self.local.slot, detector, rgb_frame, self.call_timeout)
+            except WorkerLost as error:
+                self.failovers += 1
+                print(f"Recognition worker lost ({error}); finishing the frame here")
+        return super().detect(detector, rgb_frame)
+
+    def encode(self, rgb_frame, face_locations):
+        remote = getattr(self.local, 'remote', None)
+        if remote is not None and remote.alive and len(face_locations):
+            try:
+                return remote.encode(self.local.slot, face_locations, self.call_timeout)
+            except WorkerLost as error:
+                self.failovers += 1
+                print(f"Recognition worker lost ({error}); finishing the frame here")
+        return super().encode(rgb_frame, face_locations)
+
+    def worker_stats(self):
+        return {'local_workers': self.workers, 'remote_workers': [remote.stats() for remote in list(self.remote_workers)],
+                'failovers': self.failovers, 'port': self.port}
+
+
+def run_recognition_worker(address, slots=None, name=None, shared_memory=True, stop=None, min_backoff=0.5, max_backoff=30.0):
+    # Worker process for a DistributedWorkerPool at (host, port): runs detection and encoding on
+    # `slots` threads until `stop` (a threading or multiprocessing Event) is set, and reconnects
+    # with exponential backoff whenever the coordinator is unreachable or goes quiet.
+    slots = slots or max(1, (os.cpu_count() or 2) // 2)
+    name = name or f"{socket.gethostname()}-{os.getpid()}"
+    backoff = min_backoff
+    while stop is None or not stop.is_set():
+        try:
+            connection = socket.create_connection(address, timeout=10)
+        except OSError as error:
+            print(f"Coordinator {address[0]}:{address[1]} unreachable ({error}), retrying in {backoff:g} s")
+            time.sleep(backoff)
+            backoff = min(max_backoff, backoff * 2)
+            continue
+        backoff = min_backoff
+        try:
+            serve_coordinator(connection, slots, name, shared_memory, stop)
+        except (OSError, ValueError, struct.error) as error:
+            print(f"Lost coordinator {address[0]}:{address[1]}: {error}")
+        finally:
+            connection.close()
+
+
+def serve_coordinator(connection, slots, name, use_shared_memory, stop):
+    hello = {'name': name, 'slots': slots, 'host': socket.gethostname(), 'shared_memory': use_shared_memory, 'pid': os.getpid()}
+    WorkerProtocol.send(connection, WorkerProtocol.HELLO, 0, json.dumps(hello).encode('utf-8'))
+    kind, _, payload = WorkerProtocol.receive(connection)
+    if kind != WorkerProtocol.WELCOME:
+        raise ValueError(f"expected WELCOME, got message type {kind}")
+    welcome = json.loads(payload)
+    # The coordinator pings every heartbeat_interval; a much longer silence means it is gone
+    connection.settimeout(4 * welcome['heartbeat_interval'])
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    print(f"Serving recognition as {name} with {slots} slots over {'shared memory' if welcome['shared_memory'] else 'tcp'}")
+    send_lock = threading.Lock()
+    # Per slot: the last detected frame (reused by ENCODE) and the attached shared-memory buffer
+    frames = [None] * slots
+    buffers = [None] * slots
+    detectors = {}
+    busy = [0]
+
+    def reply(kind, slot, *parts):
+        with send_lock:
+            WorkerProtocol.send(connection, kind, slot, *parts)
+
+    def attach(slot, buffer_name):
+        buffer = buffers[slot]
+        if buffer is None or buffer.name != buffer_name:
+            if buffer is not None:
+                # The old frame still views the buffer, and close() refuses while it does
+                frames[slot] = None
+                buffer.close()
+            # The coordinator owns (and unlinks) the buffer; tracked here, the resource tracker
+            # of this process would unlink it when the worker exits
+            if sys.version_info >= (3, 13):
+                buffer = buffers[slot] = shared_memory.SharedMemory(name=buffer_name, track=False)
+            else:
+                buffer = buffers[slot] = shared_memory.SharedMemory(name=buffer_name)
+                if os.name == "posix":
+                    resource_tracker.unregister(buffer._name, "shared_memory")
+        return buffer
+
+    def handle(kind, slot, payload):
+        busy[0] += 1
+        try:
+            if kind == WorkerProtocol.DETECT:
+                height, width, scale, model, upsample, name_length = WorkerProtocol.DETECT_HEADER.unpack_from(payload)
+                offset = WorkerProtocol.DETECT_HEADER.size
+                if name_length:
+                    buffer = attach(slot, payload[offset:offset + name_length].decode('ascii'))
+                    frame = np.ndarray((height, width, 3), np.uint8, buffer=buffer.buf)
+                else:
+                    frame = np.frombuffer(payload, np.uint8, count=height * width * 3, offset=offset).reshape(height, width, 3)
+                frames[slot] = frame
+                key = (FaceDetector.MODELS[model], round(scale, 4), upsample)
+                detector = detectors.get(key) or detectors.setdefault(key, FaceDetector(*key))
+                result = WorkerProtocol.pack_array(np.reshape(detector.detect(frame), (-1, 4)), '>i4')
+            else:
+                boxes = [tuple(int(value) for value in box) for box in WorkerProtocol.unpack_array(payload, '>i4', 4)]
+                encodings = face_recognition.face_encodings(frames[slot], boxes, model="cnn") if boxes else []
+                result = WorkerProtocol.pack_array(np.reshape(encodings, (-1, ENCODING_SIZE)), '>f4')
+            reply(WorkerProtocol.RESULT, slot, result)
+        except Exception as error:
+            reply(WorkerProtocol.ERROR, slot, str(error).encode('utf-8'))
+        finally:
+            busy[0] -= 1
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=slots, thread_name_prefix="recognition-slot")
+    try:
+        while stop is None or not stop.is_set():
+            kind, slot, payload = WorkerProtocol.receive(connection)
+            if kind == WorkerProtocol.PING:
+                load = os.getloadavg()[0] / (os.cpu_count() or 1) if hasattr(os, "getloadavg") else busy[0] / slots
+                reply(WorkerProtocol.PONG, 0, json.dumps({'busy': busy[0], 'load': load}).encode('utf-8'))
+            elif kind in (WorkerProtocol.DETECT, WorkerProtocol.ENCODE) and slot < slots:
+                executor.submit(handle, kind, slot, payload)
+    finally:
+        executor.shutdown(wait=True)
+        frames[:] = [None] * slots
+        for buffer in buffers:
+            if buffer is not None:
+                buffer.close()
+
+
+class RecognitionPipeline:
+    # Live recognition split into capture -> detect -> encode -> match -> render stages.
+    # Capture runs on the VideoSource's grabber thread, which only decodes the frames a worker
+    # is about to take or the display (if `display_fps` is set) is due to show, and only ever
+    # hands the newest frame on; detection and
+    # encoding run on a RecognitionWorkerPool (private unless one is passed in), with a
+    # FaceTracker deciding which faces actually need encoding, on a copy scaled down to
+    # `detection_width`; matching and logging run on a match thread, which passes the untouched
+    # source frame and a (box, name) per face in source coordinates to `on_result` and, if given,
+    # every track event to `on_event(stream name, event, track, name, box)`. Nothing is drawn
+    # here: displays take `latest_frame` at camera rate and draw the latest faces over it.
+    # With a `motion_gate`, frames are checked for motion `motion_fps` times a second and only
+    # queued for detection while something moves or faces are tracked, and then only the region
+    # that changed (plus the tracked faces) is searched. Tracked faces raise the rate to
+    # `active_frame_rate` (twice `frame_rate` by default); a static scene is only re-checked every
+    # `idle_interval` seconds, in case someone is sitting still.
+    STAGES = ("capture", "detect", "encode", "match", "render")
+    # Regions larger than this fraction of the frame are searched as the whole frame
+    MAX_REGION_AREA = 0.6
+
+    def __init__(self, video_source, gallery, trespassers_folder, on_result, frame_rate=2,
+                 detection_width=1344, workers=2, worker_pool=None, max_in_flight=2,
+                 display_fps=None, detector=None, tracker=None, attendance_log=None, snapshot_writer=None,
+                 on_event=None, name="stream", motion_gate=None, motion_fps=5, active_frame_rate=None,
+                 idle_interval=10.0, motion_hold=1.0):
+        self.video_source = video_source
+        self.gallery = gallery
+        self.trespassers_folder = trespassers_folder
+        self.on_result = on_result
+        self.on_event = on_event
+        # FPS target; may be changed while running
+        self.frame_rate = frame_rate
+        self.detection_width = detection_width
+        self.worker_pool = worker_pool if worker_pool is not None else RecognitionWorkerPool(workers)
+        self.owns_worker_pool = worker_pool is None
+        self.max_in_flight = max_in_flight
+        self.display_interval = 1.0 / display_fps if display_fps else None
+        self.next_display = 0.0
+        self.sequence = 0
+        self.in_flight = 0
+        self.next_due = 0.0
+        self.motion_gate = motion_gate
+        self.motion_interval = 1.0 / motion_fps
+        self.active_frame_rate = active_frame_rate
+        self.idle_interval = idle_interval
+        self.motion_hold = motion_hold
+        self.next_motion_check = 0.0
+        self.next_idle_detect = 0.0
+        self.last_motion = -float("inf")
+        # Frames the motion gate kept away from the detector, and time spent detecting and encoding
+        self.gated = 0
+        self.busy_seconds = 0.0
+        self.started = None
+        self.attendance_log = attendance_log if attendance_log is not None else AttendanceLog("detections.csv")
+        self.owns_attendance_log = attendance_log is None
+        self.snapshot_writer = snapshot_writer if snapshot_writer is not None else SnapshotWriter(trespassers_folder)
+        self.name = name
+        self.frames = FrameQueue(maxsize=1)
+        # (sequence, BGR frame) of the newest capture, for displays; frames are never modified
+        self.latest_frame = None
+        self.detector = detector if detector is not None else FaceDetector()
+        self.tracker = tracker if tracker is not None else FaceTracker()
+        self.track_lock = threading.Lock()
+        self.tracked_sequence = 0
+        self.results = queue.Queue(maxsize=2 * max_in_flight)
+        self.stale_results = 0
+        self.stats = {stage: StageStats(stage) for stage in self.STAGES}
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def start(self):
+        self.started = time.monotonic()
+        thread = Thread(target=self.match_loop, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        self.worker_pool.register(self)
+        if self.owns_worker_pool:
+            self.worker_pool.start()
+        self.video_source.start(self.on_capture, self.wants_frame)
+
+    def stop(self):
+        self.stopped.set()
+        self.video_source.stop()
+        self.worker_pool.unregister(self)
+        if self.owns_worker_pool:
+            self.worker_pool.stop()
+        self.frames.close()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout=2)
+        if self.owns_attendance_log:
+            self.attendance_log.close()
+
+    def wants_frame(self, now):
+        # Asked by the grabber for every frame: only frames a worker can take now, that the
+        # display is due to show or that the motion gate is due to check are decoded
+        if self.display_interval is not None and now >= self.next_display:
+            self.next_display = now + self.display_interval
+            return True
+        if self.stopped.is_set():
+            return False
+        if self.motion_gate is not None:
+            if now >= self.next_motion_check:
+                self.next_motion_check = now + self.motion_interval
+                return True
+            if not self.active(now):
+                return False
+        return self.in_flight < self.max_in_flight and now >= self.next_due
+
+    def active(self, now):
+        return bool(self.tracker.tracks) or now - self.last_motion < self.motion_hold
+
+    def on_capture(self, frame, duration):
+        # Runs on the grabber thread
+        self.stats["capture"].record(duration)
+        self.sequence += 1
+        self.latest_frame = (self.sequence, frame)
+        region = None
+        if self.motion_gate is not None:
+            now = time.monotonic()
+            clock = METRICS.clock()
+            motion = self.motion_gate.update(frame)
+            METRICS.stage_since(self.name, "motion", clock)
+            if motion is not None:
+                self.last_motion = now
+                region = motion
+            elif self.tracker.tracks:
+                # Nothing moved, so only the tracked faces are searched again
+                region = ()
+            elif now >= self.next_idle_detect:
+                # Periodic full-frame check of a static scene
+                region = None
+            elif not self.active(now):
+                self.gated += 1
+                METRICS.frames(self.name, "gated")
+                return
+        if self.frames.put((self.sequence, frame, region)):
+            METRICS.frames(self.name, "dropped")
+        self.worker_pool.notify()
+
+    # The two methods below are called by the worker pool with its lock held
+    def time_until_due(self, now):
+        if self.stopped.is_set() or self.in_flight >= self.max_in_flight or not len(self.frames):
+            return float("inf")
+        return self.next_due - now
+
+    def take_frame(self, now):
+        item = self.frames.get(timeout=0)
+        if item is not None:
+            frame_rate = self.frame_rate
+            if self.motion_gate is not None and self.tracker.tracks:
+                frame_rate = self.active_frame_rate or 2 * self.frame_rate
+            self.next_due = now + 1.0 / frame_rate
+            self.next_idle_detect = now + self.idle_interval
+            self.in_flight += 1
+        return item
+
+    def process(self, sequence, frame, region=None):
+        result = self.detect_and_encode(sequence, frame, region)
+        if result is None:
+            self.drop_result()
+            return
+        try:
+            self.results.put_nowait(result)
+        except queue.Full:
+            self.drop_result()
+
+    def drop_result(self):
+        self.stale_results += 1
+        METRICS.frames(self.name, "dropped")
+
+    def search_region(self, region, scale, shape):
+        # The motion region (empty when only tracked faces need searching) grown to cover every
+        # tracked face, padded by half a face for movement, in source coordinates; None means the
+        # whole frame, also when the union is most of the frame anyway
+        height, width = shape[:2]
+        boxes = [region] if region else []
+        for top, right, bottom, left in [self.to_source(track.box, scale) for track in list(self.tracker.tracks)]:
+            pad_y, pad_x = (bottom - top) // 2, (right - left) // 2
+            boxes.append((top - pad_y, right + pad_x, bottom + pad_y, left - pad_x))
+        if region is None or not boxes:
+            return None
+        top, bottom = max(0, min(box[0] for box in boxes)), min(height, max(box[2] for box in boxes))
+        left, right = max(0, min(box[3] for box in boxes)), min(width, max(box[1] for box in boxes))
+        if bottom <= top or right <= left or (bottom - top) * (right - left) > self.MAX_REGION_AREA * height * width:
+            return None
+        return top, right, bottom, left
+
+    def detect_and_encode(self, sequence, frame, region=None):
+        clock = METRICS.clock()
+        # Aspect-preserving and never upscaled; boxes are mapped back to the source frame later
+        scale = min(1.0, self.detection_width / frame.shape[1])
+        region = self.search_region(region, scale, frame.shape)
+        top, right, bottom, left = region if region is not None else (0, frame.shape[1], frame.shape[0], 0)
+        searched = frame[top:bottom, left:right]
+        small_frame = cv2.resize(searched, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else searched
+        METRICS.stage_since(self.name, "resize", clock)
+        clock = METRICS.clock()
+        # Enrollment encodes RGB images, so live faces are encoded in RGB as well
+        rgb_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
+        METRICS.stage_since(self.name, "convert", clock)
+        start = time.perf_counter()
+        region_locations = self.worker_pool.detect(self.detector, rgb_frame)
+        # Tracked in whole-frame detection coordinates; encoded from the searched region
+        offset_y, offset_x = int(top * scale), int(left * scale)
+        face_locations = [(t + offset_y, r + offset_x, b + offset_y, l + offset_x) for t, r, b, l in region_locations]
+        duration = time.perf_counter() - start
+        self.busy_seconds += duration
+        self.stats["detect"].record(duration)
+        METRICS.record_stage(self.name, "detect", duration)
+        with self.track_lock:
+            # Another worker already tracked a newer frame; this one would only be discarded
+            if sequence < self.tracked_sequence:
+                return None
+            self.tracked_sequence = sequence
+            tracks, to_encode, lost_tracks = self.tracker.update(face_locations, time.monotonic())
+        # Only new tracks and tracks due for re-verification are encoded
+        start = time.perf_counter()
+        face_encodings = []
+        if to_encode:
+            face_encodings = self.worker_pool.encode(rgb_frame, [region_locations[i] for i in to_encode])
+        duration = time.perf_counter() - start
+        self.busy_seconds += duration
+        self.stats["encode"].record(duration)
+        METRICS.record_stage(self.name, "encode", duration)
+        encoded_tracks = [tracks[i] for i in to_encode]
+        return sequence, frame, scale, face_locations, tracks, encoded_tracks, face_encodings, lost_tracks
+
+    @staticmethod
+    def to_source(box, scale):
+        # Maps a box from detection coordinates back to the source frame
+        if scale == 1:
+            return tuple(box)
+        top, right, bottom, left = box
+        return int(top / scale), int(right / scale), int(bottom / scale), int(left / scale)
+
+    def match_loop(self):
+        last_sequence = 0
+        while not self.stopped.is_set():
+            try:
+                sequence, frame, scale, face_locations, tracks, encoded_tracks, face_encodings, lost_tracks = self.results.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            # Workers can finish out of order; never show an older frame after a newer one
+            if sequence <= last_sequence:
+                self.drop_result()
+                continue
+            last_sequence = sequence
+            start = time.perf_counter()
+            events = []
+            for track, (name, distance) in zip(encoded_tracks, self.gallery.match(face_encodings)):
+                if name != track.name:
+                    events.append(("appeared" if track.name is None else "changed", track, name))
+                track.name, track.distance = name, distance
+            events.extend(("lost", track, track.name) for track in lost_tracks)
+            METRICS.stage_since(self.name, "match", start)
+            clock = METRICS.clock()
+            for event, track, name in events:
+                self.handle_track_event(event, track, name, frame, self.to_source(track.box, scale))
+            METRICS.stage_since(self.name, "events", clock)
+            faces = [(self.to_source(box, scale), track.name or "Unknown") for box, track in zip(face_locations, tracks)]
+            self.stats["match"].record(time.perf_counter() - start)
+            METRICS.frames(self.name, "processed")
+            METRICS.faces(self.name, len(face_locations))
+            self.on_result(frame, faces)
+
+    def handle_track_event(self, event, track, name, frame, box):
+        # `box` is the track's box in source frame coordinates
+        if self.on_event is not None:
+            self.on_event(self.name, event, track, name, box)
+        # Attendance and trespasser snapshots are written once per track identity, not per frame
+        if event == "lost":
+            return
+        if name == "Unknown":
+            # Cropped here, encoded and written by the snapshot writer thread, rate-limited per track
+            self.snapshot_writer.submit(frame, box, (self.name, track.track_id))
+        else:
+            # Debounced and written in the background by the attendance log
+            self.attendance_log.record(name, source=self.name)
+
+    def stream_stats(self):
+        capture = self.video_source.capture_stats()
+        return {
+            'name': self.name,
+            'target_fps': self.frame_rate,
+            'fps': self.stats["match"].snapshot()['fps'],
+            'queue_depth': len(self.frames) + self.in_flight + self.results.qsize(),
+            'dropped': self.frames.dropped + self.stale_results,
+            'skipped': capture['skipped'],
+            'decode_saved_percent': capture['decode_saved_percent'],
+            'reconnects': capture['reconnects'],
+            'gated': self.gated,
+            'duty_cycle_percent': self.duty_cycle_percent(),
+        }
+
+    def duty_cycle_percent(self):
+        # Share of wall time this stream kept a worker detecting and encoding
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        return 100.0 * self.busy_seconds / elapsed if elapsed > 0 else 0.0
+
+    def stats_text(self):
+        parts = []
+        for stage in self.STAGES:
+            snapshot = self.stats[stage].snapshot()
+            parts.append(f"{stage} {snapshot['fps']:.1f} fps / {snapshot['ms']:.0f} ms")
+        parts.append(f"dropped {self.frames.dropped}")
+        capture = self.video_source.capture_stats()
+        parts.append(f"decoded {capture['decoded']}/{capture['grabbed']} (~{capture['decode_saved_percent']:.0f}% CPU saved)")
+        parts.append(f"detector duty {self.duty_cycle_percent():.0f}%" + (f", {self.gated} static frames skipped" if self.motion_gate else ""))
+        return " | ".join(parts)
+
+
+# Offline analysis of recorded video. Each worker process gets its own copy of the gallery once,
+# through init_video_worker, so segments are detected, tracked and matched in parallel and only
+# track events travel back to the parent.
+video_worker_state = {}
+
+
+def init_video_worker(encodings, names, detector, tolerance):
+    video_worker_state['gallery'] = FaceGallery(encodings, names, tolerance=tolerance, index=IVFIndex(nprobe=8))
+    video_worker_state['detector'] = detector
+
+
+def analyze_video_segment(path, start_frame, end_frame, step, fps, detection_width=1344):
+    # Runs in a worker process. Decodes every `step`th frame of [start_frame, end_frame), or to the
+    # end of the file when end_frame is None, and tracks faces the way RecognitionPipeline does,
+    # with video time as the clock. Returns (events, sampled frames); events are (seconds into the
+    # video, event, track id, name, box, frame), and the frame is only kept for Unknown faces.
+    gallery = video_worker_state['gallery']
+    detector = video_worker_state['detector']
+    tracker = FaceTracker()
+    events = []
+    sampled = 0
+    capture = cv2.VideoCapture(path)
+    try:
+        if start_frame:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+        frame_index = start_frame
+        while end_frame is None or frame_index < end_frame:
+            # Frames between samples are grabbed but never retrieved
+            if not capture.grab():
+                break
+            frame_index += 1
+            if (frame_index - 1 - start_frame) % step:
+                continue
+            ok, frame = capture.retrieve()
+            if not ok:
+                continue
+            sampled += 1
+            seconds = (frame_index - 1) / fps
+            scale = min(1.0, detection_width / frame.shape[1])
+            small_frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else frame
+            rgb_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
+            face_locations = detector.detect(rgb_frame)
+            tracks, to_encode, _ = tracker.update(face_locations, seconds)
+            if not to_encode:
+                continue
+            face_encodings = face_recognition.face_encodings(rgb_frame, [face_locations[i] for i in to_encode], model="cnn")
+            for i, (name, distance) in zip(to_encode, gallery.match(face_encodings)):
+                track = tracks[i]
+                if name != track.name:
+                    event = "appeared" if track.name is None else "changed"
+                    box = RecognitionPipeline.to_source(track.box, scale)
+                    events.append((seconds, event, track.track_id, name, box, frame if name == "Unknown" else None))
+                track.name, track.distance = name, distance
+    finally:
+        capture.release()
+    return events, sampled
+
+
+def analyze_videos(gallery, paths, attendance_log, snapshot_writer, interval=0.5, segment_seconds=60.0, workers=None,
+                   detector=None, start_times=None, tolerance=None, progress=None, cancelled=None):
+    # Re-runs attendance on recorded footage much faster than real time: every file is split into
+    # segments of `segment_seconds` that a process pool samples every `interval` seconds of video.
+    # Sightings are logged at video time: start_times[path] (epoch seconds) plus the frame's offset.
+    # Without a start time the file's modification time minus its duration is used, since
+    # recorders finish writing the file when the recording ends. Faces are matched at the
+    # gallery's tolerance unless `tolerance` is given. Returns {path: summary}.
+    start = time.perf_counter()
+    detector = detector or FaceDetector()
+    start_times = start_times or {}
+    tasks = []
+    summaries = {}
+    for path in paths:
+        capture = cv2.VideoCapture(path)
+        if not capture.isOpened():
+            capture.release()
+            raise ValueError(f"Could not open video file {path!r}")
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25
+        frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        capture.release()
+        duration = frame_count / fps
+        step = max(1, round(interval * fps))
+        # Segments start on a sampled frame, so the samples are those of one sequential pass
+        segment_frames = max(step, int(segment_seconds * fps) // step * step)
+        starts = list(range(0, max(frame_count, 1), segment_frames))
+        for index, start_frame in enumerate(starts):
+            end_frame = starts[index + 1] if index + 1 < len(starts) else None
+            tasks.append((path, start_frame, end_frame, step, fps))
+        summaries[path] = {
+            'duration': duration, 'start_time': start_times.get(path, os.path.getmtime(path) - duration),
+            'segments': len(starts), 'sampled': 0, 'attendance': 0, 'snapshots': 0,
+        }
+    with gallery.lock:
+        initargs = (np.array(gallery.matrix), list(gallery.names), detector,
+                    gallery.tolerance if tolerance is None else tolerance)
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    executor = None
+    if workers > 1:
+        # Spawned rather than forked: the GUI process already runs threads
+        context = multiprocessing.get_context("spawn")
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                                          initializer=init_video_worker, initargs=initargs)
+        futures = {executor.submit(analyze_video_segment, *task): task for task in tasks}
+        results = ((futures[future], future.result()) for future in concurrent.futures.as_completed(futures))
+    else:
+        init_video_worker(*initargs)
+        results = ((task, analyze_video_segment(*task)) for task in tasks)
+    sightings = []
+    done = 0
+    if progress is not None:
+        progress(done, len(tasks))
+    try:
+        for (path, start_frame, _, _, _), (events, sampled) in results:
+            summary = summaries[path]
+            summary['sampled'] += sampled
+            label = os.path.basename(path)
+            for seconds, event, track_id, name, box, frame in events:
+                timestamp = summary['start_time'] + seconds
+                if name == "Unknown":
+                    # Track ids restart in every segment
+                    if snapshot_writer.submit(frame, box, (label, start_frame, track_id), timestamp, wait=True):
+                        summary['snapshots'] += 1
+                else:
+                    sightings.append((timestamp, name, path))
+            done += 1
+            if progress is not None:
+                progress(done, len(tasks))
+            if cancelled is not None and cancelled():
+                break
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    snapshot_writer.flush()
+    # Segments finish out of order; the attendance log debounces in time order
+    for timestamp, name, path in sorted(sightings):
+        if attendance_log.record(name, timestamp, source=os.path.basename(path)):
+            summaries[path]['attendance'] += 1
+    seconds = time.perf_counter() - start
+    for path, summary in summaries.items():
+        summary['seconds'] = seconds
+        print(f"{os.path.basename(path)}: {summary['duration']:.0f}s of video, {summary['sampled']} frames sampled, "
+              f"{summary['attendance']} attendance records, {summary['snapshots']} trespasser snapshots")
+    total_duration = sum(summary['duration'] for summary in summaries.values())
+    print(f"Analyzed {total_duration:.0f}s of video in {seconds:.1f}s ({total_duration / max(seconds, 1e-9):.1f}x real time)")
+    return summaries
+
+
+class EnrollmentSession:
+    # Enrollment of one identity from live captures. Each capture is checked and encoded on a
+    # background thread as soon as it is taken: exactly one face, large, sharp and frontal enough,
+    # and not a near-duplicate of an earlier capture. Accepted captures are saved to the class
+    # folder and entered into the embedding cache, and the identity's templates are re-selected
+    # and swapped into the gallery, so running streams recognize the person straight away and no
+    # other identity is touched. With replace=True the new captures replace the identity's
+    # existing images; otherwise they are added to them. finish() persists the identity to the
+    # face database; cancel() puts everything back.
+    def __init__(self, service, class_name, replace=False, target=15, min_face_size=80, min_sharpness=40.0,
+                 min_pose=0.6, duplicate_distance=0.12):
+        self.service = service
+        self.class_name = class_name
+        self.folder = os.path.join(service.root_folder, class_name)
+        os.makedirs(self.folder, exist_ok=True)
+        self.replace = replace
+        self.target = target
+        self.min_face_size = min_face_size
+        self.min_sharpness = min_sharpness
+        self.min_pose = min_pose
+        self.duplicate_distance = duplicate_distance
+        self.previous_images = DatasetEncoder.image_paths(self.folder)
+        with service.gallery.lock:
+            self.previous_templates = service.gallery.matrix[service.gallery.rows.get(class_name, [])].copy()
+        # Accepted faces: existing images (unless replacing) followed by this session's captures
+        self.encodings = []
+        self.qualities = []
+        self.captures = []
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"enroll-{class_name}")
+        if self.previous_images and not replace:
+            # Mostly served from the embedding cache
+            self.executor.submit(self.load_previous_images)
+
+    def load_previous_images(self):
+        encoded = self.service.dataset_encoder.encode_images(self.previous_images)
+        with self.lock:
+            for image_path in self.previous_images:
+                encoding, quality = encoded[image_path]
+                if encoding is not None:
+                    self.encodings.append(encoding)
+                    self.qualities.append(quality)
+
+    def submit(self, frame, manual=False):
+        # Queues a BGR frame; returns a future of the capture's feedback. Manual captures are only
+        # held to the one-face and duplicate checks
+        with self.lock:
+            self.pending += 1
+        return self.executor.submit(self.check_capture, frame.copy(), manual)
+
+    def check_capture(self, frame, manual):
+        try:
+            return self.add_capture(frame, manual)
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def add_capture(self, frame, manual):
+        # Returns feedback: faces, box, size, sharpness, pose, quality, accepted, duplicate, message
+        face_locations, encoding, details = enrollment_face(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        result = {'faces': len(face_locations), 'box': face_locations[0] if encoding is not None else None,
+                  'accepted': False, 'duplicate': False, **details}
+        if encoding is None:
+            result['message'] = "No face found" if not face_locations else f"{len(face_locations)} faces: only one person should be in view"
+            return result
+        problems = []
+        if details['size'] < self.min_face_size:
+            problems.append("move closer")
+        if details['sharpness'] < self.min_sharpness:
+            problems.append("hold still")
+        if details['pose'] < self.min_pose:
+            problems.append("face the camera")
+        if problems and not manual:
+            result['message'] = ", ".join(problems).capitalize()
+            return result
+        with self.lock:
+            if self.encodings and np.linalg.norm(np.asarray(self.encodings) - encoding, axis=1).min() < self.duplicate_distance:
+                result['duplicate'] = True
+                result['message'] = "Same as an earlier capture: turn your head slightly or change expression"
+                return result
+        image_path = os.path.join(self.folder, f"{self.class_name}_{time.strftime('%Y%m%d_%H%M%S')}_{int(time.time() * 1000) % 1000:03d}.jpg")
+        if not cv2.imwrite(image_path, frame):
+            result['message'] = f"Could not save {image_path}"
+            return result
+        # Cached under the saved file, so the next full update_face_data does not encode it again
+        encoder = self.service.dataset_encoder
+        stat = os.stat(image_path)
+        cached = convert_encodings((encoding, details['quality']), encoder.cache_dtype)
+        with encoder.lock:
+            encoder.cache[os.path.abspath(image_path)] = ((stat.st_mtime_ns, stat.st_size, encoder.encode_function.__name__), cached)
+        # The value a later cache hit returns, so the templates saved now match a full update's
+        encoding = convert_encodings(cached[0], np.float32)
+        with self.lock:
+            self.encodings.append(encoding)
+            self.qualities.append(details['quality'])
+            self.captures.append(image_path)
+            templates = select_templates(self.encodings, self.qualities)
+            count = len(self.captures)
+        self.service.gallery.add_identity(self.class_name, templates)
+        result['accepted'] = True
+        result['message'] = f"Captured {count}/{self.target}" + (f": {', '.join(problems)}" if problems else "")
+        return result
+
+    def finish(self):
+        # Waits for queued captures, then persists the identity; returns the number of captures
+        self.executor.shutdown(wait=True)
+        if not self.captures:
+            return 0
+        if self.replace:
+            for image_path in self.previous_images:
+                if os.path.exists(image_path):
+                    os.remove(image_path)
+        with self.lock:
+            templates = select_templates(self.encodings, self.qualities)
+        self.service.face_db.put(self.class_name, templates)
+        self.service.all_face_encodings, self.service.all_face_names = self.service.face_db.read()
+        self.service.dataset_encoder.save_cache()
+        print(f"Enrolled {self.class_name}: {len(self.captures)} captures, {len(templates)} templates")
+        return len(self.captures)
+
+    def cancel(self):
+        self.executor.shutdown(wait=True)
+        for image_path in self.captures:
+            if os.path.exists(image_path):
+                os.remove(image_path)
+        if len(self.previous_templates):
+            self.service.gallery.add_identity(self.class_name, self.previous_templates)
+        else:
+            self.service.gallery.remove_identity(self.class_name)
+
+
+class RecognitionService:
+    # Everything the app does apart from its windows: the enrolled gallery and its face database,
+    # the attendance log and the trespasser snapshot writer. FaceRecognitionApp and the headless
+    # server (server.py) each drive one, so enrollment, streams and sorting behave the same in both.
+    # With load=False the gallery starts empty until load_face_data() is called, so the app can
+    # show its window first and load in the background. `precision` (PRECISIONS) is that of the
+    # gallery's candidate scan and of the embedding caches.
+    def __init__(self, base_dir, load=True, precision="float32"):
+        self.root_folder = os.path.join(base_dir, "ImagesAttendance")
+        self.trespassers_folder = os.path.join(base_dir, "trespassers")
+        self.snapshot_deduplicators = {}
+        self.all_face_encodings = []
+        self.all_face_names = []
+        # Inverted-file index over the gallery; nprobe is the recall/latency knob
+        self.gallery = FaceGallery(index=IVFIndex(nprobe=8), precision=precision)
+        # Legacy pickle, only read once to import it into the face database
+        self.face_data_file = "face_data.pkl"
+        self.face_db = FaceDatabase("face_db")
+        # Enrollment images, reduced to at most MAX_TEMPLATES templates per identity
+        self.dataset_encoder = DatasetEncoder("embedding_cache.pkl", precision=precision)
+        # Uploaded photos are searched at full resolution, like sorted images
+        self.identify_detector = FaceDetector(scale=1)
+        if load:
+            self.load_face_data()
+        # Debounced attendance events from every stream, queryable by name and date
+        self.attendance_log = AttendanceLog("attendance.db")
+        # Face crops of unknown tracks, written in the background under a disk quota
+        self.snapshot_writer = SnapshotWriter(self.trespassers_folder)
+
+    def update_face_data(self, class_name=None):
+        existing_face_encodings, existing_face_names, flag = self.read_face_data()
+
+        if flag == 0 and class_name:
+            # Re-encode a single class and update only its database row and gallery entry, so
+            # neither the file nor the index is rebuilt
+            class_folder = os.path.join(self.root_folder, class_name)
+            if os.path.isdir(class_folder):
+                templates, _ = self.encode_faces_in_class(class_folder)
+                if templates is None:
+                    return
+                self.face_db.put(class_name, templates)
+                self.gallery.add_identity(class_name, templates)
+            else:
+                # The class folder was deleted, so drop the identity
+                self.face_db.remove(class_name)
+                self.gallery.remove_identity(class_name)
+            self.all_face_encodings, self.all_face_names = self.face_db.read()
+            return
+
+        if flag == 0:
+            # Every class goes through the embedding cache, so new and changed images are encoded
+            # and an unchanged tree does no model work at all
+            existing = {}
+            for name, encoding in zip(existing_face_names, existing_face_encodings):
+                existing.setdefault(name, []).append(encoding)
+            dataset = self.dataset_encoder.encode_dataset(self.root_folder)
+            changed = {}
+            for class_name, templates in dataset.items():
+                if templates is not None and (len(existing.get(class_name, [])) != len(templates)
+                                              or not np.allclose(existing[class_name], templates)):
+                    changed[class_name] = templates
+            # Identities whose class folder was deleted
+            removed = [name for name in existing if name not in dataset]
+            if not changed and not removed:
+                return
+            for class_name, templates in changed.items():
+                self.face_db.put(class_name, templates)
+            for name in removed:
+                self.face_db.remove(name)
+            existing_face_encodings, existing_face_names = self.face_db.read()
+
+        # Update class variables
+        self.all_face_encodings = existing_face_encodings
+        self.all_face_names = existing_face_names
+        self.gallery.set_data(existing_face_encodings, existing_face_names)
+
+    def read_face_data(self, progress=None):
+        if not self.face_db.exists() and os.path.exists(self.face_data_file):
+            self.face_db.import_pickle(self.face_data_file)
+        # Check if the face database exists
+        if self.face_db.exists():
+            # Memory-mapped, so this is cheap however many identities are enrolled
+            existing_face_encodings, existing_face_names = self.face_db.read()
+            flag = 0
+        else:
+            # Encode faces from the entire dataset
+            existing_face_encodings, existing_face_names = self.encode_faces_in_dataset(self.root_folder, progress)
+            self.save_face_data(existing_face_encodings, existing_face_names)
+            flag = 1
+        return existing_face_encodings, existing_face_names, flag
+
+    def load_face_data(self, progress=None):
+        # progress(done, total) is only called when there is no face database yet and the whole
+        # dataset has to be encoded
+        existing_face_encodings, existing_face_names, flag = self.read_face_data(progress)
+        self.all_face_encodings = existing_face_encodings
+        self.all_face_names = existing_face_names
+        # Builds the matcher (and its index) from the face database
+        self.gallery.set_data(existing_face_encodings, existing_face_names)
+        return existing_face_encodings, existing_face_names, flag
+    
+    def save_face_data(self, encodings, names):
+        self.face_db.write_all(encodings, names)
+        print("Encodings Saved.")
+
+    def encode_faces_in_class(self, class_folder):
+        class_name = os.path.basename(os.path.normpath(class_folder))
+        templates = self.dataset_encoder.encode_dataset(os.path.dirname(os.path.normpath(class_folder)), [class_name])[class_name]
+        if templates is None:
+            print("Class encoding failed")
+            return None, None
+        return templates, class_name
+
+    def encode_faces_in_dataset(self, root_folder, progress=None):
+        # One row per template, so names repeat for identities with several templates
+        class_templates = self.dataset_encoder.encode_dataset(root_folder, progress=progress)
+        all_face_encodings, all_face_names = [], []
+        for class_name, templates in class_templates.items():
+            if templates is not None:
+                all_face_encodings.extend(templates)
+                all_face_names.extend([class_name] * len(templates))
+        return all_face_encodings, all_face_names
+
+    def delete_similar_faces(self, folder_path, tolerance=0.6):
+        # The deduplicator keeps its embedding cache between scheduler passes
+        deduplicator = self.snapshot_deduplicators.get(folder_path)
+        if deduplicator is None or deduplicator.tolerance != tolerance:
+            deduplicator = self.snapshot_deduplicators[folder_path] = SnapshotDeduplicator(folder_path, tolerance, self.gallery.precision)
+        return deduplicator.run()
+
+    def identify_images(self, rgb_images, tolerance=None):
+        # Returns, per image, a (box, name, distance) per face. Every face of every image is
+        # matched in one gallery call, so a batch costs little more than a single image. A None
+        # tolerance is the gallery's
+        face_locations = self.identify_detector.detect_batch(rgb_images)
+        face_encodings = [
+            encoding
+            for image, locations in zip(rgb_images, face_locations)
+            for encoding in face_recognition.face_encodings(image, locations)
+        ]
+        matches = iter(self.gallery.match(face_encodings, tolerance))
+        return [[(box, *next(matches)) for box in locations] for locations in face_locations]
+
+    def start_enrollment(self, class_name, replace=False, **options):
+        # Options are those of EnrollmentSession
+        return EnrollmentSession(self, class_name, replace, **options)
+
+    def analyze_videos(self, paths, **options):
+        # Recorded footage into the same attendance log and trespasser folder as live streams;
+        # options are those of analyze_videos
+        os.makedirs(self.trespassers_folder, exist_ok=True)
+        return analyze_videos(self.gallery, paths, self.attendance_log, self.snapshot_writer, **options)
+
+    def open_stream(self, source, on_result, worker_pool=None, frame_rate=2, detector=None, on_event=None, name=None,
+                    capture_options=None, motion_gating=True):
+        # Webcam ports (int), video files (played back at their own frame rate) or RTSP URLs;
+        # capture_options are VideoSource.OPTIONS. Motion gating skips detection on static scenes
+        name = name or str(source)
+        video_source = VideoSource(source, name=name, **(capture_options or {}))
+        if not video_source.connect():
+            raise ValueError(f"Could not open video source {source!r}")
+        os.makedirs(self.trespassers_folder, exist_ok=True)
+        pipeline = RecognitionPipeline(
+            video_source, self.gallery, self.trespassers_folder, on_result, frame_rate=frame_rate,
+            worker_pool=worker_pool, detector=detector, attendance_log=self.attendance_log,
+            snapshot_writer=self.snapshot_writer, on_event=on_event, name=name,
+            motion_gate=MotionGate() if motion_gating else None,
+        )
+        pipeline.start()
+        return pipeline
@@ -0,0 +1,567 @@
+import argparse
+import asyncio
+import base64
+import collections
+import concurrent.futures
+import datetime
+import email
+import email.policy
+import functools
+import hashlib
+import itertools
+import json
+import os
+import struct
+import time
+import urllib.parse
+
+import cv2
+import numpy as np
+
+from faice_core import (METRICS, PRECISIONS, DistributedWorkerPool, FaceDetector, RecognitionService, RecognitionWorkerPool,
+                        VideoSource, run_recognition_worker, sort_folder)
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+MAX_BODY_BYTES = 64 * 1024 * 1024
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_source(source):
+    # Webcam ports are given as plain numbers on the command line and in requests
+    return int(source) if isinstance(source, str) and source.isdigit() else source
+
+
+def decode_image(data):
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def uploaded_files(content_type, body):
+    # multipart/form-data with one part per image, or a single raw image as the body
+    if content_type.startswith("multipart/"):
+        message = email.message_from_bytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body,
+                                           policy=email.policy.HTTP)
+        if not message.is_multipart():
+            raise HttpError(400, "Malformed multipart body")
+        return [(part.get_filename() or f"image_{i}", part.get_payload(decode=True) or b"")
+                for i, part in enumerate(message.iter_parts())]
+    return [("image", body)]
+
+
+def websocket_frame(payload, opcode=0x1):
+    # Server frames are never masked; FIN is always set since events fit in one frame
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+async def read_websocket_frame(reader, max_length=65536):
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        (length,) = struct.unpack("!H", await reader.readexactly(2))
+    elif length == 127:
+        (length,) = struct.unpack("!Q", await reader.readexactly(8))
+    if length > max_length:
+        raise ConnectionError("WebSocket frame too large")
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask is not None:
+        payload = (np.frombuffer(payload, np.uint8) ^ np.resize(np.frombuffer(mask, np.uint8), length)).tobytes()
+    return first & 0x0F, payload
+
+
+class IdentifyBatcher:
+    # Micro-batches identify requests: images arriving within `max_delay` seconds of each other
+    # (up to `max_batch`) go through the detector, encoder and matcher together on the executor,
+    # so concurrent clients share one gallery search and, with the CNN detector, one dlib batch.
+    def __init__(self, service, executor, max_batch=16, max_delay=0.01):
+        self.service = service
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = None
+        self.task = None
+        self.batches = 0
+        self.images = 0
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.run())
+
+    async def identify(self, images, tolerance=None):
+        loop = asyncio.get_running_loop()
+        futures = []
+        for image in images:
+            future = loop.create_future()
+            self.queue.put_nowait((image, tolerance, future))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # Matching takes one tolerance per call, so requests are grouped by theirs
+            groups = collections.defaultdict(list)
+            for image, tolerance, future in batch:
+                groups[tolerance].append((image, future))
+            for tolerance, group in groups.items():
+                try:
+                    results = await loop.run_in_executor(self.executor, self.service.identify_images,
+                                                         [image for image, _ in group], tolerance)
+                except Exception as error:
+                    for _, future in group:
+                        if not future.done():
+                            future.set_exception(error)
+                    continue
+                for (_, future), result in zip(group, results):
+                    if not future.done():
+                        future.set_result(result)
+            self.batches += 1
+            self.images += len(batch)
+
+
+class RecognitionServer:
+    # Headless HTTP/WebSocket front end for a RecognitionService, built on asyncio streams only.
+    #   GET    /health          gallery size, streams and identify batching counters
+    #   POST   /identify        raw image body or multipart/form-data with several images
+    #   POST   /enroll          {"class_name": ...} re-encodes one class, {} re-encodes every class
+    #   POST   /sort            {"folder": ..., "class_names": [...]} sorts a photo folder
+    #   POST   /analyze         {"paths": [...], "interval": 0.5, "segment_seconds": 60, "start_times": {path: epoch}}
+    #                           runs attendance over recorded video files
+    #   GET    /streams         per-stream stats
+    #   POST   /streams         {"source": ..., "fps": 2, "detector": "hog:0.5:1", "name": ...,
+    #                            "capture": {"transport": "tcp", "keyframes_only": false, ...}, "motion_gating": true}
+    #   DELETE /streams/<id>    stops a stream
+    #   GET    /workers         local worker threads, connected recognition workers and failovers
+    #   GET    /events          WebSocket feed of track events from every stream, as JSON
+    #   GET    /metrics         per-stage timings and frame counters in the Prometheus text format
+    #   POST   /metrics         {"enabled": true/false} turns metrics collection on or off
+    # Model work runs on thread pools so the event loop only ever parses and routes requests.
+    # Identify batches have a thread of their own, so long enroll, sort, analyze or stream-opening
+    # jobs on the other pool never hold up an identify request.
+    # With a `coordinator` (host, port), stream frames are also handed to recognition workers that
+    # register there (`server.py worker`), and `workers` may be 0 to leave all model work to them.
+    def __init__(self, service, host="127.0.0.1", port=8080, workers=None, max_batch=16, batch_delay=0.01,
+                 subscriber_queue=256, coordinator=None):
+        self.service = service
+        self.host = host
+        self.port = port
+        workers = workers if workers is not None else max(1, (os.cpu_count() or 2) // 2)
+        if workers < 1 and not coordinator:
+            raise ValueError("A server without a coordinator needs at least one recognition worker")
+        if coordinator:
+            self.worker_pool = DistributedWorkerPool(*coordinator, local_workers=workers)
+        else:
+            self.worker_pool = RecognitionWorkerPool(workers)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="faice-server")
+        # The batcher runs one batch at a time, so one thread is all it can use
+        self.identify_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="faice-identify")
+        self.batcher = IdentifyBatcher(service, self.identify_executor, max_batch, batch_delay)
+        self.subscriber_queue = subscriber_queue
+        self.subscribers = set()
+        self.streams = {}
+        self.stream_ids = itertools.count(1)
+        self.loop = None
+        self.server = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.worker_pool.start()
+        self.batcher.start()
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        print(f"Listening on http://{self.host}:{self.port}")
+
+    def stop(self):
+        while self.streams:
+            self.streams.popitem()[1].stop()
+        self.worker_pool.stop()
+        self.executor.shutdown(wait=False)
+        self.identify_executor.shutdown(wait=False)
+        if self.server is not None:
+            self.server.close()
+
+    def add_stream(self, source, frame_rate=2, detector=None, name=None, capture_options=None, motion_gating=True):
+        # Runs on the executor, since opening an RTSP source can block for seconds
+        stream_id = str(next(self.stream_ids))
+        name = name or str(source)
+        on_event = lambda stream_name, event, track, track_name, box: self.publish({
+            'type': "track", 'stream': stream_id, 'name': stream_name, 'event': event, 'track': track.track_id,
+            'identity': track_name, 'distance': track.distance, 'box': [int(value) for value in box],
+            'time': time.time(),
+        })
+        # Frames are not displayed headless; only the track events are of interest
+        self.streams[stream_id] = self.service.open_stream(
+            source, lambda frame, names: None, worker_pool=self.worker_pool, frame_rate=frame_rate,
+            detector=detector, on_event=on_event, name=name, capture_options=capture_options,
+            motion_gating=motion_gating,
+        )
+        return stream_id
+
+    def remove_stream(self, stream_id):
+        pipeline = self.streams.pop(stream_id, None)
+        if pipeline is None:
+            raise HttpError(404, f"No stream {stream_id}")
+        pipeline.stop()
+
+    def publish(self, event):
+        # Called from pipeline match threads
+        if self.loop is not None and self.subscribers:
+            self.loop.call_soon_threadsafe(self.broadcast, json.dumps(event))
+
+    def broadcast(self, message):
+        for subscriber in self.subscribers:
+            # Slow clients lose their oldest events rather than holding up the others
+            if subscriber.full():
+                subscriber.get_nowait()
+            subscriber.put_nowait(message)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                method, target, _ = request_line.split(" ", 2)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+                return
+            headers = {}
+            for line in header_lines:
+                if ":" in line:
+                    key, value = line.split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+            url = urllib.parse.urlsplit(target)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            if url.path == "/events" and headers.get("upgrade", "").lower() == "websocket":
+                await self.handle_events(reader, writer, headers)
+                return
+            try:
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY_BYTES:
+                    raise HttpError(413, f"Request body over {MAX_BODY_BYTES} bytes")
+                body = await reader.readexactly(length) if length else b""
+                status, payload = 200, await self.route(method, url.path, query, headers, body)
+            except HttpError as error:
+                status, payload = error.status, {'error': str(error)}
+            except ValueError as error:
+                status, payload = 400, {'error': str(error)}
+            except Exception as error:
+                status, payload = 500, {'error': repr(error)}
+            if isinstance(payload, str):
+                content, content_type = payload.encode(), "text/plain; version=0.0.4"
+            else:
+                content, content_type = json.dumps(payload).encode(), "application/json"
+            writer.write(
+                f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(content)}\r\nConnection: close\r\n\r\n".encode() + content
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, query, headers, body):
+        parts = [part for part in path.split("/") if part]
+        if parts == ["health"] and method == "GET":
+            return {
+                'identities': len(self.service.gallery), 'streams': len(self.streams),
+                'identify_batches': self.batcher.batches, 'identify_images': self.batcher.images,
+            }
+        if parts == ["metrics"] and method == "GET":
+            return METRICS.render()
+        if parts == ["metrics"] and method == "POST":
+            if json.loads(body or b"{}").get("enabled", True):
+                METRICS.enable("api")
+            else:
+                METRICS.disable("api")
+            return {'enabled': METRICS.enabled}
+        if parts == ["identify"] and method == "POST":
+            # Without ?tolerance= faces are matched at the gallery's tolerance
+            tolerance = float(query["tolerance"]) if "tolerance" in query else None
+            return await self.identify(headers.get("content-type", ""), body, tolerance)
+        if parts == ["enroll"] and method == "POST":
+            request = json.loads(body or b"{}")
+            await self.run_blocking(self.service.update_face_data, request.get("class_name"))
+            return {'identities': len(self.service.gallery)}
+        if parts == ["sort"] and method == "POST":
+            request = json.loads(body or b"{}")
+            folder = request.get("folder", "")
+            if not os.path.isdir(folder):
+                raise HttpError(400, f"{folder} is not a folder")
+            counts = await self.run_blocking(sort_folder, self.service.gallery, folder, request.get("class_names"))
+            return {'counts': counts}
+        if parts == ["analyze"] and method == "POST":
+            request = json.loads(body or b"{}")
+            paths = request.get("paths") or []
+            missing = [path for path in paths if not os.path.isfile(path)]
+            if not paths or missing:
+                raise HttpError(400, f"Not video files: {missing}" if missing else "Missing video paths")
+            detector = FaceDetector.parse(request["detector"]) if request.get("detector") else None
+            summaries = await self.run_blocking(
+                self.service.analyze_videos, paths, interval=float(request.get("interval", 0.5)),
+                segment_seconds=float(request.get("segment_seconds", 60)), detector=detector,
+                start_times={path: float(value) for path, value in (request.get("start_times") or {}).items()},
+            )
+            return {'videos': summaries}
+        if parts == ["streams"] and method == "GET":
+            return {'streams': {stream_id: pipeline.stream_stats() for stream_id, pipeline in list(self.streams.items())}}
+        if parts == ["streams"] and method == "POST":
+            request = json.loads(body or b"{}")
+            if "source" not in request:
+                raise HttpError(400, "Missing stream source")
+            detector = FaceDetector.parse(request["detector"]) if request.get("detector") else None
+            capture_options = request.get("capture") or {}
+            unknown = set(capture_options) - set(VideoSource.OPTIONS)
+            if unknown:
+                raise HttpError(400, f"Unknown capture options {sorted(unknown)}, expected {list(VideoSource.OPTIONS)}")
+            stream_id = await self.run_blocking(self.add_stream, parse_source(request["source"]),
+                                                float(request.get("fps", 2)), detector, request.get("name"), capture_options,
+                                                bool(request.get("motion_gating", True)))
+            return {'id': stream_id}
+        if len(parts) == 2 and parts[0] == "streams" and method == "DELETE":
+            await self.run_blocking(self.remove_stream, parts[1])
+            return {'stopped': parts[1]}
+        if parts == ["workers"] and method == "GET":
+            return self.worker_pool.worker_stats()
+        if parts in (["health"], ["metrics"], ["identify"], ["enroll"], ["sort"], ["analyze"], ["streams"], ["workers"]) or (len(parts) == 2 and parts[0] == "streams"):
+            raise HttpError(405, f"{method} not allowed on {path}")
+        raise HttpError(404, f"No route for {path}")
+
+    async def run_blocking(self, function, *args, **kwargs):
+        # run_in_executor only passes positional arguments
+        return await self.loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    async def identify(self, content_type, body, tolerance):
+        files = uploaded_files(content_type, body)
+        images = [decode_image(data) for _, data in files]
+        decoded = [image for image in images if image is not None]
+        results = iter(await self.batcher.identify(decoded, tolerance))
+        response = []
+        for (filename, _), image in zip(files, images):
+            if image is None:
+                response.append({'file': filename, 'error': "Not a decodable image"})
+                continue
+            response.append({'file': filename, 'faces': [
+                {'box': [int(value) for value in box], 'name': name, 'distance': distance}
+                for box, name, distance in next(results)
+            ]})
+        return {'results': response}
+
+    async def handle_events(self, reader, writer, headers):
+        key = headers.get("sec-websocket-key", "")
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        writer.write(
+            "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n".encode()
+        )
+        await writer.drain()
+        subscriber = asyncio.Queue(maxsize=self.subscriber_queue)
+        self.subscribers.add(subscriber)
+
+        async def send_events():
+            while True:
+                writer.write(websocket_frame((await subscriber.get()).encode()))
+                await writer.drain()
+
+        async def receive_frames():
+            # Clients only ever ping or close
+            while True:
+                opcode, payload = await read_websocket_frame(reader)
+                if opcode == 0x8:
+                    writer.write(websocket_frame(payload[:2], opcode=0x8))
+                    await writer.drain()
+                    return
+                if opcode == 0x9:
+                    writer.write(websocket_frame(payload, opcode=0xA))
+                    await writer.drain()
+
+        tasks = [asyncio.ensure_future(send_events()), asyncio.ensure_future(receive_frames())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.subscribers.discard(subscriber)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def parse_address(address, default_host="0.0.0.0"):
+    # "host:port" or just "port"
+    host, _, port = address.rpartition(":")
+    return host or default_host, int(port)
+
+
+def serve(args):
+    if args.workers is not None and args.workers < 1 and not args.coordinator:
+        raise SystemExit("--workers must be at least 1 unless --coordinator accepts remote workers")
+    service = RecognitionService(os.path.dirname(os.path.abspath(__file__)), precision=args.precision)
+    coordinator = parse_address(args.coordinator) if args.coordinator else None
+    server = RecognitionServer(service, args.host, args.port, args.workers, args.max_batch, args.batch_delay_ms / 1000.0,
+                               coordinator=coordinator)
+    detector = FaceDetector.parse(args.detector) if args.detector else None
+    capture_options = {'transport': args.transport, 'buffer_size': args.buffer_size, 'keyframes_only': args.keyframes_only,
+                       'backend': args.backend, 'hardware_acceleration': args.hardware_decoding}
+    if args.metrics:
+        METRICS.enable("api")
+    if args.metrics_log:
+        METRICS.start_log(args.metrics_log)
+
+    async def main():
+        await server.start()
+        for source in args.stream:
+            stream_id = await server.run_blocking(server.add_stream, parse_source(source), args.fps, detector, None,
+                                                  capture_options, not args.no_motion_gating)
+            print(f"Stream {stream_id}: {source}")
+        try:
+            await server.server.serve_forever()
+        finally:
+            server.stop()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+def identify(args):
+    service = RecognitionService(os.path.dirname(os.path.abspath(__file__)), precision=args.precision)
+    paths = [path for path in args.images if os.path.isfile(path)]
+    images = []
+    for path in paths:
+        with open(path, 'rb') as file:
+            images.append(decode_image(file.read()))
+    loaded = [(path, image) for path, image in zip(paths, images) if image is not None]
+    for start in range(0, len(loaded), args.batch_size):
+        batch = loaded[start:start + args.batch_size]
+        results = service.identify_images([image for _, image in batch], args.tolerance)
+        for (path, _), faces in zip(batch, results):
+            print(json.dumps({'file': path, 'faces': [
+                {'box': [int(value) for value in box], 'name': name, 'distance': distance} for box, name, distance in faces
+            ]}))
+
+
+def enroll(args):
+    service = RecognitionService(os.path.dirname(os.path.abspath(__file__)), precision=args.precision)
+    service.update_face_data(args.class_name)
+    print(f"{len(service.gallery)} identities enrolled")
+
+
+def sort(args):
+    service = RecognitionService(os.path.dirname(os.path.abspath(__file__)), precision=args.precision)
+    counts = sort_folder(service.gallery, args.folder, args.class_names,
+                         progress=lambda done, total: print(f"\r{done}/{total} images encoded", end="", flush=True))
+    print()
+    for name, count in sorted(counts.items()):
+        print(f"{name}: {count}")
+
+
+def analyze(args):
+    if args.start and len(args.start) != len(args.videos):
+        raise SystemExit("Give one --start per video")
+    start_times = {
+        path: datetime.datetime.fromisoformat(start).timestamp() for path, start in zip(args.videos, args.start or [])
+    }
+    service = RecognitionService(os.path.dirname(os.path.abspath(__file__)), precision=args.precision)
+    service.analyze_videos(
+        args.videos, interval=args.interval, segment_seconds=args.segment_seconds, workers=args.workers,
+        detector=FaceDetector.parse(args.detector) if args.detector else None, start_times=start_times,
+        progress=lambda done, total: print(f"\r{done}/{total} segments analyzed", end="\n" if done == total else "", flush=True),
+    )
+    service.attendance_log.close()
+
+
+def worker(args):
+    try:
+        run_recognition_worker(parse_address(args.coordinator, "127.0.0.1"), args.slots, args.name,
+                               shared_memory=not args.no_shared_memory)
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless fAIce recognition service")
+    parser.add_argument("--precision", choices=PRECISIONS, default="float32",
+                        help="Gallery scan and embedding cache precision; float16 and int8 re-rank matches at float32")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Run the HTTP/WebSocket API")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument("--stream", action="append", default=[],
+                              help="Webcam port, RTSP URL or video file to start with; may be repeated")
+    serve_parser.add_argument("--fps", type=float, default=2, help="Recognition FPS target for --stream sources")
+    serve_parser.add_argument("--detector", help="model:scale:upsample for --stream sources, e.g. hog:0.5:1")
+    serve_parser.add_argument("--transport", choices=["tcp", "udp"], default="tcp", help="RTSP transport for --stream sources")
+    serve_parser.add_argument("--buffer-size", type=int, help="Network receive buffer in bytes for --stream sources")
+    serve_parser.add_argument("--keyframes-only", action="store_true", help="Only decode keyframes of --stream sources")
+    serve_parser.add_argument("--backend", choices=VideoSource.BACKENDS, default="ffmpeg", help="Capture backend for --stream sources")
+    serve_parser.add_argument("--hardware-decoding", action="store_true", help="Use a hardware decoder when OpenCV has one")
+    serve_parser.add_argument("--no-motion-gating", action="store_true", help="Run detection on --stream sources even when nothing moves")
+    serve_parser.add_argument("--workers", type=int, help="Recognition worker threads shared by all streams; 0 with --coordinator")
+    serve_parser.add_argument("--coordinator", metavar="[HOST:]PORT",
+                              help="Accept recognition workers (server.py worker) on this address, e.g. 0.0.0.0:7070")
+    serve_parser.add_argument("--max-batch", type=int, default=16, help="Images per identify batch")
+    serve_parser.add_argument("--batch-delay-ms", type=float, default=10, help="How long an identify batch waits to fill")
+    serve_parser.add_argument("--metrics", action="store_true", help="Collect metrics for GET /metrics from the start")
+    serve_parser.add_argument("--metrics-log", type=float, metavar="SECONDS", help="Also print metrics at this interval")
+
+    identify_parser = subparsers.add_parser("identify", help="Identify the faces in image files")
+    identify_parser.add_argument("images", nargs="+")
+    identify_parser.add_argument("--tolerance", type=float, help="Match distance threshold, the gallery's by default")
+    identify_parser.add_argument("--batch-size", type=int, default=16)
+
+    enroll_parser = subparsers.add_parser("enroll", help="Encode ImagesAttendance into the face database")
+    enroll_parser.add_argument("class_name", nargs="?", help="Only re-encode this class")
+
+    sort_parser = subparsers.add_parser("sort", help="Sort a photo folder into per-class folders")
+    sort_parser.add_argument("folder")
+    sort_parser.add_argument("--class", dest="class_names", action="append", help="Only sort this class; may be repeated")
+
+    analyze_parser = subparsers.add_parser("analyze", help="Run attendance over recorded video files")
+    analyze_parser.add_argument("videos", nargs="+")
+    analyze_parser.add_argument("--interval", type=float, default=0.5, help="Seconds of video between sampled frames")
+    analyze_parser.add_argument("--segment-seconds", type=float, default=60, help="Seconds of video per parallel segment")
+    analyze_parser.add_argument("--workers", type=int, help="Worker processes, one per CPU by default")
+    analyze_parser.add_argument("--detector", help="model:scale:upsample, e.g. hog:0.5:1")
+    analyze_parser.add_argument("--start", action="append",
+                                help="Local recording start time per video, e.g. 2024-05-01T09:00:00; "
+                                     "defaults to the file's modification time minus its duration")
+
+    worker_parser = subparsers.add_parser("worker", help="Run detection and encoding for a serve --coordinator")
+    worker_parser.add_argument("coordinator", metavar="[HOST:]PORT", help="Coordinator address, e.g. 10.0.0.5:7070")
+    worker_parser.add_argument("--slots", type=int, help="Frames processed at once, half the CPUs by default")
+    worker_parser.add_argument("--name", help="Name shown in GET /workers, host-pid by default")
+    worker_parser.add_argument("--no-shared-memory", action="store_true",
+                               help="Always send frames over TCP, even when the coordinator is on this host")
+
+    args = parser.parse_args()
+    {"serve": serve, "identify": identify, "enroll": enroll, "sort": sort, "analyze": analyze,
+     "worker": worker}[args.command](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import numpy as np
+import pytest
+
+from faice_core import ENCODING_SIZE, PRECISIONS, FaceGallery, IVFIndex, ScalarQuantizer
+
+
+def random_encodings(count, seed=0):
+    # Spread like dlib encodings: small components, unit-ish norms
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(0, 0.09, (count, ENCODING_SIZE)).astype(np.float32)
+    return np.clip(vectors, -0.45, 0.45)
+
+
+def noisy(vectors, noise=0.005, seed=1):
+    return vectors + np.random.default_rng(seed).normal(0, noise, vectors.shape).astype(np.float32)
+
+
+def test_match_names_nearest_identity_within_tolerance():
+    encodings = random_encodings(3)
+    gallery = FaceGallery(encodings, ["alice", "bob", "carol"], tolerance=0.5)
+    matches = gallery.match(np.vstack((noisy(encodings[1:2]), encodings[2:3] + 1.0)))
+    assert matches[0][0] == "bob"
+    assert matches[0][1] < 0.5
+    assert matches[1][0] == "Unknown"
+    assert gallery.match([]) == []
+
+
+def test_match_uses_the_gallery_tolerance_unless_overridden():
+    encodings = random_encodings(1)
+    gallery = FaceGallery(encodings, ["alice"], tolerance=0.01)
+    query = encodings + 0.01
+    distance = gallery.match(query)[0][1]
+    assert distance > 0.01
+    assert gallery.match(query)[0][0] == "Unknown"
+    assert gallery.match(query, tolerance=distance + 0.01)[0][0] == "alice"
+
+
+def test_identity_is_matched_through_its_closest_template():
+    encodings = random_encodings(4)
+    gallery = FaceGallery(encodings, ["alice", "alice", "bob", "bob"])
+    assert len(gallery) == 2
+    assert [name for name, _ in gallery.match(noisy(encodings))] == ["alice", "alice", "bob", "bob"]
+
+
+def test_add_identity_replaces_every_template():
+    encodings = random_encodings(5)
+    gallery = FaceGallery(encodings[:3], ["alice", "alice", "bob"])
+    gallery.add_identity("alice", encodings[3])
+    assert len(gallery.rows["alice"]) == 1
+    assert gallery.match(encodings[3:4])[0] == ("alice", pytest.approx(0.0, abs=1e-3))
+    assert gallery.match(encodings[0:1])[0][0] != "alice"
+    gallery.add_identity("carol", encodings[4:5])
+    assert sorted(gallery.rows) == ["alice", "bob", "carol"]
+
+
+def test_remove_identity_keeps_rows_contiguous_and_consistent():
+    encodings = random_encodings(6)
+    names = ["alice", "bob", "alice", "carol", "dave", "dave"]
+    gallery = FaceGallery(encodings, names)
+    assert gallery.remove_identity("alice")
+    assert not gallery.remove_identity("alice")
+    assert len(gallery.names) == len(gallery.matrix) == len(gallery.norms) == 4
+    for name, rows in gallery.rows.items():
+        assert all(gallery.names[row] == name for row in rows)
+        for row in rows:
+            original = [index for index, owner in enumerate(names) if owner == name]
+            assert any(np.array_equal(gallery.matrix[row], encodings[index]) for index in original)
+    assert [name for name, _ in gallery.match(encodings[[1, 3, 4]])] == ["bob", "carol", "dave"]
+    assert gallery.match(encodings[0:1])[0][0] != "alice"
+
+
+def test_ivf_index_agrees_with_exact_search_when_probing_every_list():
+    encodings = random_encodings(600)
+    names = [f"person{i}" for i in range(600)]
+    exact = FaceGallery(encodings, names)
+    ivf = FaceGallery(encodings, names, index=IVFIndex(nlist=8, nprobe=8, min_train_size=64))
+    assert len(ivf.index.centroids) == 8
+    queries = noisy(encodings[::37])
+    assert ivf.match(queries) == exact.match(queries)
+
+
+def test_ivf_index_tracks_added_and_removed_rows():
+    encodings = random_encodings(300)
+    gallery = FaceGallery(encodings[:200], [f"p{i}" for i in range(200)],
+                          index=IVFIndex(nlist=4, nprobe=4, min_train_size=64))
+    for i in range(200, 300):
+        gallery.add_identity(f"p{i}", encodings[i])
+    gallery.remove_identity("p5")
+    assert sorted(gallery.index.row_list) == list(range(len(gallery.names)))
+    assert gallery.match(encodings[250:251])[0][0] == "p250"
+    assert gallery.match(encodings[5:6])[0][0] != "p5"
+
+
+@pytest.mark.parametrize("precision", PRECISIONS[1:])
+def test_quantizer_round_trip_error_is_small(precision):
+    vectors = random_encodings(100)
+    quantizer = ScalarQuantizer(precision)
+    quantizer.fit(vectors)
+    decoded = quantizer.decode(quantizer.encode(vectors))
+    assert decoded.dtype == np.float32
+    assert np.abs(decoded - vectors).max() <= (quantizer.scale / 2 + 1e-6 if precision == "int8" else 1e-3)
+
+
+def test_quantizer_rejects_float32():
+    with pytest.raises(ValueError):
+        ScalarQuantizer("float32")
+
+
+@pytest.mark.parametrize("precision", PRECISIONS[1:])
+def test_quantized_gallery_reranks_to_exact_distances(precision):
+    encodings = random_encodings(500)
+    names = [f"person{i}" for i in range(500)]
+    exact = FaceGallery(encodings, names)
+    quantized = FaceGallery(encodings, names, precision=precision, rerank=16)
+    queries = noisy(encodings[::25], noise=0.02)
+    for (exact_name, exact_distance), (name, distance) in zip(exact.match(queries), quantized.match(queries)):
+        assert name == exact_name
+        assert distance == pytest.approx(exact_distance, abs=1e-5)
+
+
+def test_quantized_gallery_follows_add_and_remove():
+    encodings = random_encodings(10)
+    gallery = FaceGallery(encodings[:8], [f"p{i}" for i in range(8)], precision="int8")
+    gallery.add_identity("new", encodings[8])
+    gallery.remove_identity("p0")
+    assert len(gallery.codes) == len(gallery.code_norms) == len(gallery.names)
+    assert gallery.match(encodings[8:9])[0][0] == "new"
+    assert gallery.match(encodings[3:4])[0][0] == "p3"
+
+
+def test_gallery_rejects_mismatched_names_and_unknown_precision():
+    with pytest.raises(ValueError):
+        FaceGallery(random_encodings(2), ["alice"])
+    with pytest.raises(ValueError):
+        FaceGallery(precision="float64")
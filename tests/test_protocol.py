@@ -0,0 +1,149 @@
+import json
+import socket
+import threading
+import time
+import types
+
+import numpy as np
+import pytest
+
+import faice_core
+from faice_core import ENCODING_SIZE, DistributedWorkerPool, FaceDetector, WorkerProtocol, run_recognition_worker
+
+
+def fake_face_locations(rgb_frame, number_of_times_to_upsample=1, model="hog"):
+    # The bounding box of the bright pixels, so the result depends on the frame that arrived
+    rows, columns = np.nonzero(rgb_frame.max(axis=2) > 127)
+    if not len(rows):
+        return []
+    return [(int(rows.min()), int(columns.max()) + 1, int(rows.max()) + 1, int(columns.min()))]
+
+
+def fake_face_encodings(rgb_frame, face_locations, model="small"):
+    return [np.full(ENCODING_SIZE, rgb_frame[top:bottom, left:right].mean() / 255)
+            for top, right, bottom, left in face_locations]
+
+
+@pytest.fixture
+def models(monkeypatch):
+    monkeypatch.setattr(faice_core, "face_recognition", types.SimpleNamespace(
+        face_locations=fake_face_locations, face_encodings=fake_face_encodings))
+
+
+def frame_with_face():
+    frame = np.zeros((120, 160, 3), np.uint8)
+    frame[30:90, 40:100] = 200
+    frame[50:60, 60:70] = 140
+    return frame
+
+
+def test_messages_round_trip_over_a_socket():
+    left, right = socket.socketpair()
+    with left, right:
+        WorkerProtocol.send(left, WorkerProtocol.RESULT, 3, b"ab", b"", b"cd")
+        WorkerProtocol.send(left, WorkerProtocol.PING, 0)
+        assert WorkerProtocol.receive(right) == (WorkerProtocol.RESULT, 3, bytearray(b"abcd"))
+        assert WorkerProtocol.receive(right) == (WorkerProtocol.PING, 0, bytearray())
+
+
+def test_large_payloads_arrive_whole():
+    left, right = socket.socketpair()
+    payload = np.random.default_rng(0).integers(0, 255, 3 * 1024 * 1024, dtype=np.uint8).tobytes()
+    sender = threading.Thread(target=WorkerProtocol.send, args=(left, WorkerProtocol.DETECT, 1, payload))
+    sender.start()
+    kind, slot, received = WorkerProtocol.receive(right)
+    sender.join()
+    left.close()
+    right.close()
+    assert (kind, slot) == (WorkerProtocol.DETECT, 1)
+    assert received == payload
+
+
+def test_receive_raises_when_the_peer_closes_mid_message():
+    left, right = socket.socketpair()
+    left.sendall(WorkerProtocol.HEADER.pack(WorkerProtocol.RESULT, 0, 10) + b"short")
+    left.close()
+    with pytest.raises(ConnectionError):
+        WorkerProtocol.receive(right)
+    right.close()
+
+
+def test_arrays_round_trip():
+    boxes = np.array([[1, 2, 3, 4], [-5, 600, 70000, 8]])
+    payload = WorkerProtocol.pack_array(boxes, '>i4')
+    assert len(payload) == WorkerProtocol.COUNT.size + boxes.size * 4
+    assert WorkerProtocol.unpack_array(payload, '>i4', 4).tolist() == boxes.tolist()
+    encodings = np.random.default_rng(0).random((3, ENCODING_SIZE)).astype(np.float32)
+    decoded = WorkerProtocol.unpack_array(WorkerProtocol.pack_array(encodings, '>f4'), '>f4', ENCODING_SIZE)
+    assert np.array_equal(decoded, encodings)
+    assert WorkerProtocol.unpack_array(WorkerProtocol.pack_array(np.empty((0, 4)), '>i4'), '>i4', 4).shape == (0, 4)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def pool():
+    pool = DistributedWorkerPool("127.0.0.1", 0, heartbeat_interval=0.5, heartbeat_timeout=5.0, call_timeout=5.0)
+    pool.start()
+    yield pool
+    pool.stop()
+
+
+@pytest.mark.parametrize("shared_memory", [True, False])
+def test_remote_worker_matches_local_results(models, pool, shared_memory):
+    stop = threading.Event()
+    worker = threading.Thread(target=run_recognition_worker, args=(("127.0.0.1", pool.port),),
+                              kwargs={'slots': 2, 'name': "test-worker", 'shared_memory': shared_memory, 'stop': stop},
+                              daemon=True)
+    worker.start()
+    try:
+        wait_for(lambda: pool.remote_workers)
+        [remote] = pool.remote_workers
+        assert remote.slots == 2 and remote.shared_memory == shared_memory
+        frame = frame_with_face()
+        for detector in (FaceDetector("hog", 1.0, 1), FaceDetector("hog", 0.5, 1)):
+            boxes = remote.detect(0, detector, frame, timeout=5)
+            assert boxes == detector.detect(frame)
+            encodings = remote.encode(0, boxes, timeout=5)
+            assert np.allclose(encodings, fake_face_encodings(frame, boxes))
+        # Another frame in the same slot replaces the first one
+        empty = np.zeros_like(frame)
+        assert remote.detect(0, FaceDetector("hog", 1.0, 1), empty, timeout=5) == []
+        assert remote.encode(0, [], timeout=5) == []
+        assert remote.stats()['jobs'] == 3
+    finally:
+        stop.set()
+        pool.stop()
+        worker.join(timeout=10)
+
+
+def test_lost_worker_fails_over_to_this_process(models, pool):
+    connection = socket.create_connection(("127.0.0.1", pool.port))
+    hello = {'name': "silent", 'slots': 1, 'host': "elsewhere", 'shared_memory': False}
+    WorkerProtocol.send(connection, WorkerProtocol.HELLO, 0, json.dumps(hello).encode('utf-8'))
+    kind, _, payload = WorkerProtocol.receive(connection)
+    assert kind == WorkerProtocol.WELCOME and json.loads(payload)['shared_memory'] is False
+
+    def drop_after_first_job():
+        # Disappears with the frame it was sent, without answering
+        while WorkerProtocol.receive(connection)[0] != WorkerProtocol.DETECT:
+            pass
+        connection.close()
+    threading.Thread(target=drop_after_first_job, daemon=True).start()
+    wait_for(lambda: pool.remote_workers)
+    [remote] = pool.remote_workers
+    pool.local.remote, pool.local.slot = remote, 0
+    frame = frame_with_face()
+    detector = FaceDetector("hog", 1.0, 1)
+    assert pool.detect(detector, frame) == detector.detect(frame)
+    assert pool.failovers == 1
+    assert not remote.alive
+    # With the worker gone, encoding runs here without another failover
+    boxes = detector.detect(frame)
+    assert np.allclose(pool.encode(frame, boxes), fake_face_encodings(frame, boxes))
+    assert pool.failovers == 1
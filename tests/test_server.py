@@ -0,0 +1,145 @@
+import asyncio
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+import server
+from faice_core import METRICS
+
+
+class StubService:
+    # Stands in for RecognitionService: records the calls the routes make instead of running models
+    def __init__(self):
+        self.gallery = []
+        self.analyze_calls = []
+        self.identify_calls = []
+        self.enrolled = []
+
+    def identify_images(self, rgb_images, tolerance=None):
+        self.identify_calls.append((len(rgb_images), tolerance))
+        return [[((10, 40, 40, 10), "alice", 0.3)] for _ in rgb_images]
+
+    def update_face_data(self, class_name=None):
+        self.enrolled.append(class_name)
+        self.gallery.append(class_name)
+
+    def analyze_videos(self, paths, **options):
+        self.analyze_calls.append((paths, options))
+        return [{'path': path, 'sightings': 0} for path in paths]
+
+
+@pytest.fixture
+def api():
+    recognition_server = server.RecognitionServer(StubService(), workers=1)
+    yield recognition_server
+    recognition_server.stop()
+
+
+def call(api, method, path, body=None, query=None):
+    # `body` is sent as JSON, or as is when it is already bytes
+    async def route():
+        api.loop = asyncio.get_running_loop()
+        api.batcher.start()
+        payload = body if isinstance(body, bytes) else json.dumps(body).encode() if body is not None else b""
+        return await api.route(method, path, query or {}, {}, payload)
+    return asyncio.run(route())
+
+
+def jpeg():
+    ok, data = cv2.imencode(".jpg", np.zeros((64, 64, 3), np.uint8))
+    return data.tobytes()
+
+
+def test_analyze_runs_with_the_requested_options(api, tmp_path):
+    video = tmp_path / "lecture.mp4"
+    video.write_bytes(b"")
+    response = call(api, "POST", "/analyze", {
+        'paths': [str(video)], 'interval': 2, 'segment_seconds': 30, 'detector': "hog:0.5:1",
+        'start_times': {str(video): "1700000000"},
+    })
+    assert response == {'videos': [{'path': str(video), 'sightings': 0}]}
+    [(paths, options)] = api.service.analyze_calls
+    assert paths == [str(video)]
+    assert options['interval'] == 2.0
+    assert options['segment_seconds'] == 30.0
+    assert repr(options['detector']) == "hog:0.5:1"
+    assert options['start_times'] == {str(video): 1700000000.0}
+
+
+def test_analyze_rejects_missing_videos(api, tmp_path):
+    with pytest.raises(server.HttpError) as error:
+        call(api, "POST", "/analyze", {'paths': [str(tmp_path / "missing.mp4")]})
+    assert error.value.status == 400
+    with pytest.raises(server.HttpError) as error:
+        call(api, "POST", "/analyze", {})
+    assert error.value.status == 400
+    assert api.service.analyze_calls == []
+
+
+def test_identify_matches_at_the_gallery_tolerance_by_default(api):
+    response = call(api, "POST", "/identify", jpeg())
+    assert response == {'results': [{'file': "image", 'faces': [{'box': [10, 40, 40, 10], 'name': "alice", 'distance': 0.3}]}]}
+    assert api.service.identify_calls == [(1, None)]
+
+
+def test_identify_tolerance_query(api):
+    call(api, "POST", "/identify", jpeg(), query={'tolerance': "0.4"})
+    assert api.service.identify_calls == [(1, 0.4)]
+
+
+def test_identify_reports_undecodable_images(api):
+    response = call(api, "POST", "/identify", b"not an image")
+    assert response == {'results': [{'file': "image", 'error': "Not a decodable image"}]}
+    assert api.service.identify_calls == []
+
+
+def test_health_counts_identities_streams_and_batches(api):
+    call(api, "POST", "/identify", jpeg())
+    assert call(api, "GET", "/health") == {'identities': 0, 'streams': 0, 'identify_batches': 1, 'identify_images': 1}
+
+
+def test_enroll_refreshes_the_named_identity(api):
+    assert call(api, "POST", "/enroll", {'class_name': "alice"}) == {'identities': 1}
+    assert call(api, "POST", "/enroll") == {'identities': 2}
+    assert api.service.enrolled == ["alice", None]
+
+
+def test_sort_rejects_a_missing_folder(api, tmp_path):
+    with pytest.raises(server.HttpError) as error:
+        call(api, "POST", "/sort", {'folder': str(tmp_path / "missing")})
+    assert error.value.status == 400
+
+
+def test_metrics_can_be_switched_on_and_off(api):
+    try:
+        assert call(api, "POST", "/metrics", {'enabled': True}) == {'enabled': True}
+        METRICS.frames("test", "processed")
+        assert 'faice_frames_total{stream="test",state="processed"}' in call(api, "GET", "/metrics")
+    finally:
+        assert call(api, "POST", "/metrics", {'enabled': False}) == {'enabled': False}
+
+
+def test_streams_and_workers_start_empty(api):
+    assert call(api, "GET", "/streams") == {'streams': {}}
+    assert call(api, "GET", "/workers") == {'local_workers': 1, 'remote_workers': [], 'failovers': 0}
+
+
+def test_stream_requests_are_validated(api):
+    for body in ({}, {'source': "0", 'capture': {'bogus': 1}}):
+        with pytest.raises(server.HttpError) as error:
+            call(api, "POST", "/streams", body)
+        assert error.value.status == 400
+    with pytest.raises(server.HttpError) as error:
+        call(api, "DELETE", "/streams/missing")
+    assert error.value.status == 404
+
+
+@pytest.mark.parametrize("method, path, status", [
+    ("GET", "/nowhere", 404), ("POST", "/health", 405), ("GET", "/identify", 405), ("PUT", "/streams/1", 405),
+])
+def test_unknown_routes_and_methods(api, method, path, status):
+    with pytest.raises(server.HttpError) as error:
+        call(api, method, path)
+    assert error.value.status == status
@@ -0,0 +1,193 @@
+import json
+import os
+import time
+
+import numpy as np
+import pytest
+
+from faice_core import ENCODING_SIZE, AttendanceLog, FaceDatabase, SnapshotWriter
+
+
+def encoding(value):
+    return np.full(ENCODING_SIZE, value, dtype=np.float32)
+
+
+def as_dict(database):
+    encodings, names = database.read()
+    gallery = {}
+    for name, row in zip(names, encodings):
+        gallery.setdefault(name, []).append(float(row[0]))
+    return gallery
+
+
+def test_database_starts_empty(tmp_path):
+    database = FaceDatabase(str(tmp_path / "face_db"))
+    assert not database.exists()
+    encodings, names = database.read()
+    assert encodings.shape == (0, ENCODING_SIZE) and names == []
+    assert not database.remove("alice")
+
+
+def test_put_replaces_an_identity_and_survives_reopen(tmp_path):
+    folder = str(tmp_path / "face_db")
+    database = FaceDatabase(folder)
+    database.write_all(np.stack([encoding(0.1), encoding(0.2)]), ["alice", "bob"])
+    database.put("carol", np.stack([encoding(0.3), encoding(0.31)]))
+    database.put("alice", encoding(0.4))
+    assert as_dict(database) == {'bob': [pytest.approx(0.2)], 'carol': [pytest.approx(0.3), pytest.approx(0.31)],
+                                 'alice': [pytest.approx(0.4)]}
+    assert database.header['rows'] == 5 and database.header['live'] == 4
+    assert database.records['deleted'].tolist() == [1, 0, 0, 0, 0]
+    assert as_dict(FaceDatabase(folder)) == as_dict(database)
+
+
+def test_remove_tombstones_and_compacts_into_a_new_generation(tmp_path):
+    folder = str(tmp_path / "face_db")
+    database = FaceDatabase(folder)
+    database.write_all(np.stack([encoding(value) for value in (0.1, 0.2, 0.3, 0.4)]), ["a", "b", "c", "d"])
+    assert database.header['generation'] == 1
+    assert database.remove("a")
+    assert not database.remove("a")
+    assert database.header['generation'] == 1 and database.header['live'] == 3
+    database.remove("b")
+    database.remove("c")
+    # Fewer than half the rows are live: rewritten without the dead ones
+    assert database.header['generation'] == 2
+    assert database.header['rows'] == database.header['live'] == 1
+    assert as_dict(FaceDatabase(folder)) == {'d': [pytest.approx(0.4)]}
+    assert sorted(filename for filename in os.listdir(folder) if not filename.startswith("header")) == \
+        ["embeddings.2.f32", "identities.2.bin"]
+
+
+def test_read_is_zero_copy_without_tombstones(tmp_path):
+    database = FaceDatabase(str(tmp_path / "face_db"))
+    database.write_all(np.stack([encoding(0.1), encoding(0.2)]), ["alice", "bob"])
+    database.put("carol", encoding(0.3))
+    encodings, names = database.read()
+    assert isinstance(encodings, np.memmap)
+    assert names == ["alice", "bob", "carol"]
+    database.put("carol", encoding(0.35))
+    encodings, _ = database.read()
+    assert not isinstance(encodings, np.memmap)
+
+
+def test_newest_put_wins_when_tombstones_were_never_written(tmp_path):
+    database = FaceDatabase(str(tmp_path / "face_db"))
+    database.write_all(encoding(0.1)[None], ["alice"])
+    time.sleep(0.01)
+    # An append without the tombstone that put() would follow it with
+    database.append(["alice"], encoding(0.2)[None])
+    assert as_dict(database) == {'alice': [pytest.approx(0.2)]}
+
+
+def test_database_rejects_newer_versions_and_long_names(tmp_path):
+    folder = str(tmp_path / "face_db")
+    database = FaceDatabase(folder)
+    with pytest.raises(ValueError):
+        database.put("x" * (FaceDatabase.NAME_BYTES + 1), encoding(0.1))
+    with pytest.raises(ValueError):
+        database.write_all(np.stack([encoding(0.1), encoding(0.2)]), ["alice"])
+    database.put("alice", encoding(0.1))
+    with open(database.header_path) as file:
+        header = json.load(file)
+    header['version'] = FaceDatabase.VERSION + 1
+    with open(database.header_path, 'w') as file:
+        json.dump(header, file)
+    with pytest.raises(ValueError):
+        FaceDatabase(folder)
+
+
+@pytest.fixture(params=["attendance.db", "attendance.csv"])
+def attendance(request, tmp_path):
+    log = AttendanceLog(str(tmp_path / request.param), debounce_seconds=60, flush_interval=3600)
+    yield log
+    log.close()
+
+
+def test_attendance_debounces_repeat_sightings(attendance):
+    start = time.mktime((2024, 3, 4, 9, 0, 0, 0, 0, -1))
+    assert attendance.record("alice", start, "camera 1")
+    assert not attendance.record("alice", start + 30)
+    assert attendance.record("bob", start + 30)
+    assert attendance.record("alice", start + 90, "camera 2")
+    # The CSV backend keeps the legacy three-column layout, without the source
+    csv_backend = attendance.backend.path.endswith(".csv")
+    first, second = (None, None) if csv_backend else ("camera 1", "camera 2")
+    assert [tuple(row) for row in attendance.query()] == [("alice", "2024-03-04", "09:00:00", first),
+                                                          ("bob", "2024-03-04", "09:00:30", None),
+                                                          ("alice", "2024-03-04", "09:01:30", second)]
+    assert [tuple(row) for row in attendance.query(name="alice", limit=1, offset=1)] == \
+        [("alice", "2024-03-04", "09:01:30", second)]
+
+
+def test_attendance_summaries(attendance):
+    start = time.mktime((2024, 3, 4, 9, 0, 0, 0, 0, -1))
+    for offset in (0, 600, 1200):
+        attendance.record("alice", start + offset)
+    attendance.record("alice", start + 86400)
+    attendance.record("bob", start + 86400)
+    assert {name: tuple(row) for name, row in attendance.day_summary("2024-03-04").items()} == \
+        {'alice': ("09:00:00", "09:20:00", 3)}
+    assert attendance.days_present(["alice", "bob", "carol"]) == {'alice': 2, 'bob': 1}
+    assert [tuple(row) for row in attendance.query(date="2024-03-05")] == \
+        [("alice", "2024-03-05", "09:00:00", None), ("bob", "2024-03-05", "09:00:00", None)]
+
+
+def test_attendance_is_written_by_the_flusher(tmp_path):
+    log = AttendanceLog(str(tmp_path / "attendance.db"), flush_interval=0.05)
+    try:
+        log.record("alice")
+        # Read the backend directly, since query() would flush by itself
+        deadline = time.monotonic() + 2
+        while not log.backend.query() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert [row[0] for row in log.backend.query()] == ["alice"]
+    finally:
+        log.close()
+
+
+def make_snapshot(folder, filename, size, age_days=0):
+    paths = [os.path.join(folder, filename), os.path.join(folder, "context", filename)]
+    modified = time.time() - age_days * 86400
+    for path in paths:
+        with open(path, 'wb') as file:
+            file.write(b"\0" * size)
+        os.utime(path, (modified, modified))
+    return paths
+
+
+def test_snapshot_limits_delete_crops_and_context_together(tmp_path):
+    folder = str(tmp_path / "trespassers")
+    writer = SnapshotWriter(folder, quota_bytes=2500, retention_days=30)
+    expired = make_snapshot(folder, "expired.jpg", 10, age_days=40)
+    oldest = make_snapshot(folder, "oldest.jpg", 500, age_days=3)
+    older = make_snapshot(folder, "older.jpg", 500, age_days=2)
+    newest = make_snapshot(folder, "newest.jpg", 500, age_days=1)
+    # A context frame whose crop is already gone still counts towards the quota
+    orphan = os.path.join(folder, "context", "orphan.jpg")
+    with open(orphan, 'wb') as file:
+        file.write(b"\0" * 10)
+    os.utime(orphan, (time.time() - 40 * 86400,) * 2)
+    writer.enforce_limits()
+    remaining = {path for path in expired + oldest + older + newest + [orphan] if os.path.exists(path)}
+    assert remaining == set(older + newest)
+    assert writer.usage == 2000
+
+
+def test_snapshot_writer_keeps_running_after_a_failed_write(tmp_path):
+    writer = SnapshotWriter(str(tmp_path / "trespassers"), min_interval=0)
+    frame = np.full((120, 160, 3), 128, np.uint8)
+    original_write = writer.write
+
+    def failing_write(*item):
+        raise OSError("disk full")
+    writer.write = failing_write
+    assert writer.submit(frame, (20, 80, 80, 20), 1)
+    writer.flush()
+    assert writer.failed == 1
+    writer.write = original_write
+    assert writer.submit(frame, (20, 80, 80, 20), 2)
+    writer.flush()
+    assert writer.thread.is_alive()
+    assert writer.written == 1
+    assert len(os.listdir(str(tmp_path / "trespassers" / "context"))) == 1
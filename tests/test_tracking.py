@@ -0,0 +1,74 @@
+from faice_core import FaceTracker
+
+
+def shifted(box, dy=0, dx=0):
+    top, right, bottom, left = box
+    return (top + dy, right + dx, bottom + dy, left + dx)
+
+
+FACE = (100, 200, 200, 100)
+OTHER = (100, 600, 200, 500)
+
+
+def test_new_faces_get_tracks_and_are_encoded_once():
+    tracker = FaceTracker(reverify_interval=5.0)
+    tracks, to_encode, lost = tracker.update([FACE, OTHER], now=0.0)
+    assert [track.track_id for track in tracks] == [1, 2]
+    assert to_encode == [0, 1] and lost == []
+    for track in tracks:
+        track.name = "alice"
+    tracks, to_encode, _ = tracker.update([shifted(OTHER, dx=5), shifted(FACE, dy=5)], now=1.0)
+    # Matched by overlap even though the detector returned them in the other order
+    assert [track.track_id for track in tracks] == [2, 1]
+    assert to_encode == []
+
+
+def test_named_tracks_are_reverified_on_interval():
+    tracker = FaceTracker(reverify_interval=5.0)
+    [track], _, _ = tracker.update([FACE], now=0.0)
+    track.name = "alice"
+    assert tracker.update([FACE], now=4.9)[1] == []
+    assert tracker.update([FACE], now=5.0)[1] == [0]
+    assert tracker.update([FACE], now=6.0)[1] == []
+
+
+def test_unknown_tracks_are_retried_sooner():
+    tracker = FaceTracker(reverify_interval=5.0, retry_interval=1.0)
+    [track], _, _ = tracker.update([FACE], now=0.0)
+    track.name = "Unknown"
+    assert tracker.update([FACE], now=0.5)[1] == []
+    assert tracker.update([FACE], now=1.0)[1] == [0]
+    track.name = "alice"
+    assert tracker.update([FACE], now=2.5)[1] == []
+
+
+def test_fast_movers_keep_their_track_by_centroid():
+    tracker = FaceTracker(iou_threshold=0.3, centroid_threshold=0.6)
+    [track], _, _ = tracker.update([FACE], now=0.0)
+    # Too little overlap for IoU, but the centre moved less than 0.6 face widths
+    moved_box = shifted(FACE, dx=57)
+    assert tracker.affinity([FACE], [moved_box])[0, 0] < 0.3
+    [moved], to_encode, _ = tracker.update([moved_box], now=0.2)
+    assert moved is track
+    assert to_encode == []
+    [far], to_encode, lost = tracker.update([shifted(FACE, dx=400)], now=0.4)
+    assert far is not track and to_encode == [0]
+
+
+def test_tracks_are_lost_after_max_missed_frames():
+    tracker = FaceTracker(max_missed=2)
+    [track], _, _ = tracker.update([FACE], now=0.0)
+    assert tracker.update([], now=0.1)[2] == []
+    assert tracker.update([], now=0.2)[2] == []
+    assert tracker.update([], now=0.3)[2] == [track]
+    assert tracker.tracks == []
+    [returned], to_encode, _ = tracker.update([FACE], now=0.4)
+    assert returned.track_id == 2 and to_encode == [0]
+
+
+def test_a_missed_frame_does_not_reset_the_track():
+    tracker = FaceTracker(max_missed=2)
+    [track], _, _ = tracker.update([FACE], now=0.0)
+    tracker.update([], now=0.1)
+    [again], _, _ = tracker.update([FACE], now=0.2)
+    assert again is track and track.missed == 0